@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+"""
+Times task 0 set up in hgi_arvados against FakeArvados for synthetic
+cohorts of CRAMs:
+  cram_fanout             chunked_tasks_per_cram_file, one task per CRAM and chunk
+  reuse_lookup            get_reusable_tasks over a previous job's tasks
+  cram_fanout_with_reuse  chunked_tasks_per_cram_file matching every task for reuse
+                          (only up to --reuse-max-size CRAMs)
+  gvcf_fanout             one_task_per_group_and_per_n_gvcfs over one gVCF per CRAM and chunk
+  validate_outputs        validate_compressed_indexed_vcf_collection over one gVCF per CRAM
+
+Example:
+  bench_task_fanout.py --sizes 10,1000,100000 --api-latency 0.002 --json fanout.json
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import argparse
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCHMARKS_DIR), "crunch_scripts"))
+
+from fake_arvados import FakeArvados
+from fixtures import bgzf_block, BGZF_EOF
+
+SCRIPT = "gatk-haplotypecaller-cram.py"
+GROUP_BY_REGEX = r'\.(?P<group_by>[0-9]+_of_[0-9]+)\.'
+REUSE_KEY_PARAMS = ['input', 'ref', 'chunk']
+
+class Cohort(object):
+    """
+    Collections for a synthetic cohort of size CRAMs split into chunks
+    chunks. All files share a single Keep block, so only manifests grow
+    with the cohort.
+    """
+    def __init__(self, fake, size, chunks):
+        cram = "CRAM" + "\0" * 996
+        crai = "\0" * 100
+        gvcf = bgzf_block("##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tsample\n") + BGZF_EOF
+        tbi = bgzf_block("TBI\1" + "\0" * 60) + BGZF_EOF
+        interval_list = "@HD\tVN:1.4\n@SQ\tSN:1\tLN:1000000\n1\t1\t1000000\t+\tchunk\n"
+        layout = []
+        offset = 0
+        for name, data in (('cram', cram), ('crai', crai), ('gvcf', gvcf), ('tbi', tbi), ('interval_list', interval_list)):
+            layout.append((name, (offset, len(data))))
+            offset += len(data)
+        ranges = dict(layout)
+        locator = fake.put_block(cram + crai + gvcf + tbi + interval_list)
+
+        def manifest(files):
+            return ". %s %s\n" % (locator, ' '.join(["%s:%s:%s" % (ranges[kind][0], ranges[kind][1], name)
+                                                    for kind, name in files]))
+
+        chunk_names = ["genome.%s_of_%s" % (chunk_i + 1, chunks) for chunk_i in range(0, chunks)]
+        samples = ["sample%06d" % (sample_i) for sample_i in range(0, size)]
+        self.ref = fake.create_collection(manifest([('cram', 'ref.fa'), ('crai', 'ref.fa.fai'), ('crai', 'ref.dict')]))['portable_data_hash']
+        self.interval_lists = fake.create_collection(manifest([('interval_list', name + ".interval_list") for name in chunk_names]))['portable_data_hash']
+        self.crams = fake.create_collection(manifest([(kind, sample + ext) for sample in samples
+                                                      for kind, ext in (('cram', '.cram'), ('crai', '.cram.crai'))]))['portable_data_hash']
+        self.gvcfs = fake.create_collection(manifest([(kind, "%s.%s%s" % (sample, chunk_name, ext))
+                                                      for sample in samples for chunk_name in chunk_names
+                                                      for kind, ext in (('gvcf', '.g.vcf.gz'), ('tbi', '.g.vcf.gz.tbi'))]))['portable_data_hash']
+        self.outputs = fake.create_collection(manifest([(kind, sample + ext) for sample in samples
+                                                        for kind, ext in (('gvcf', '.g.vcf.gz'), ('tbi', '.g.vcf.gz.tbi'))]))['portable_data_hash']
+
+def start_job(fake, script_parameters):
+    """
+    Creates a job and its task 0 and makes them current, as crunch would.
+    """
+    import arvados
+    job = fake.create_job(SCRIPT, script_parameters)
+    task = fake.create_task(job['uuid'], 0, {})
+    fake.configure_environment(job_uuid=job['uuid'], task_uuid=task['uuid'])
+    # forget the job and task the SDK has cached
+    arvados._current_job = None
+    arvados._current_task = None
+    return job
+
+def timed(fake, results, size, phase, func, *args, **kwargs):
+    fake.store.reset_counts()
+    start = time.time()
+    result = func(*args, **kwargs)
+    seconds = time.time() - start
+    requests = dict(fake.store.request_counts)
+    results.append({'size': size, 'phase': phase, 'seconds': seconds, 'requests': requests})
+    return result
+
+def run(fake, size, chunks, results, reuse_max_size):
+    import hgi_arvados
+    from hgi_arvados import validators
+
+    cohort = Cohort(fake, size, chunks)
+    script_parameters = {'reference_collection': cohort.ref,
+                         'inputs_collection': cohort.crams,
+                         'interval_lists_collection': cohort.interval_lists}
+
+    job = start_job(fake, script_parameters)
+    timed(fake, results, size, 'cram_fanout', hgi_arvados.chunked_tasks_per_cram_file,
+          cohort.ref, cohort.crams, cohort.interval_lists, lambda output: True,
+          if_sequence=0, and_end_task=False, reuse_tasks=False, script=SCRIPT)
+
+    # the tasks of that job become the history for the next one to reuse
+    for task in fake.store.records['job_tasks']:
+        if task['job_uuid'] == job['uuid'] and task['sequence'] == 1:
+            task.update({'success': True, 'output': cohort.outputs, 'progress': 1.0,
+                         'started_at': task['created_at'], 'finished_at': task['created_at']})
+
+    job = start_job(fake, script_parameters)
+    job_filters = [
+        ['script', '=', SCRIPT],
+        ['repository', '=', job['repository']],
+        ['script_version', 'in git', job['script_version']],
+        ['docker_image_locator', 'in docker', job['docker_image_locator']],
+    ]
+    timed(fake, results, size, 'reuse_lookup', hgi_arvados.get_reusable_tasks,
+          1, REUSE_KEY_PARAMS, job_filters)
+    if size <= reuse_max_size:
+        # this lists every reusable task once per CRAM, so grows with the square of size
+        timed(fake, results, size, 'cram_fanout_with_reuse', hgi_arvados.chunked_tasks_per_cram_file,
+              cohort.ref, cohort.crams, cohort.interval_lists, lambda output: True,
+              if_sequence=0, and_end_task=False, reuse_tasks=True,
+              oldest_git_commit_to_reuse=job['script_version'], script=SCRIPT)
+
+    start_job(fake, {'reference_collection': cohort.ref,
+                     'inputs_collection': cohort.gvcfs,
+                     'interval_lists_collection': cohort.interval_lists})
+    timed(fake, results, size, 'gvcf_fanout', hgi_arvados.one_task_per_group_and_per_n_gvcfs,
+          cohort.ref, cohort.gvcfs, cohort.interval_lists, GROUP_BY_REGEX, 0,
+          if_sequence=0, and_end_task=False)
+
+    if not timed(fake, results, size, 'validate_outputs',
+                 validators.validate_compressed_indexed_vcf_collection, cohort.outputs):
+        raise Exception("synthetic outputs did not validate")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark task 0 set up against a local fake Arvados")
+    parser.add_argument("--sizes", default="10,100,1000,10000,100000",
+                        help="comma-separated cohort sizes (number of CRAMs)")
+    parser.add_argument("--chunks", type=int, default=4, help="number of genome chunks")
+    parser.add_argument("--api-latency", type=float, default=0.002, help="seconds added to every API request")
+    parser.add_argument("--keep-latency", type=float, default=0.001, help="seconds added to every Keep request")
+    parser.add_argument("--page-limit", type=int, default=1000, help="maximum items returned by a list request")
+    parser.add_argument("--reuse-max-size", type=int, default=1000,
+                        help="largest cohort to time cram_fanout_with_reuse for")
+    parser.add_argument("--json", help="write the timings to this file")
+    args = parser.parse_args()
+
+    fake = FakeArvados(api_latency=args.api_latency, keep_latency=args.keep_latency,
+                       max_page_size=args.page_limit).start()
+    # a crunch-like environment (TASK_WORK, JOB_WORK and CRUNCH_TMP), as
+    # run_benchmarks.py sets up for its cases
+    work_dir = os.path.join(fake.tmpdir, "work")
+    for env, name in (('TASK_WORK', "task"), ('JOB_WORK', "job"), ('CRUNCH_TMP', "crunch")):
+        os.environ[env] = os.path.join(work_dir, name)
+        os.makedirs(os.environ[env])
+
+    # the functions under test are chatty, keep their output apart from the timings
+    results = []
+    log = open(os.path.join(fake.tmpdir, "benchmark.log"), "w")
+    print "%8s  %-24s %11s %17s" % ("size", "phase", "time", "")
+    for size in [int(size) for size in args.sizes.split(",")]:
+        stdout = sys.stdout
+        sys.stdout = log
+        try:
+            run(fake, size, args.chunks, results, args.reuse_max_size)
+        finally:
+            sys.stdout = stdout
+        for result in results:
+            if result['size'] == size:
+                print "%8s  %-24s %10.3fs %8s requests" % (size, result['phase'], result['seconds'], sum(result['requests'].values()))
+    fake.stop()
+    shutil.rmtree(work_dir, ignore_errors=True)
+    print "Output of the functions under test is in %s" % (log.name)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,497 @@
+#!/usr/bin/env python
+"""
+A local stand-in for the parts of the Arvados API server and Keep
+that the crunch scripts use, so that task 0 set up (task fan-out,
+reuse lookups and output validation) can be measured without a
+cluster.
+
+FakeArvados runs two threaded HTTP servers in this process:
+  - an API server (HTTPS, as arvados.api() only speaks HTTPS) with a
+    discovery document describing the jobs, job_tasks, collections and
+    keep_services resources, so that the real Python SDK can be pointed
+    at it with ARVADOS_API_HOST and ARVADOS_API_HOST_INSECURE
+  - a Keep server (HTTP) for block GET and PUT, which the SDK finds
+    through keep_services.accessible
+Every request can be delayed by a fixed latency, and list requests are
+capped at max_page_size items (as the real API server caps them), so
+that the pagination in hgi_arvados.execute_list_all is exercised.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import tempfile
+import threading
+import subprocess
+import ssl
+import socket
+import urllib
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+UUID_PREFIX = "zzzzz"
+
+# largest block the SDK writes to Keep
+KEEP_BLOCK_SIZE = 2 ** 26
+
+# uuid infix and list kind for each resource
+RESOURCES = {
+    'jobs': ('8i9sb', 'Job'),
+    'job_tasks': ('ot0gb', 'JobTask'),
+    'collections': ('4zz18', 'Collection'),
+    'keep_services': ('bi6l4', 'KeepService'),
+}
+
+LIST_PARAMETERS = {
+    'filters': {'type': 'array', 'location': 'query'},
+    'where': {'type': 'object', 'location': 'query'},
+    'order': {'type': 'array', 'location': 'query'},
+    'select': {'type': 'array', 'location': 'query'},
+    'distinct': {'type': 'boolean', 'location': 'query'},
+    'limit': {'type': 'integer', 'location': 'query'},
+    'offset': {'type': 'integer', 'location': 'query'},
+    'count': {'type': 'string', 'location': 'query'},
+}
+
+UUID_PARAMETER = {'uuid': {'type': 'string', 'required': True, 'location': 'path'}}
+
+def discovery_document(root_url):
+    """
+    Returns a discovery document describing the fake API, enough for
+    googleapiclient (and so arvados.api()) to build a client from.
+    """
+    resources = {}
+    schemas = {}
+    for resource, (infix, kind) in RESOURCES.items():
+        schemas[kind] = {'id': kind, 'type': 'object'}
+        schemas[kind + 'List'] = {'id': kind + 'List', 'type': 'object'}
+        methods = {
+            'list': {'id': 'arvados.%s.list' % resource, 'path': resource, 'httpMethod': 'GET',
+                     'parameters': LIST_PARAMETERS, 'response': {'$ref': kind + 'List'}},
+            'get': {'id': 'arvados.%s.get' % resource, 'path': resource + '/{uuid}', 'httpMethod': 'GET',
+                    'parameters': UUID_PARAMETER, 'parameterOrder': ['uuid'], 'response': {'$ref': kind}},
+            'create': {'id': 'arvados.%s.create' % resource, 'path': resource, 'httpMethod': 'POST',
+                       'parameters': {'ensure_unique_name': {'type': 'boolean', 'location': 'query'}},
+                       'request': {'$ref': kind, 'required': True}, 'response': {'$ref': kind}},
+            'update': {'id': 'arvados.%s.update' % resource, 'path': resource + '/{uuid}', 'httpMethod': 'PUT',
+                       'parameters': UUID_PARAMETER, 'parameterOrder': ['uuid'],
+                       'request': {'$ref': kind, 'required': True}, 'response': {'$ref': kind}},
+        }
+        if resource == 'keep_services':
+            methods['accessible'] = {'id': 'arvados.keep_services.accessible', 'path': 'keep_services/accessible',
+                                     'httpMethod': 'GET', 'parameters': {}, 'response': {'$ref': 'KeepServiceList'}}
+        resources[resource] = {'methods': methods}
+    return {
+        'kind': 'discovery#restDescription',
+        'discoveryVersion': 'v1',
+        'id': 'arvados:v1',
+        'name': 'arvados',
+        'version': 'v1',
+        'protocol': 'rest',
+        'rootUrl': root_url,
+        'servicePath': 'arvados/v1/',
+        'baseUrl': root_url + 'arvados/v1/',
+        'batchPath': 'batch',
+        'uuidPrefix': UUID_PREFIX,
+        'defaultCollectionReplication': 1,
+        'blobSignatureTtl': 1209600,
+        'parameters': {},
+        'schemas': schemas,
+        'resources': resources,
+    }
+
+def portable_data_hash(manifest_text):
+    # the hash covers the manifest with all locator hints except the size removed
+    stripped = re.sub(r'\b([0-9a-f]{32}\+\d+)\+\S+', r'\1', manifest_text)
+    return "%s+%s" % (hashlib.md5(stripped).hexdigest(), len(stripped))
+
+def _like_regex(pattern, flags=0):
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\' and i + 1 < len(pattern):
+            regex += re.escape(pattern[i + 1])
+            i += 1
+        elif c == '%':
+            regex += '.*'
+        elif c == '_':
+            regex += '.'
+        else:
+            regex += re.escape(c)
+        i += 1
+    return re.compile('^' + regex + '$', flags | re.DOTALL)
+
+def _serialized(value):
+    # the API server stores hashes such as job_task parameters as YAML,
+    # which is what the 'like' filters in hgi_arvados match against
+    if isinstance(value, dict):
+        return "---\n" + ''.join(["%s: %s\n" % (k, v) for k, v in sorted(value.items())])
+    return "%s" % (value,)
+
+def _matches(record, attr, operator, operand):
+    value = record.get(attr)
+    if operator == '=':
+        return value == operand or "%s" % (value,) == "%s" % (operand,)
+    if operator == '!=':
+        return not _matches(record, attr, '=', operand)
+    if operator == 'in':
+        return value in operand
+    if operator == 'not in':
+        return value not in operand
+    if operator in ('<', '<=', '>', '>='):
+        return value is not None and {'<': value < operand, '<=': value <= operand,
+                                      '>': value > operand, '>=': value >= operand}[operator]
+    if operator in ('like', 'ilike'):
+        flags = re.IGNORECASE if operator == 'ilike' else 0
+        return _like_regex(operand, flags).match(_serialized(value)) is not None
+    if operator == 'in git':
+        # every script_version is taken to descend from the given commit
+        return True
+    if operator == 'in docker':
+        return value == operand
+    raise ValueError("unsupported filter operator %s" % (operator))
+
+class FakeStore(object):
+    """
+    The records held by the fake API server and the blocks held by the
+    fake Keep server, with counts of the requests made to each.
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.records = dict((resource, []) for resource in RESOURCES)
+        self.by_uuid = {}
+        self.blocks = {}
+        self.request_counts = {}
+        self.next_id = 0
+
+    def count_request(self, name):
+        with self.lock:
+            self.request_counts[name] = self.request_counts.get(name, 0) + 1
+
+    def reset_counts(self):
+        with self.lock:
+            self.request_counts = {}
+
+    def create(self, resource, body, ensure_unique_name=False):
+        with self.lock:
+            self.next_id += 1
+            record = {
+                'uuid': "%s-%s-%015d" % (UUID_PREFIX, RESOURCES[resource][0], self.next_id),
+                'created_at': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            }
+            if resource == 'job_tasks':
+                record.update({'success': None, 'output': None, 'progress': 0.0,
+                               'started_at': None, 'finished_at': None, 'parameters': {},
+                               'created_by_job_task_uuid': None})
+            elif resource == 'collections':
+                record.update({'name': None, 'manifest_text': ''})
+            record.update(body)
+            if resource == 'collections':
+                record['portable_data_hash'] = portable_data_hash(record['manifest_text'])
+                if ensure_unique_name and record['name']:
+                    names = set([c['name'] for c in self.records['collections']])
+                    base_name = record['name']
+                    n = 1
+                    while record['name'] in names:
+                        n += 1
+                        record['name'] = "%s (%s)" % (base_name, n)
+            self.records[resource].append(record)
+            self.by_uuid[record['uuid']] = record
+            return record
+
+    def get(self, resource, uuid):
+        with self.lock:
+            if uuid in self.by_uuid:
+                return self.by_uuid[uuid]
+            if resource == 'collections':
+                for record in self.records['collections']:
+                    if record['portable_data_hash'] == uuid:
+                        return record
+                # a manifest CollectionWriter.finish() put in Keep can be
+                # read by its locator, as on a crunch v1 cluster
+                m = re.match(r'^([0-9a-f]{32})\+[0-9]+$', uuid)
+                if m and m.group(1) in self.blocks:
+                    return {'uuid': uuid, 'portable_data_hash': uuid,
+                            'manifest_text': self.blocks[m.group(1)]}
+            return None
+
+    def update(self, uuid, body):
+        with self.lock:
+            record = self.by_uuid.get(uuid)
+            if record is not None:
+                record.update(body)
+            return record
+
+    def list(self, resource, filters=None, select=None, limit=100, offset=0):
+        with self.lock:
+            matched = [record for record in self.records[resource]
+                       if all([_matches(record, f[0], f[1], f[2]) for f in (filters or [])])]
+        items = matched[offset:offset + limit]
+        if select:
+            items = [dict((attr, record.get(attr)) for attr in select) for record in items]
+        return {'kind': 'arvados#%sList' % (RESOURCES[resource][1][0].lower() + RESOURCES[resource][1][1:]),
+                'items': items, 'items_available': len(matched),
+                'offset': offset, 'limit': limit}
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # held here so that it is still set while the interpreter shuts down
+    _disconnect_errors = (socket.error,)
+
+    def handle(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.handle(self)
+        except self._disconnect_errors:
+            # the SDK's pooled connections are dropped without closing
+            # TLS, which is not worth a traceback in the logs
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, code, body, content_type="application/json", headers=None):
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.getheader('content-length', 0))
+        return self.rfile.read(length) if length > 0 else ''
+
+class _ApiHandler(_Handler):
+    def _dispatch(self, http_method):
+        fake = self.server.fake
+        url = urlparse.urlparse(self.path)
+        query = dict((k, v[0]) for k, v in urlparse.parse_qs(url.query).items())
+        if url.path.startswith('/discovery/v1/apis/arvados/v1/rest'):
+            return self._reply(200, discovery_document(fake.api_root_url()))
+        m = re.match(r'^/arvados/v1/([a-z_]+)(?:/([^/]+))?$', url.path)
+        if m is None or m.group(1) not in RESOURCES:
+            return self._reply(404, {'errors': ['not found: %s' % url.path]})
+        resource, uuid = m.group(1), m.group(2)
+        if uuid is not None:
+            # the SDK quotes the '+' in a portable data hash
+            uuid = urllib.unquote(uuid)
+        time.sleep(fake.api_latency)
+        store = fake.store
+        if http_method == 'GET' and uuid == 'accessible':
+            store.count_request('keep_services.accessible')
+            return self._reply(200, {'kind': 'arvados#keepServiceList', 'items': [fake.keep_service()],
+                                     'items_available': 1})
+        if http_method == 'GET' and uuid is None:
+            store.count_request(resource + '.list')
+            limit = min(int(query.get('limit', 100)), fake.max_page_size)
+            return self._reply(200, store.list(resource,
+                                               filters=json.loads(query.get('filters', '[]')),
+                                               select=json.loads(query.get('select', 'null')),
+                                               limit=limit, offset=int(query.get('offset', 0))))
+        if http_method == 'GET':
+            store.count_request(resource + '.get')
+            record = store.get(resource, uuid)
+            if record is None:
+                return self._reply(404, {'errors': ['%s not found' % uuid]})
+            return self._reply(200, record)
+        body = json.loads(self._body() or '{}')
+        singular = RESOURCES[resource][1]
+        singular = re.sub(r'([a-z])([A-Z])', r'\1_\2', singular).lower()
+        if len(body) == 1 and singular in body:
+            # the SDK may wrap the record in its resource name
+            body = body[singular]
+        if http_method == 'POST':
+            store.count_request(resource + '.create')
+            return self._reply(200, store.create(resource, body,
+                                                 ensure_unique_name=query.get('ensure_unique_name') == 'true'))
+        store.count_request(resource + '.update')
+        record = store.update(uuid, body)
+        if record is None:
+            return self._reply(404, {'errors': ['%s not found' % uuid]})
+        return self._reply(200, record)
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+class _KeepHandler(_Handler):
+    def do_GET(self):
+        fake = self.server.fake
+        time.sleep(fake.keep_latency)
+        fake.store.count_request('keep.get')
+        block_hash = self.path.lstrip('/')[:32]
+        if block_hash not in fake.store.blocks:
+            return self._reply(404, "not found", content_type="text/plain")
+        self._reply(200, fake.store.blocks[block_hash], content_type="application/octet-stream")
+
+    def do_PUT(self):
+        fake = self.server.fake
+        time.sleep(fake.keep_latency)
+        fake.store.count_request('keep.put')
+        data = self._body()
+        block_hash = hashlib.md5(data).hexdigest()
+        if self.path.lstrip('/')[:32] != block_hash:
+            return self._reply(422, "hash mismatch", content_type="text/plain")
+        fake.store.blocks[block_hash] = data
+        # claim as many copies as were asked for, or the SDK reports a failed write
+        replicas = self.headers.getheader('X-Keep-Desired-Replicas') or '2'
+        self._reply(200, "%s+%s" % (block_hash, len(data)), content_type="text/plain",
+                    headers={'X-Keep-Replicas-Stored': replicas})
+
+class FakeArvados(object):
+    """
+    Runs the fake API and Keep servers. Call start() and then
+    configure_environment() before importing arvados-using code, so
+    that arvados.api() and Keep use the fakes.
+    """
+    def __init__(self, api_latency=0.0, keep_latency=0.0, max_page_size=1000):
+        self.api_latency = api_latency
+        self.keep_latency = keep_latency
+        self.max_page_size = max_page_size
+        self.store = FakeStore()
+        self.api_server = None
+        self.keep_server = None
+        self.tmpdir = tempfile.mkdtemp(prefix="fake_arvados.")
+
+    def _serve(self, handler, certfile=None, keyfile=None):
+        server = _ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        server.fake = self
+        if certfile:
+            server.socket = ssl.wrap_socket(server.socket, certfile=certfile, keyfile=keyfile, server_side=True)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+    def start(self):
+        certfile = os.path.join(self.tmpdir, "api.crt")
+        keyfile = os.path.join(self.tmpdir, "api.key")
+        subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+                               "-subj", "/CN=localhost", "-days", "1",
+                               "-keyout", keyfile, "-out", certfile],
+                              stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+        self.api_server = self._serve(_ApiHandler, certfile=certfile, keyfile=keyfile)
+        self.keep_server = self._serve(_KeepHandler)
+        return self
+
+    def stop(self):
+        for server in (self.api_server, self.keep_server):
+            if server is not None:
+                server.shutdown()
+
+    def api_host(self):
+        return "127.0.0.1:%s" % (self.api_server.server_address[1])
+
+    def api_root_url(self):
+        return "https://%s/" % (self.api_host())
+
+    def keep_service(self):
+        return {'uuid': "%s-bi6l4-000000000000000" % (UUID_PREFIX),
+                'service_host': "127.0.0.1",
+                'service_port': self.keep_server.server_address[1],
+                'service_ssl_flag': False,
+                'service_type': 'disk',
+                'read_only': False}
+
+    def configure_environment(self, job_uuid=None, task_uuid=None):
+        """
+        Points the Arvados SDK at the fakes (and, if given, at a job and
+        task, as crunch would).
+        """
+        os.environ['ARVADOS_API_HOST'] = self.api_host()
+        os.environ['ARVADOS_API_TOKEN'] = "fake-token"
+        os.environ['ARVADOS_API_HOST_INSECURE'] = "true"
+        os.environ.pop('ARVADOS_KEEP_PROXY', None)
+        os.environ.pop('KEEP_LOCAL_STORE', None)
+        if job_uuid:
+            os.environ['JOB_UUID'] = job_uuid
+        if task_uuid:
+            os.environ['TASK_UUID'] = task_uuid
+        os.environ.setdefault('CRUNCH_TMP', self.tmpdir)
+        os.environ.setdefault('TASK_WORK', self.tmpdir)
+        # the SDK reads its settings once, so have it reread them if it
+        # has already been imported
+        config = sys.modules.get('arvados.config')
+        if config is not None:
+            config.initialize()
+
+    def put_block(self, data):
+        block_hash = hashlib.md5(data).hexdigest()
+        self.store.blocks[block_hash] = data
+        return "%s+%s" % (block_hash, len(data))
+
+    def create_collection(self, manifest_text, **attrs):
+        body = dict(attrs)
+        body['manifest_text'] = manifest_text
+        return self.store.create('collections', body)
+
+    def create_collection_from_files(self, files, **attrs):
+        """
+        Puts local files (a list of (name within the collection, path))
+        into Keep and creates a collection of them, with one stream per
+        directory.
+        """
+        streams = {}
+        for name, path in files:
+            stream_name, file_name = os.path.split(name)
+            streams.setdefault(stream_name, []).append((file_name, path))
+        manifest_text = ""
+        for stream_name in sorted(streams.keys()):
+            tokens = []
+            data = []
+            position = 0
+            for file_name, path in streams[stream_name]:
+                with open(path, "rb") as f:
+                    file_data = f.read()
+                tokens.append("%s:%s:%s" % (position, len(file_data), file_name))
+                data.append(file_data)
+                position += len(file_data)
+            data = ''.join(data)
+            locators = [self.put_block(data[offset:offset + KEEP_BLOCK_SIZE])
+                        for offset in range(0, max(len(data), 1), KEEP_BLOCK_SIZE)]
+            manifest_text += "%s %s %s\n" % (os.path.join(".", stream_name) if stream_name else ".",
+                                             ' '.join(locators), ' '.join(tokens))
+        return self.create_collection(manifest_text, **attrs)
+
+    def create_job(self, script, script_parameters, **attrs):
+        body = {'script': script,
+                'script_parameters': script_parameters,
+                'script_version': attrs.pop('script_version', '0' * 40),
+                'repository': attrs.pop('repository', 'hgi/benchmarks'),
+                'docker_image_locator': attrs.pop('docker_image_locator', 'd' * 32 + '+1'),
+                'owner_uuid': attrs.pop('owner_uuid', "%s-tpzed-000000000000000" % (UUID_PREFIX))}
+        body.update(attrs)
+        return self.store.create('jobs', body)
+
+    def create_task(self, job_uuid, sequence, parameters, **attrs):
+        body = {'job_uuid': job_uuid, 'sequence': sequence, 'parameters': parameters}
+        body.update(attrs)
+        return self.store.create('job_tasks', body)
+
+if __name__ == '__main__':
+    # run the fakes until interrupted, e.g. to point an interactive
+    # session or a crunch script at them
+    fake = FakeArvados().start()
+    print "ARVADOS_API_HOST=%s ARVADOS_API_HOST_INSECURE=true ARVADOS_API_TOKEN=fake-token" % (fake.api_host())
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
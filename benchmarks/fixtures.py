@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+"""
+Generates a deterministic, scaled-down data set for benchmarking the
+pipelines away from production:
+  ref/ref.fa, ref.fa.fai, ref.dict  main contigs plus many small decoy contigs
+  interval_lists/genome.K_of_C.interval_list
+                                    the main contigs split into C chunks
+  targets/targets.interval_list     exome-like targets on the main contigs
+  crams/sampleNNNNNN.cram, .cram.crai
+                                    reads sampled from the reference (needs samtools)
+  gvcfs/sampleNNNNNN.genome.K_of_C.interval_list.vcf.gz, .vcf.gz.tbi
+                                    one BGZF gVCF per sample and chunk, named
+                                    as gatk-haplotypecaller-cram.py names them
+
+The same arguments always give the same files (CRAMs are as deterministic
+as the samtools that writes them).
+
+Example:
+  fixtures.py --out /tmp/fixtures --samples 8 --contig-length 2000000 --decoys 2000
+"""
+
+import os
+import sys
+import zlib
+import struct
+import random
+import hashlib
+import argparse
+import subprocess
+
+BGZF_MAX_BLOCK_DATA = 0xff00
+VCF_HEADER_TEMPLATE = """##fileformat=VCFv4.2
+##ALT=<ID=NON_REF,Description="Represents any possible alternative allele at this location">
+##FORMAT=<ID=AD,Number=R,Type=Integer,Description="Allelic depths for the ref and alt alleles in the order listed">
+##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Approximate read depth (reads with MQ=255 or with bad mates are filtered)">
+##FORMAT=<ID=GQ,Number=1,Type=Integer,Description="Genotype Quality">
+##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+##FORMAT=<ID=MIN_DP,Number=1,Type=Integer,Description="Minimum DP observed within the GVCF block">
+##FORMAT=<ID=PL,Number=G,Type=Integer,Description="Normalized, Phred-scaled likelihoods for genotypes as defined in the VCF specification">
+##INFO=<ID=END,Number=1,Type=Integer,Description="Stop position of the interval">
+%(contigs)s##reference=file://ref.fa
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t%(sample)s
+"""
+
+def bgzf_block(data):
+    """
+    Returns data compressed as a single BGZF block.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = struct.pack('<BBBBIBBHBBHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, 18 + len(cdata) + 8 - 1)
+    return header + cdata + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+
+BGZF_EOF = bgzf_block("")
+
+class BgzfWriter(object):
+    """
+    Writes BGZF to a file object, keeping track of virtual offsets.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.block_offset = 0
+        self.buffer = []
+        self.buffered = 0
+
+    def tell(self):
+        return (self.block_offset << 16) | self.buffered
+
+    def write(self, data):
+        while len(data) > 0:
+            room = BGZF_MAX_BLOCK_DATA - self.buffered
+            self.buffer.append(data[:room])
+            self.buffered += len(data[:room])
+            data = data[room:]
+            if self.buffered == BGZF_MAX_BLOCK_DATA:
+                self.flush()
+
+    def flush(self):
+        if self.buffered > 0:
+            block = bgzf_block(''.join(self.buffer))
+            self.f.write(block)
+            self.block_offset += len(block)
+            self.buffer = []
+            self.buffered = 0
+
+    def close(self):
+        self.flush()
+        self.f.write(BGZF_EOF)
+        self.f.close()
+
+def random_bases(seed, length):
+    """
+    Returns length bases that depend only on seed.
+    """
+    table = ''.join(["ACGT"[i % 4] for i in range(0, 256)])
+    digests = []
+    for i in range(0, (length + 63) / 64):
+        digests.append(hashlib.sha512("%s:%s" % (seed, i)).digest())
+    return ''.join(digests)[:length].translate(table)
+
+class Reference(object):
+    """
+    A reference of main contigs chr1..chrN followed by decoy contigs.
+    """
+    def __init__(self, seed, contigs, contig_length, decoys, decoy_length):
+        rng = random.Random(seed)
+        self.names = []
+        self.sequences = {}
+        for contig_i in range(0, contigs):
+            self.names.append("chr%s" % (contig_i + 1))
+        self.main_contigs = list(self.names)
+        for decoy_i in range(0, decoys):
+            self.names.append("chrUn_JTFH%08dv1_decoy" % (decoy_i + 1))
+        for name in self.names:
+            if name in self.main_contigs:
+                length = contig_length
+            else:
+                length = rng.randint(decoy_length / 2, decoy_length * 3 / 2)
+            self.sequences[name] = random_bases("%s:%s" % (seed, name), length)
+
+    def length(self, name):
+        return len(self.sequences[name])
+
+    def sq_lines(self):
+        return ''.join(["@SQ\tSN:%s\tLN:%s\tM5:%s\tUR:file:ref.fa\n" % (name, self.length(name), hashlib.md5(self.sequences[name]).hexdigest())
+                        for name in self.names])
+
+    def write(self, ref_dir, line_length=60):
+        fai = []
+        offset = 0
+        with open(os.path.join(ref_dir, "ref.fa"), "w") as fa:
+            for name in self.names:
+                sequence = self.sequences[name]
+                header = ">%s\n" % (name)
+                fa.write(header)
+                offset += len(header)
+                fai.append("%s\t%s\t%s\t%s\t%s\n" % (name, len(sequence), offset, line_length, line_length + 1))
+                for line_start in range(0, len(sequence), line_length):
+                    line = sequence[line_start:line_start + line_length] + "\n"
+                    fa.write(line)
+                    offset += len(line)
+        with open(os.path.join(ref_dir, "ref.fa.fai"), "w") as f:
+            f.write(''.join(fai))
+        with open(os.path.join(ref_dir, "ref.dict"), "w") as f:
+            f.write("@HD\tVN:1.5\tSO:unsorted\n" + self.sq_lines())
+
+    def chunks(self, chunks):
+        """
+        Returns chunks lists of (contig, start, end) (1-based, inclusive)
+        splitting the main contigs into equal shares.
+        """
+        total = sum([self.length(name) for name in self.main_contigs])
+        cuts = [total * chunk_i / chunks for chunk_i in range(0, chunks + 1)]
+        result = [[] for chunk_i in range(0, chunks)]
+        offset = 0
+        for name in self.main_contigs:
+            for chunk_i in range(0, chunks):
+                start = max(cuts[chunk_i], offset)
+                end = min(cuts[chunk_i + 1], offset + self.length(name))
+                if start < end:
+                    result[chunk_i].append((name, start - offset + 1, end - offset))
+            offset += self.length(name)
+        return result
+
+def write_interval_lists(reference, chunk_intervals, interval_list_dir):
+    names = []
+    for chunk_i, intervals in enumerate(chunk_intervals):
+        name = "genome.%s_of_%s" % (chunk_i + 1, len(chunk_intervals))
+        with open(os.path.join(interval_list_dir, name + ".interval_list"), "w") as f:
+            f.write("@HD\tVN:1.5\tSO:coordinate\n" + reference.sq_lines())
+            for contig, start, end in intervals:
+                f.write("%s\t%s\t%s\t+\t%s_%s_%s\n" % (contig, start, end, contig, start, end))
+        names.append(name)
+    return names
+
+def write_cram(reference, ref_fa, sample, seed, reads, read_length, cram_dir, samtools):
+    """
+    Writes reads single-end reads with about 1% mismatches, sampled from
+    the main contigs, as sample.cram with its index.
+    """
+    rng = random.Random("%s:%s" % (seed, sample))
+    total = sum([reference.length(name) for name in reference.main_contigs])
+    positions = []
+    for read_i in range(0, reads):
+        genome_pos = rng.randint(0, total - 1)
+        for contig_i, name in enumerate(reference.main_contigs):
+            if genome_pos < reference.length(name):
+                break
+            genome_pos -= reference.length(name)
+        positions.append((contig_i, min(genome_pos, reference.length(name) - read_length)))
+    positions.sort()
+
+    sam = os.path.join(cram_dir, sample + ".sam")
+    with open(sam, "w") as f:
+        f.write("@HD\tVN:1.5\tSO:coordinate\n" + reference.sq_lines())
+        f.write("@RG\tID:%s\tSM:%s\tPL:ILLUMINA\n" % (sample, sample))
+        for read_i, (contig_i, pos) in enumerate(positions):
+            name = reference.main_contigs[contig_i]
+            bases = list(reference.sequences[name][pos:pos + read_length])
+            for base_i in range(0, len(bases)):
+                if rng.random() < 0.01:
+                    bases[base_i] = rng.choice([b for b in "ACGT" if b != bases[base_i]])
+            flag = 16 if rng.random() < 0.5 else 0
+            f.write("%s:%s\t%s\t%s\t%s\t60\t%sM\t*\t0\t0\t%s\t%s\tRG:Z:%s\n" % (sample, read_i, flag, name, pos + 1, len(bases), ''.join(bases), "I" * len(bases), sample))
+
+    cram = os.path.join(cram_dir, sample + ".cram")
+    subprocess.check_call([samtools, "view", "-C", "-T", ref_fa, "-o", cram, sam])
+    subprocess.check_call([samtools, "index", cram])
+    os.remove(sam)
+
+def tbi_index(contig_offsets, max_ends):
+    """
+    Returns a tabix index for a VCF given, per contig in file order,
+    the virtual offsets (start, end) of its records and the largest
+    record end. Each contig's records are indexed as one chunk in bin 0,
+    which tabix and htslib accept but scan in full.
+    """
+    names = ''.join([name + "\0" for name, offsets in contig_offsets])
+    index = struct.pack('<4s7i', "TBI\1", len(contig_offsets), 2, 1, 2, 0, ord('#'), 0)
+    index += struct.pack('<i', len(names)) + names
+    for name, (start, end) in contig_offsets:
+        index += struct.pack('<iIiQQ', 1, 0, 1, start, end)
+        n_intv = ((max_ends[name] - 1) >> 14) + 1
+        index += struct.pack('<i', n_intv) + struct.pack('<%sQ' % (n_intv), *([start] * n_intv))
+    return index
+
+def write_gvcf(reference, sample, seed, intervals, path, block_length, variant_rate):
+    """
+    Writes a gVCF for sample over intervals: reference blocks of up to
+    block_length bases, broken by a heterozygous SNP at about
+    variant_rate of positions, and its tabix index.
+    """
+    rng = random.Random("%s:%s:%s" % (seed, sample, os.path.basename(path)))
+    contig_lines = ''.join(["##contig=<ID=%s,length=%s>\n" % (name, reference.length(name)) for name in reference.names])
+    writer = BgzfWriter(open(path, "wb"))
+    writer.write(VCF_HEADER_TEMPLATE % {'contigs': contig_lines, 'sample': sample})
+    contig_offsets = []
+    max_ends = {}
+    for contig, start, end in intervals:
+        sequence = reference.sequences[contig]
+        if len(contig_offsets) == 0 or contig_offsets[-1][0] != contig:
+            contig_offsets.append((contig, [writer.tell(), None]))
+        records = []
+        pos = start
+        next_variant = pos + int(rng.expovariate(variant_rate))
+        while pos <= end:
+            if pos == next_variant:
+                ref_base = sequence[pos - 1]
+                alt_base = rng.choice([b for b in "ACGT" if b != ref_base])
+                records.append("%s\t%s\t.\t%s\t%s,<NON_REF>\t%s.77\t.\t.\tGT:AD:DP:GQ:PL\t0/1:5,5,0:10:%s:%s,0,%s,115,130,245\n" % (contig, pos, ref_base, alt_base, rng.randint(30, 400), rng.randint(20, 99), rng.randint(50, 400), rng.randint(50, 400)))
+                pos += 1
+                next_variant = pos + int(rng.expovariate(variant_rate))
+            else:
+                block_end = min(end, next_variant - 1, pos + rng.randint(1, block_length) - 1)
+                dp = rng.randint(5, 40)
+                records.append("%s\t%s\t.\t%s\t<NON_REF>\t.\t.\tEND=%s\tGT:DP:GQ:MIN_DP:PL\t0/0:%s:%s:%s:0,%s,%s\n" % (contig, pos, sequence[pos - 1], block_end, dp, 3 * dp, dp - 2, 3 * dp, 30 * dp))
+                pos = block_end + 1
+        writer.write(''.join(records))
+        contig_offsets[-1][1][1] = writer.tell()
+        max_ends[contig] = max(max_ends.get(contig, 0), end)
+    writer.close()
+
+    with open(path + ".tbi", "wb") as f:
+        index_writer = BgzfWriter(f)
+        index_writer.write(tbi_index([(name, tuple(offsets)) for name, offsets in contig_offsets], max_ends))
+        index_writer.close()
+
+def write_targets(reference, seed, targets, targets_dir):
+    """
+    Writes targets exome-like targets of 100-300 bases (some overlapping)
+    on the main contigs as targets.interval_list.
+    """
+    rng = random.Random("%s:targets" % (seed))
+    lines = []
+    for contig_i, contig in enumerate(reference.main_contigs):
+        contig_targets = targets / len(reference.main_contigs) + (1 if contig_i < targets % len(reference.main_contigs) else 0)
+        starts = sorted([rng.randint(1, reference.length(contig) - 300) for target_i in range(0, contig_targets)])
+        for start in starts:
+            end = start + rng.randint(100, 300) - 1
+            lines.append("%s\t%s\t%s\t+\ttarget_%s_%s\n" % (contig, start, end, contig, start))
+    with open(os.path.join(targets_dir, "targets.interval_list"), "w") as f:
+        f.write("@HD\tVN:1.5\tSO:coordinate\n" + reference.sq_lines() + ''.join(lines))
+
+def generate(out, seed="1", contigs=3, contig_length=1000000, decoys=500, decoy_length=2000,
+             chunks=4, targets=20000, samples=4, reads=20000, read_length=100,
+             gvcf_block_length=1000, variant_rate=0.001, samtools="samtools", skip_crams=False):
+    """
+    Writes the data set to out (see the module docstring) and returns
+    a dict of the directories written to, keyed by their names.
+    """
+    dirs = dict((name, os.path.join(out, name)) for name in ("ref", "interval_lists", "targets", "crams", "gvcfs"))
+    for d in dirs.values():
+        if not os.path.isdir(d):
+            os.makedirs(d)
+
+    reference = Reference(seed, contigs, contig_length, decoys, decoy_length)
+    reference.write(dirs['ref'])
+    print "Wrote reference of %s contigs to %s" % (len(reference.names), dirs['ref'])
+
+    chunk_intervals = reference.chunks(chunks)
+    chunk_names = write_interval_lists(reference, chunk_intervals, dirs['interval_lists'])
+    print "Wrote %s interval lists to %s" % (len(chunk_names), dirs['interval_lists'])
+
+    write_targets(reference, seed, targets, dirs['targets'])
+    print "Wrote %s targets to %s" % (targets, dirs['targets'])
+
+    for sample in ["sample%06d" % (sample_i + 1) for sample_i in range(0, samples)]:
+        if not skip_crams:
+            write_cram(reference, os.path.join(dirs['ref'], "ref.fa"), sample, seed, reads, read_length, dirs['crams'], samtools)
+        for chunk_name, intervals in zip(chunk_names, chunk_intervals):
+            write_gvcf(reference, sample, seed, intervals,
+                       os.path.join(dirs['gvcfs'], "%s.%s.interval_list.vcf.gz" % (sample, chunk_name)),
+                       gvcf_block_length, variant_rate)
+        print "Wrote %s" % (sample)
+    return dirs
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a deterministic benchmark data set")
+    parser.add_argument("--out", required=True, help="directory to write to")
+    parser.add_argument("--seed", default="1", help="seed for all random choices")
+    parser.add_argument("--contigs", type=int, default=3, help="number of main contigs")
+    parser.add_argument("--contig-length", type=int, default=1000000, help="length of each main contig")
+    parser.add_argument("--decoys", type=int, default=500, help="number of decoy contigs")
+    parser.add_argument("--decoy-length", type=int, default=2000, help="mean length of decoy contigs")
+    parser.add_argument("--chunks", type=int, default=4, help="number of interval lists to split the main contigs into")
+    parser.add_argument("--targets", type=int, default=20000, help="number of targets in targets.interval_list")
+    parser.add_argument("--samples", type=int, default=4, help="number of samples")
+    parser.add_argument("--reads", type=int, default=20000, help="number of reads per sample")
+    parser.add_argument("--read-length", type=int, default=100, help="length of each read")
+    parser.add_argument("--gvcf-block-length", type=int, default=1000, help="longest gVCF reference block")
+    parser.add_argument("--variant-rate", type=float, default=0.001, help="heterozygous SNPs per base in gVCFs")
+    parser.add_argument("--samtools", default="samtools", help="samtools binary used to write CRAMs")
+    parser.add_argument("--skip-crams", action="store_true", help="do not write CRAMs (no samtools needed)")
+    args = parser.parse_args()
+    generate(**vars(args))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+"""
+Runs the heavy Python paths of the crunch scripts on fixed synthetic
+fixtures (see fixtures.py) against FakeArvados, with the bioinformatics
+tools replaced by stubs (see stub_tools.py), and compares the timings
+and peak memory with a stored baseline.
+
+Cases:
+  dict_chunking      gatk-create-interval-lists.py: resolve the reference,
+                     parse its .dict and write 200 weighted chunks
+  interval_splitting gatk-split-interval-list.py: pad, merge and split
+                     200k targets into 200 chunks
+  gvcf_grouping      one_task_per_group_and_per_n_gvcfs as
+                     gatk-combinegvcfs.py calls it, on 2000 samples
+  reuse_lookup       get_reusable_tasks over 2000 samples' previous tasks
+  bgzf_validation    validate_compressed_indexed_vcf_collection on the
+                     fixture gVCFs
+  concat             bcftools-concatvcfs.py on one sample's chunk gVCFs
+  mpileup_chunked    the region loop of bcftools-exp-gvcf-mpileup-cram-chunked.py
+                     over 300 regions
+
+Each run of a case is a separate process, so peak memory (the maximum
+resident set size of that process, which includes the fake servers and
+the fixtures they hold) is per case. The fastest time and largest peak
+over --repeat runs are reported.
+
+Examples:
+  run_benchmarks.py --update-baseline        record benchmarks/baseline.json
+  run_benchmarks.py --out results.json       compare with it; exits 1 on a regression
+"""
+
+import os
+import re
+import sys
+import imp
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+from distutils.spawn import find_executable
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+CRUNCH_SCRIPTS_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), "crunch_scripts")
+sys.path.insert(0, CRUNCH_SCRIPTS_DIR)
+
+import fixtures
+import stub_tools
+from fake_arvados import FakeArvados
+
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_DIR, "baseline.json")
+
+FIXTURE_PARAMS = {
+    'seed': "1",
+    'contigs': 3,
+    'contig_length': 1000000,
+    'decoys': 2000,
+    'decoy_length': 2000,
+    'chunks': 20,
+    'targets': 200000,
+    'samples': 4,
+    'reads': 20000,
+    'read_length': 100,
+}
+
+GENOME_CHUNKS = 200
+COHORT_SAMPLES = 2000
+COHORT_CHUNKS = 20
+MPILEUP_REGION_LENGTH = 10000
+
+# regressions smaller than these are taken to be noise
+MIN_SECONDS_CHANGE = 0.05
+MIN_PEAK_RSS_KB_CHANGE = 1024
+
+def load_script(script_name):
+    """
+    Imports a crunch script (whose file name is not a module name).
+    """
+    module_name = re.sub(r'[^A-Za-z0-9_]', '_', os.path.splitext(script_name)[0])
+    return imp.load_source(module_name, os.path.join(CRUNCH_SCRIPTS_DIR, script_name))
+
+class Context(object):
+    """
+    Everything a case needs: FakeArvados, a crunch-like environment
+    (TASK_WORK, JOB_WORK, TASK_KEEPMOUNT and the stub tools on PATH) in
+    work_dir, and the fixtures.
+    """
+    def __init__(self, fixtures_dir, work_dir, api_latency=0.0, keep_latency=0.0):
+        self.fixtures_dir = fixtures_dir
+        self.work_dir = work_dir
+        self.keep_mount = os.path.join(work_dir, "keep")
+        self.fake = FakeArvados(api_latency=api_latency, keep_latency=keep_latency).start()
+        for env, name in (('TASK_WORK', "task"), ('JOB_WORK', "job"), ('CRUNCH_TMP', "crunch"),
+                          ('TASK_KEEPMOUNT', "keep"), ('HGI_ARVADOS_REFERENCE_CACHE', "reference_cache")):
+            os.environ[env] = os.path.join(work_dir, name)
+            if not os.path.isdir(os.environ[env]):
+                os.makedirs(os.environ[env])
+        os.environ['PATH'] = stub_tools.install(os.path.join(work_dir, "bin")) + os.pathsep + os.environ['PATH']
+        # a current job and task for cases that do not start their own
+        self.start_job("benchmark", {})
+
+    def start_job(self, script, script_parameters, task_sequence=0, task_parameters=None):
+        """
+        Creates a job and a task in it and makes them current, as crunch would.
+        """
+        import arvados
+        job = self.fake.create_job(script, script_parameters)
+        task = self.fake.create_task(job['uuid'], task_sequence, task_parameters or {})
+        self.fake.configure_environment(job_uuid=job['uuid'], task_uuid=task['uuid'])
+        # forget the job and task the SDK has cached
+        arvados._current_job = None
+        arvados._current_task = None
+        return (job, task)
+
+    def fixture_files(self, subdir, regex=None):
+        """
+        Returns (name, path) for each file in a fixtures subdirectory
+        (whose names match regex, if given).
+        """
+        subdir_path = os.path.join(self.fixtures_dir, subdir)
+        return [(name, os.path.join(subdir_path, name)) for name in sorted(os.listdir(subdir_path))
+                if regex is None or re.search(regex, name)]
+
+    def collection(self, files, mount=False):
+        """
+        Creates a collection of the (name, path) files and returns its
+        portable data hash. If mount is set, the files are also made
+        available under TASK_KEEPMOUNT, as arv-mount would.
+        """
+        pdh = self.fake.create_collection_from_files(files)['portable_data_hash']
+        if mount:
+            for name, path in files:
+                mounted = os.path.join(self.keep_mount, pdh, name)
+                if not os.path.isdir(os.path.dirname(mounted)):
+                    os.makedirs(os.path.dirname(mounted))
+                if not os.path.exists(mounted):
+                    os.symlink(os.path.abspath(path), mounted)
+        return pdh
+
+    def write_file(self, name, data):
+        path = os.path.join(self.work_dir, "files", name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write(data)
+        return (name, path)
+
+def case_dict_chunking(ctx):
+    script = load_script("gatk-create-interval-lists.py")
+    ref_pdh = ctx.collection(ctx.fixture_files("ref"))
+    ctx.start_job("gatk-create-interval-lists.py", {'reference_collection': ref_pdh,
+                                                    'genome_chunks': GENOME_CHUNKS})
+    return script.main
+
+def case_interval_splitting(ctx):
+    script = load_script("gatk-split-interval-list.py")
+    targets_pdh = ctx.collection(ctx.fixture_files("targets"))
+    ctx.start_job("gatk-split-interval-list.py", {'interval_list_collection': targets_pdh,
+                                                  'genome_chunks': GENOME_CHUNKS,
+                                                  'padding': 100,
+                                                  'merge_intervals': 'true'})
+    return script.main
+
+def case_gvcf_grouping(ctx):
+    import hgi_arvados
+    from bench_task_fanout import Cohort
+    script = load_script("gatk-combinegvcfs.py")
+    cohort = Cohort(ctx.fake, COHORT_SAMPLES, COHORT_CHUNKS)
+    ctx.start_job("gatk-combinegvcfs.py", {'reference_collection': cohort.ref,
+                                           'inputs_collection': cohort.gvcfs,
+                                           'interval_lists_collection': cohort.interval_lists})
+    return lambda: hgi_arvados.one_task_per_group_and_per_n_gvcfs(cohort.ref, cohort.gvcfs, cohort.interval_lists,
+                                                                  script.group_by_regex, script.max_gvcfs_to_combine,
+                                                                  if_sequence=0, and_end_task=False)
+
+def case_reuse_lookup(ctx):
+    import hgi_arvados
+    from bench_task_fanout import Cohort, SCRIPT, REUSE_KEY_PARAMS
+    cohort = Cohort(ctx.fake, 1, 1)
+    previous_job, previous_task = ctx.start_job(SCRIPT, {})
+    for sample_i in range(0, COHORT_SAMPLES):
+        for chunk_i in range(0, COHORT_CHUNKS):
+            ctx.fake.create_task(previous_job['uuid'], 1,
+                                 {'input': "%032x+%s" % (sample_i, 1000 + sample_i),
+                                  'ref': cohort.ref,
+                                  'chunk': "%032x+%s" % (chunk_i, 100 + chunk_i)},
+                                 success=True, output=cohort.outputs, progress=1.0)
+    job, task = ctx.start_job(SCRIPT, {})
+    job_filters = [
+        ['script', '=', SCRIPT],
+        ['repository', '=', job['repository']],
+        ['script_version', 'in git', job['script_version']],
+        ['docker_image_locator', 'in docker', job['docker_image_locator']],
+    ]
+    return lambda: hgi_arvados.get_reusable_tasks(1, REUSE_KEY_PARAMS, job_filters)
+
+def case_bgzf_validation(ctx):
+    from hgi_arvados import validators
+    gvcfs_pdh = ctx.collection(ctx.fixture_files("gvcfs"))
+    def validate():
+        if not validators.validate_compressed_indexed_vcf_collection(gvcfs_pdh):
+            raise Exception("fixture gVCFs did not validate")
+    return validate
+
+def case_concat(ctx):
+    script = load_script("bcftools-concatvcfs.py")
+    inputs_pdh = ctx.collection(ctx.fixture_files("gvcfs", r'^sample000001\.'), mount=True)
+    ctx.start_job("bcftools-concatvcfs.py", {'output_prefix': "sample000001"},
+                  task_sequence=1, task_parameters={'inputs': inputs_pdh})
+    return script.main
+
+def case_mpileup_chunked(ctx):
+    script = load_script("bcftools-exp-gvcf-mpileup-cram-chunked.py")
+    ref_pdh = ctx.collection(ctx.fixture_files("ref"), mount=True)
+    regions = []
+    for contig_i in range(0, FIXTURE_PARAMS['contigs']):
+        for start in range(1, FIXTURE_PARAMS['contig_length'] + 1, MPILEUP_REGION_LENGTH):
+            regions.append("chr%s\t%s\t%s\n" % (contig_i + 1, start, start + MPILEUP_REGION_LENGTH - 1))
+    chunk_pdh = ctx.collection([ctx.write_file("genome.1_of_1.region_list", ''.join(regions))], mount=True)
+    cram_files = ctx.fixture_files("crams", r'^sample000001\.')
+    if len(cram_files) == 0:
+        # the stub tools never read the CRAM
+        cram_files = [ctx.write_file("sample000001.cram", "CRAM"), ctx.write_file("sample000001.cram.crai", "")]
+    input_pdh = ctx.collection(cram_files, mount=True)
+    ctx.start_job("bcftools-exp-gvcf-mpileup-cram-chunked.py", {'skip_sq_sn_regex': '_decoy$', 'genome_chunks': 1},
+                  task_sequence=1, task_parameters={'ref': ref_pdh, 'chunk': chunk_pdh, 'input': input_pdh})
+    return script.main
+
+CASES = [
+    ('dict_chunking', case_dict_chunking),
+    ('interval_splitting', case_interval_splitting),
+    ('gvcf_grouping', case_gvcf_grouping),
+    ('reuse_lookup', case_reuse_lookup),
+    ('bgzf_validation', case_bgzf_validation),
+    ('concat', case_concat),
+    ('mpileup_chunked', case_mpileup_chunked),
+]
+
+def run_case(case_name, fixtures_dir, result_file, api_latency, keep_latency):
+    """
+    Sets up and times one case in this process and writes its result
+    to result_file.
+    """
+    work_dir = tempfile.mkdtemp(prefix="hgi_arvados_benchmark.")
+    try:
+        ctx = Context(fixtures_dir, work_dir, api_latency=api_latency, keep_latency=keep_latency)
+        run = dict(CASES)[case_name](ctx)
+        ctx.fake.store.reset_counts()
+        start = time.time()
+        run()
+        seconds = time.time() - start
+        result = {
+            'seconds': seconds,
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'requests': dict(ctx.fake.store.request_counts),
+        }
+        ctx.fake.stop()
+    finally:
+        os.chdir(BENCHMARKS_DIR)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    with open(result_file, "w") as f:
+        json.dump(result, f)
+
+def prepare_fixtures(fixtures_dir):
+    """
+    Generates the fixtures in fixtures_dir unless they are already there.
+    """
+    complete_marker = os.path.join(fixtures_dir, ".complete")
+    if os.path.exists(complete_marker):
+        return
+    params = dict(FIXTURE_PARAMS)
+    params['skip_crams'] = find_executable("samtools") is None
+    if params['skip_crams']:
+        print "samtools not found, generating fixtures without CRAMs"
+    fixtures.generate(fixtures_dir, **params)
+    open(complete_marker, "w").close()
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=BENCHMARKS_DIR,
+                                       stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline, time_tolerance, memory_tolerance):
+    """
+    Prints each case's results next to the baseline and returns the
+    names of the cases that regressed.
+    """
+    regressions = []
+    print "%-20s %10s %10s %8s %12s %12s %8s" % ("case", "seconds", "baseline", "change", "peak MB", "baseline", "change")
+    for case_name, _ in CASES:
+        result = results['cases'].get(case_name)
+        if result is None:
+            continue
+        if 'error' in result:
+            print "%-20s FAILED: %s" % (case_name, result['error'])
+            continue
+        base = baseline['cases'].get(case_name) if baseline else None
+        if base is None or 'error' in base:
+            print "%-20s %10.3f %10s %8s %12.1f" % (case_name, result['seconds'], "-", "-", result['peak_rss_kb'] / 1024.0)
+            continue
+        time_change = (result['seconds'] - base['seconds']) / max(base['seconds'], 1e-9)
+        memory_change = (result['peak_rss_kb'] - base['peak_rss_kb']) / float(max(base['peak_rss_kb'], 1))
+        flags = []
+        if time_change > time_tolerance and result['seconds'] - base['seconds'] > MIN_SECONDS_CHANGE:
+            flags.append("time")
+        if memory_change > memory_tolerance and result['peak_rss_kb'] - base['peak_rss_kb'] > MIN_PEAK_RSS_KB_CHANGE:
+            flags.append("memory")
+        print "%-20s %10.3f %10.3f %+7.0f%% %12.1f %12.1f %+7.0f%% %s" % (case_name, result['seconds'], base['seconds'], 100 * time_change,
+                                                                     result['peak_rss_kb'] / 1024.0, base['peak_rss_kb'] / 1024.0,
+                                                                     100 * memory_change,
+                                                                     "REGRESSION (%s)" % (', '.join(flags)) if flags else "")
+        if flags:
+            regressions.append(case_name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the crunch scripts against a stored baseline")
+    parser.add_argument("--cases", help="comma-separated cases to run (default: all)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each case")
+    parser.add_argument("--fixtures", help="directory holding (or to generate) the fixtures")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="seconds added to every API request")
+    parser.add_argument("--keep-latency", type=float, default=0.0, help="seconds added to every Keep request")
+    parser.add_argument("--out", help="write the results to this file")
+    parser.add_argument("--log", help="write the output of the cases to this file")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline to compare with")
+    parser.add_argument("--update-baseline", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--time-tolerance", type=float, default=0.25, help="allowed fractional increase in time")
+    parser.add_argument("--memory-tolerance", type=float, default=0.25, help="allowed fractional increase in peak memory")
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    fixtures_dir = args.fixtures
+    if fixtures_dir is None:
+        params_hash = hashlib.md5(json.dumps(FIXTURE_PARAMS, sort_keys=True)).hexdigest()[:8]
+        fixtures_dir = os.path.join(tempfile.gettempdir(), "hgi_arvados_benchmark_fixtures.%s" % (params_hash))
+
+    if args.run_case:
+        run_case(args.run_case, fixtures_dir, args.result, args.api_latency, args.keep_latency)
+        return
+
+    case_names = [name for name, _ in CASES]
+    if args.cases:
+        case_names = args.cases.split(",")
+        unknown = [name for name in case_names if name not in dict(CASES)]
+        if unknown:
+            parser.error("unknown cases: %s" % (', '.join(unknown)))
+
+    prepare_fixtures(fixtures_dir)
+    log_file = args.log or os.path.join(tempfile.gettempdir(), "hgi_arvados_benchmark.log")
+    log = open(log_file, "w")
+    results = {
+        'commit': git_commit(),
+        'created_at': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'api_latency': args.api_latency,
+        'keep_latency': args.keep_latency,
+        'cases': {},
+    }
+    for case_name in case_names:
+        runs = []
+        for repeat_i in range(0, args.repeat):
+            fd, result_file = tempfile.mkstemp(suffix=".json")
+            os.close(fd)
+            log.write("==> %s run %s\n" % (case_name, repeat_i + 1))
+            log.flush()
+            exit_code = subprocess.call([sys.executable, os.path.abspath(__file__), "--run-case", case_name,
+                                         "--fixtures", fixtures_dir, "--result", result_file,
+                                         "--api-latency", str(args.api_latency), "--keep-latency", str(args.keep_latency)],
+                                        stdout=log, stderr=subprocess.STDOUT)
+            if exit_code == 0:
+                with open(result_file) as f:
+                    runs.append(json.load(f))
+            os.remove(result_file)
+            if exit_code != 0:
+                results['cases'][case_name] = {'error': "exited with exit code %s (see %s)" % (exit_code, log_file)}
+                break
+        else:
+            results['cases'][case_name] = {
+                'seconds': min([run['seconds'] for run in runs]),
+                'peak_rss_kb': max([run['peak_rss_kb'] for run in runs]),
+                'requests': runs[0]['requests'],
+                'runs': runs,
+            }
+    log.close()
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print "Comparing with baseline from commit %s (%s)" % (baseline.get('commit'), baseline.get('created_at'))
+    else:
+        print "No baseline at %s" % (args.baseline)
+    regressions = compare(results, baseline, args.time_tolerance, args.memory_tolerance)
+    failures = [name for name, result in results['cases'].items() if 'error' in result]
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if args.update_baseline:
+        if failures:
+            print "Not updating the baseline as some cases failed"
+        else:
+            with open(args.baseline, "w") as f:
+                json.dump(results, f, indent=1, sort_keys=True)
+            print "Baseline written to %s" % (args.baseline)
+    print "Output of the cases is in %s" % (log_file)
+    if failures or (regressions and not args.update_baseline):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
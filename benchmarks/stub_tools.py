@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""
+Stand-ins for the bioinformatics tools the crunch scripts run, so that
+the scripts' own orchestration can be benchmarked without the real
+tools or real data. They read and write plain VCF text and BGZF but do
+no real work:
+  bcftools-gvcf mpileup ... -r REGION CRAM (or -R REGIONS_FILE CRAM)
+                          a header and one record per 1000 bases of each region
+  bcftools norm           copies its input, -o writes to a file, -Oz
+                          writes BGZF
+  bcftools view           -h / -H select header / records, -o writes
+                          to a file, -Oz writes BGZF
+  bcftools concat         header of the first input then records of all
+  bcftools reheader       replaces the header of a VCF
+  bcftools index          writes a small .csi (or .tbi with -t)
+  bgzip -c                BGZF compresses a file to stdout
+  teepot FILE -           copies stdin to FILE and to stdout
+
+install(bin_dir) writes executables for these into bin_dir.
+"""
+
+import os
+import sys
+import gzip
+import stat
+from StringIO import StringIO
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from fixtures import BgzfWriter, bgzf_block, BGZF_EOF
+
+TOOLS = ["bcftools", "bcftools-gvcf", "bgzip", "teepot"]
+RECORD_SPACING = 1000
+
+def install(bin_dir):
+    """
+    Writes an executable for each stub tool into bin_dir, which should
+    then be put at the front of PATH.
+    """
+    if not os.path.isdir(bin_dir):
+        os.makedirs(bin_dir)
+    for tool in TOOLS:
+        path = os.path.join(bin_dir, tool)
+        with open(path, "w") as f:
+            f.write("#!/bin/sh\nexec \"%s\" \"%s\" %s \"$@\"\n" % (sys.executable, os.path.abspath(__file__), tool))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return bin_dir
+
+def _read_vcf(path):
+    # read in one go, as path may be a fifo
+    if path == "-":
+        data = sys.stdin.read()
+    else:
+        with open(path, "rb") as f:
+            data = f.read()
+    if data[:2] == "\x1f\x8b":
+        return gzip.GzipFile(fileobj=StringIO(data)).read()
+    return data
+
+def _split_vcf(text):
+    header = []
+    records = []
+    for line in text.splitlines(True):
+        if line.startswith("#"):
+            header.append(line)
+        else:
+            records.append(line)
+    return (''.join(header), ''.join(records))
+
+def _write_vcf(text, out_path, output_type):
+    if output_type == "z":
+        if out_path is None:
+            writer = BgzfWriter(os.fdopen(os.dup(sys.stdout.fileno()), "wb"))
+        else:
+            writer = BgzfWriter(open(out_path, "wb"))
+        writer.write(text)
+        writer.close()
+    elif out_path is None:
+        sys.stdout.write(text)
+    else:
+        with open(out_path, "wb") as f:
+            f.write(text)
+
+def _options(args, flags, valued):
+    """
+    Splits args into (options, positional), where options maps each
+    flag in flags to True and each option in valued to its value.
+    """
+    options = {}
+    positional = []
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg in flags:
+            options[arg] = True
+        elif arg in valued:
+            options[arg] = args[i + 1]
+            i += 1
+        elif arg.startswith("-O") and len(arg) == 3:
+            options["-O"] = arg[2]
+        elif arg.startswith("-") and arg != "-":
+            # an option we don't care about; assume it takes no value
+            # unless it is one of the mpileup options with values
+            if arg in ("-t", "-d", "--gvcf", "-r", "-f", "-C", "-F", "-m"):
+                i += 1
+        else:
+            positional.append(arg)
+        i += 1
+    return (options, positional)
+
+def header_for(sample):
+    return ("##fileformat=VCFv4.2\n"
+            "##FORMAT=<ID=GT,Number=1,Type=String,Description=\"Genotype\">\n"
+            "##bcftools_stubVersion=0\n"
+            "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t%s\n" % (sample))
+
+def mpileup(args):
+    options, positional = _options(args, [], ["-r", "-R", "-f", "-t", "-d", "--gvcf"])
+    if "-R" in options:
+        # a regions file of contig, start and end columns
+        with open(options["-R"]) as f:
+            regions = [line.rstrip("\n").split("\t")[:3] for line in f if line.strip()]
+    else:
+        contig, span = options["-r"].rsplit(":", 1)
+        regions = [[contig] + span.split("-")]
+    sample = os.path.basename(positional[-1]).split(".")[0]
+    records = []
+    for contig, start, end in regions:
+        start, end = int(start), int(end)
+        records.extend(["%s\t%s\t.\tN\t<*>\t0\t.\tEND=%s\tGT\t0/0\n" % (contig, pos, min(end, pos + RECORD_SPACING - 1))
+                        for pos in range(start, end + 1, RECORD_SPACING)])
+    sys.stdout.write(header_for(sample) + ''.join(records))
+
+def bcftools(args):
+    command = args[0]
+    args = args[1:]
+    if command == "norm":
+        options, positional = _options(args, [], ["-o", "-f"])
+        _write_vcf(_read_vcf(positional[0] if positional else "-"), options.get("-o"), options.get("-O", "v"))
+    elif command == "view":
+        options, positional = _options(args, ["-h", "-H"], ["-o"])
+        header, records = _split_vcf(_read_vcf(positional[0] if positional else "-"))
+        if "-h" in options:
+            text = header
+        elif "-H" in options:
+            text = records
+        else:
+            text = header + records
+        _write_vcf(text, options.get("-o"), options.get("-O", "v"))
+    elif command == "concat":
+        options, positional = _options(args, [], ["-o", "-f"])
+        if "-f" in options:
+            with open(options["-f"]) as f:
+                positional = [line.strip() for line in f if line.strip()]
+        parts = [_split_vcf(_read_vcf(path)) for path in positional]
+        text = (parts[0][0] if parts else "") + ''.join([records for header, records in parts])
+        _write_vcf(text, options.get("-o"), options.get("-O", "v"))
+    elif command == "reheader":
+        options, positional = _options(args, [], ["-h", "-o"])
+        header = _read_vcf(options["-h"])
+        old_header, records = _split_vcf(_read_vcf(positional[0]))
+        _write_vcf(header + records, options.get("-o"), "z")
+    elif command == "index":
+        options, positional = _options(args, ["-t", "-c"], [])
+        index_ext = ".tbi" if "-t" in options else ".csi"
+        magic = "TBI\1" if "-t" in options else "CSI\1"
+        with open(positional[0] + index_ext, "wb") as f:
+            f.write(bgzf_block(magic + "\0" * 60) + BGZF_EOF)
+    else:
+        sys.stderr.write("stub bcftools does not implement %s\n" % (command))
+        sys.exit(1)
+
+def bgzip(args):
+    options, positional = _options(args, ["-c"], [])
+    _write_vcf(_read_vcf(positional[0]), None, "z")
+
+def teepot(args):
+    with open(args[0], "wb") as f:
+        while True:
+            data = sys.stdin.read(65536)
+            if not data:
+                break
+            f.write(data)
+            sys.stdout.write(data)
+
+def main():
+    tool = sys.argv[1]
+    args = sys.argv[2:]
+    if tool == "bcftools-gvcf" and args[0] == "mpileup":
+        mpileup(args[1:])
+    elif tool in ("bcftools", "bcftools-gvcf"):
+        bcftools(args)
+    elif tool == "bgzip":
+        bgzip(args)
+    elif tool == "teepot":
+        teepot(args)
+    else:
+        sys.stderr.write("no stub for %s\n" % (tool))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
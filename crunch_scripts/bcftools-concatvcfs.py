@@ -10,6 +10,8 @@ from hgi_arvados import bcftools
 from hgi_arvados import gatk_helper
 from hgi_arvados import errors
 from hgi_arvados import validators
+from hgi_arvados import timing
+from hgi_arvados import vcf_stats
 
 # TODO: make sort_by_regex a parameter
 sort_by_regex = '(?P<sort_by>[0-9]+)_of_[0-9]+[^0-9]'
@@ -27,14 +29,21 @@ def main():
     ################################################################################
     # Concatentate VCFs in numerically sorted order of sort_by_regex
     ################################################################################
-    vcf_files = gatk_helper.mount_gatk_gvcf_inputs(inputs_param="inputs")
+    with timing.span("mount inputs") as span:
+        vcf_files = gatk_helper.mount_gatk_gvcf_inputs(inputs_param="inputs")
+        span.add_bytes(sum([timing.file_size(vcf_file) for vcf_file in vcf_files]))
     out_dir = hgi_arvados.prepare_out_dir()
     output_prefix = arvados.current_job()['script_parameters']['output_prefix']
     out_file = output_prefix + ".vcf.gz"
+    vcf_files = sorted(vcf_files, key=lambda fn: int(re.search(sort_by_r, fn).group('sort_by')))
+
+    # check that the inputs are complete and in order from their stats sidecars
+    if not vcf_stats.check_input_stats(vcf_files, ordered=True):
+        raise errors.InvalidArgumentError("Input VCFs failed the checks of their stats sidecars")
 
     # Concatenate VCFs
-    bcftools_concat_exit = bcftools.concat(sorted(vcf_files, key=lambda fn: int(re.search(sort_by_r, fn).group('sort_by'))),
-                                    os.path.join(out_dir, out_file))
+    with timing.span("run tool"):
+        bcftools_concat_exit = bcftools.concat(vcf_files, os.path.join(out_dir, out_file))
 
     if bcftools_concat_exit != 0:
         print "WARNING: bcftools concat exited with exit code %s (NOT WRITING OUTPUT)" % bcftools_concat_exit
@@ -44,13 +53,19 @@ def main():
     else:
         print "bcftools concat exited successfully, indexing"
 
-        bcftools_index_exit = bcftools.index(os.path.join(out_dir, out_file))
+        with timing.span("index"):
+            bcftools_index_exit = bcftools.index(os.path.join(out_dir, out_file))
 
         if bcftools_index_exit != 0:
             print "WARNING: bcftools index exited with exit code %s (NOT WRITING OUTPUT)" % bcftools_index_exit
             arvados.api().job_tasks().update(uuid=this_task['uuid'],
                                              body={'success':False}
                                          ).execute()
+        elif not vcf_stats.write_dir_stats(out_dir):
+            print "ERROR: bcftools output failed validation (NOT WRITING OUTPUT)"
+            arvados.api().job_tasks().update(uuid=this_task['uuid'],
+                                             body={'success':False}
+                                         ).execute()
         else:
             print "bcftools index exited successfully, writing output to keep"
 
@@ -59,12 +74,18 @@ def main():
             out = arvados.CollectionWriter()
 
             # Write out_dir to keep
-            out.write_directory_tree(out_dir)
+            with timing.span("write_directory_tree") as span:
+                out.write_directory_tree(out_dir)
+                span.add_bytes(timing.directory_size(out_dir))
+            timing.write_summary(out)
 
             # Commit the output to Keep.
-            output_locator = out.finish()
+            with timing.span("finish"):
+                output_locator = out.finish()
 
-            if validate_task_output(output_locator):
+            with timing.span("validate"):
+                output_valid = validate_task_output(output_locator)
+            if output_valid:
                 print "Task output validated, setting output to %s" % (output_locator)
 
                 # Use the resulting locator as the output for this task.
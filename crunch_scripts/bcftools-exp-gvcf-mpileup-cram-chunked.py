@@ -3,8 +3,16 @@
 import os           # Import the os module for basic path manipulation
 import arvados      # Import the Arvados sdk module
 import re
+import shutil
 import subprocess
 import jinja2
+
+import hgi_arvados
+from hgi_arvados import checkpoints
+from hgi_arvados import reference
+from hgi_arvados import prefetch
+from hgi_arvados import sequence_dictionary
+from hgi_arvados import timing
 from select import select
 from signal import signal, SIGINT, SIGTERM, SIGKILL
 from time import sleep
@@ -13,6 +21,18 @@ from multiprocessing import Pool, cpu_count
 # the amount to weight each sequence contig
 weight_seq = 120000
 
+# options passed to bcftools mpileup for every region
+mpileup_options = ["-t", "AD,INFO/AD",
+                   "-C50",
+                   "-pm2",
+                   "-F0.1",
+                   "-d10000",
+                   "--gvcf", "1,2,3,4,5,10,15"]
+
+# number of passes to split a chunk's single mpileup pass into when
+# checkpointing, so that each pass can be checkpointed as it finishes
+checkpoint_passes = 8
+
 # list of process ids of all children
 child_pids = []
 
@@ -22,9 +42,6 @@ watch_fds = []
 # dict mapping from fd to the text to tag the output with
 watch_fd_tags = dict()
 
-# fifos to delete after processing is done
-fifos_to_delete = []
-
 class InvalidArgumentError(Exception):
     pass
 
@@ -42,19 +59,23 @@ def create_chunk_tasks(f_name, chunk_input_pdh_names,
                        if_sequence, task_input_pdh, ref_input_pdh, chunk_input_pdh, 
                        pool=None):
     async_results = []
+    job_uuid = arvados.current_job()['uuid']
+    current_task_uuid = arvados.current_task()['uuid']
     for chunk_input_pdh, chunk_input_name in chunk_input_pdh_names:
         # Create task for each CRAM / chunk
-        job_uuid = arvados.current_job()['uuid']
-        current_task_uuid = arvados.current_task()['uuid']
+        new_task_params = {
+            'input': task_input_pdh,
+            'ref': ref_input_pdh,
+            'chunk': chunk_input_pdh
+            }
+        if hgi_arvados.task_already_created(if_sequence + 1, new_task_params):
+            print "Task to process %s with chunk interval %s was already created" % (f_name, chunk_input_name)
+            continue
         new_task_attrs = {
             'job_uuid': job_uuid,
             'created_by_job_task_uuid': current_task_uuid,
             'sequence': if_sequence + 1,
-            'parameters': {
-                'input': task_input_pdh,
-                'ref': ref_input_pdh,
-                'chunk': chunk_input_pdh
-                }
+            'parameters': new_task_params
             }
         async_result = pool.apply_async(arv_create_task, (
                 new_task_attrs,
@@ -96,129 +117,31 @@ def one_task_per_cram_file(if_sequence=0, and_end_task=True,
     skip_sq_sn_r = re.compile(skip_sq_sn_regex)
 
     # Ensure we have a .fa reference file with corresponding .fai index and .dict
-    reference_coll = arvados.current_job()['script_parameters']['reference_collection']
-    rcr = arvados.CollectionReader(reference_coll)
-    ref_fasta = {}
-    ref_fai = {}
-    ref_dict = {}
-    ref_input = None
-    dict_reader = None
-    for rs in rcr.all_streams():
-        for rf in rs.all_files():
-            if re.search(r'\.fa$', rf.name()):
-                ref_fasta[rs.name(), rf.name()] = rf
-            elif re.search(r'\.fai$', rf.name()):
-                ref_fai[rs.name(), rf.name()] = rf
-            elif re.search(r'\.dict$', rf.name()):
-                ref_dict[rs.name(), rf.name()] = rf
-    for ((s_name, f_name), fasta_f) in ref_fasta.items():
-        fai_f = ref_fai.get((s_name, re.sub(r'fa$', 'fai', f_name)), 
-                            ref_fai.get((s_name, re.sub(r'fa$', 'fa.fai', f_name)), 
-                                        None))
-        dict_f = ref_dict.get((s_name, re.sub(r'fa$', 'dict', f_name)), 
-                              ref_dict.get((s_name, re.sub(r'fa$', 'fa.dict', f_name)), 
-                                           None))
-        if fasta_f and fai_f and dict_f:
-            # found a set of all three! 
-            ref_input = fasta_f.as_manifest()
-            ref_input += fai_f.as_manifest()
-            ref_input += dict_f.as_manifest()
-            dict_reader = dict_f
-            break
-    if ref_input is None:
-        raise InvalidArgumentError("Expected a reference fasta with fai and dict in reference_collection. Found [%s]" % ' '.join(rf.name() for rf in rs.all_files()))
-    if dict_reader is None:
-        raise InvalidArgumentError("Could not find .dict file in reference_collection. Found [%s]" % ' '.join(rf.name() for rf in rs.all_files()))
-
-    # Create a portable data hash for the ref_input manifest
-    try:
-        r = arvados.api().collections().create(body={"manifest_text": ref_input}).execute()
-        ref_input_pdh = r["portable_data_hash"]
-    except:
-        raise 
+    ref = reference.resolve_reference(arvados.current_job()['script_parameters']['reference_collection'])
+    ref_input_pdh = ref['ref_pdh']
+    dict_name = os.path.basename(ref['dict'])
 
     # Load the dict data
-    interval_header = ""
-    dict_lines = dict_reader.readlines()
-    dict_header = dict_lines.pop(0)
-    if re.search(r'^@HD', dict_header) is None:
-        raise InvalidArgumentError("Dict file in reference collection does not have correct header: [%s]" % dict_header)
-    interval_header += dict_header
-    print "Dict header is %s" % dict_header
-    sn_intervals = dict()
-    sns = []
-    skip_sns = []
-    total_len = 0
-    for sq in dict_lines:
-        if re.search(r'^@SQ', sq) is None:
-            raise InvalidArgumentError("Dict file contains malformed SQ line: [%s]" % sq)
-        interval_header += sq
-        sn = None
-        ln = None
-        for tagval in sq.split("\t"):
-            tv = tagval.split(":", 1)
-            if tv[0] == "SN":
-                sn = tv[1]
-            if tv[0] == "LN":
-                ln = tv[1]
-            if sn and ln:
-                break
-        if not (sn and ln):
-            raise InvalidArgumentError("Dict file SQ entry missing required SN and/or LN parameters: [%s]" % sq)
-        assert(sn and ln)
-        if sn_intervals.has_key(sn):
-            raise InvalidArgumentError("Dict file has duplicate SQ entry for SN %s: [%s]" % (sn, sq))
-        if skip_sq_sn_r.search(sn):
-            skip_sns.append(sn)
-            continue
-        sn_intervals[sn] = (1, int(ln))
-        sns.append(sn)
-        total_len += int(ln)
-    total_sequences = len(sns)
+    print "Dict header is %s" % ref['dict_lines'][0]
+    seqdict = sequence_dictionary.SequenceDictionary.from_dict_lines(ref['dict_lines'])
+    included = seqdict.subset(skip_sq_sn_r)
 
-    print "Skipped %s SQs with SNs matching regex [%s]" % (len(skip_sns), skip_sq_sn_regex)
+    print "Skipped %s SQs with SNs matching regex [%s]" % (len(seqdict) - len(included), skip_sq_sn_regex)
 
     # Chunk the genome into genome_chunks pieces
     # weighted by both number of base pairs and number of seqs
-    print "Total sequences included: %s" % (total_sequences)
-    print "Total genome length: %s" % (total_len)
-    total_points = total_len + (total_sequences * weight_seq)
-    chunk_points = int(total_points / genome_chunks)
+    print "Total sequences included: %s" % (len(included))
+    print "Total genome length: %s" % (included.total_length())
     chunk_input_pdh_names = []
-    print "Chunking genome into %s chunks of ~%s points" % (genome_chunks, chunk_points)
-    for chunk_i in range(0, genome_chunks):
+    print "Chunking genome into %s chunks weighted by length plus %s points per sequence" % (genome_chunks, weight_seq)
+    for chunk_i, chunk_intervals in enumerate(included.weighted_chunks(genome_chunks, weight_seq)):
         chunk_num = chunk_i + 1
-        chunk_intervals_count = 0
-        chunk_input_name = dict_reader.name() + (".%s_of_%s.region_list" % (chunk_num, genome_chunks))
-        print "Creating interval file for chunk %s" % chunk_num
-        chunk_c = arvados.collection.CollectionWriter(num_retries=3)
-        chunk_c.start_new_file(newfilename=chunk_input_name)
-        # chunk_c.write(interval_header)
-        remaining_points = chunk_points
-        while len(sns) > 0:
-            sn = sns.pop(0)
-            remaining_points -= weight_seq
-            if remaining_points <= 0:
-                sns.insert(0, sn)
-                break
-            if not sn_intervals.has_key(sn):
-                raise ValueError("sn_intervals missing entry for sn [%s]" % sn)
-            start, end = sn_intervals[sn]
-            if (end-start+1) > remaining_points:
-                # not enough space for the whole sq, split it
-                real_end = end
-                end = remaining_points + start - 1
-                assert((end-start+1) <= remaining_points)
-                sn_intervals[sn] = (end+1, real_end)
-                sns.insert(0, sn)
-            #interval = "%s\t%s\t%s\t+\t%s\n" % (sn, start, end, "interval_%s_of_%s_%s" % (chunk_num, genome_chunks, sn))
-            interval = "%s\t%s\t%s\n" % (sn, start, end)
-            remaining_points -= (end-start+1)
-            chunk_c.write(interval)
-            chunk_intervals_count += 1
-            if remaining_points <= 0:
-                break
-        if chunk_intervals_count > 0:
+        chunk_input_name = dict_name + (".%s_of_%s.region_list" % (chunk_num, genome_chunks))
+        if len(chunk_intervals) > 0:
+            print "Creating interval file for chunk %s" % chunk_num
+            chunk_c = arvados.collection.CollectionWriter(num_retries=3)
+            chunk_c.start_new_file(newfilename=chunk_input_name)
+            chunk_c.write(''.join(["%s\t%s\t%s\n" % interval for interval in chunk_intervals]))
             chunk_input_pdh = chunk_c.finish()
             print "Chunk intervals file %s saved as %s" % (chunk_input_name, chunk_input_pdh)
             chunk_input_pdh_names.append((chunk_input_pdh, chunk_input_name))
@@ -356,6 +279,195 @@ def test_and_prime_input_file(test_file, error_exception):
             return False
     return True
 
+def regions_grouped_by_contig(regions):
+    """
+    Returns True if the regions of each contig are listed together and
+    in increasing order without overlaps, so that a single pass of
+    'bcftools mpileup -R' over them outputs the same records in the same
+    order as running mpileup on each region in turn.
+    """
+    seen_contigs = set()
+    last = None
+    for region in regions:
+        (contig, start, end) = prefetch.parse_region(region)
+        if last is not None and contig == last[0]:
+            if last[2] is None or start <= last[2]:
+                return False
+        elif contig in seen_contigs:
+            return False
+        seen_contigs.add(contig)
+        last = (contig, start, end)
+    return True
+
+def wait_for_children(children):
+    """
+    Prints the output of children (a list of [process, tag, close_fds,
+    close_files]) until all of them have finished, closing the fds and
+    files of each as it does.
+    """
+    while True:
+        watch_fds_and_print_output()
+        for child in children:
+            child[0] = close_process_if_finished(*child)
+        if all([child[0] is None for child in children]):
+            break
+        sleep(0.01)
+
+def reheader_without_provenance(penultimate_out_file, final_headeronly_tmp, final_out_file):
+    """
+    Writes penultimate_out_file to final_out_file with the bcftools,
+    mpileup and reference lines removed from its header.
+    """
+    print "Creating 'bcftools view -h | grep' pipe"
+    final_headeronly_tmp_f = open(final_headeronly_tmp, 'wb')
+    grep_headeronly_stdin_pipe_read, grep_headeronly_stdin_pipe_write = os.pipe()
+    grep_headeronly_cmd = ["egrep", "-v", "^[#][#](bcftools|mpileup|reference)"]
+    grep_headeronly_p = run_child_cmd(grep_headeronly_cmd,
+                                      stdin=grep_headeronly_stdin_pipe_read,
+                                      stdout=final_headeronly_tmp_f,
+                                      tag="grep (headeronly)")
+    bcftools_view_headeronly_cmd = ["bcftools", "view", "-h", penultimate_out_file]
+    bcftools_view_headeronly_p = run_child_cmd(bcftools_view_headeronly_cmd,
+                                               stdout=grep_headeronly_stdin_pipe_write,
+                                               tag="bcftools view -h")
+    wait_for_children([[bcftools_view_headeronly_p, "bcftools view -h", [grep_headeronly_stdin_pipe_write], []],
+                       [grep_headeronly_p, "grep (headeronly)", [grep_headeronly_stdin_pipe_read], [final_headeronly_tmp_f]]])
+
+    print "Reheadering penultimate output file into final out file [%s]" % (final_out_file)
+    final_bcftools_reheader_cmd = ["bcftools", "reheader", "-h", final_headeronly_tmp, "-o", final_out_file, penultimate_out_file]
+    final_bcftools_reheader_p = run_child_cmd(final_bcftools_reheader_cmd, tag="final bcftools reheader")
+    wait_for_children([[final_bcftools_reheader_p, "final bcftools reheader", [], []]])
+
+def mpileup_single_pass(ref_file, cram_file, regions, tmp_dir, output_basename, final_out_file):
+    """
+    Runs one 'bcftools mpileup -R | bcftools norm' pipeline over all of
+    the regions, jumping between them using the CRAM index, and writes
+    the result to final_out_file.
+    """
+    regions_file = os.path.join(tmp_dir, output_basename + ".regions.txt")
+    penultimate_out_file = os.path.join(tmp_dir, output_basename + ".provheader.g.vcf.gz")
+    final_headeronly_tmp = os.path.join(tmp_dir, output_basename + ".headeronly.g.vcf")
+
+    print "Writing %s regions to regions file [%s]" % (len(regions), regions_file)
+    with open(regions_file, 'w') as f:
+        for region in regions:
+            f.write("%s\t%s\t%s\n" % prefetch.parse_region(region))
+
+    bcftools_mpileup_cmd = (["bcftools-gvcf", "mpileup"] + mpileup_options +
+                            ["-f", ref_file,
+                             "-Ou",
+                             "-R", regions_file,
+                             cram_file])
+    bcftools_norm_cmd = ["bcftools", "norm",
+                         "-f", ref_file,
+                         "-Oz",
+                         "-o", penultimate_out_file]
+
+    print "Creating 'bcftools mpileup | bcftools norm' pipe for all %s regions" % (len(regions))
+    bcftools_norm_stdin_pipe_read, bcftools_norm_stdin_pipe_write = os.pipe()
+    bcftools_mpileup_p = run_child_cmd(bcftools_mpileup_cmd,
+                                       stdout=bcftools_norm_stdin_pipe_write,
+                                       tag="bcftools mpileup")
+    bcftools_norm_p = run_child_cmd(bcftools_norm_cmd,
+                                    stdin=bcftools_norm_stdin_pipe_read,
+                                    tag="bcftools norm")
+    wait_for_children([[bcftools_mpileup_p, "bcftools mpileup", [bcftools_norm_stdin_pipe_write], []],
+                       [bcftools_norm_p, "bcftools norm", [bcftools_norm_stdin_pipe_read], []]])
+
+    reheader_without_provenance(penultimate_out_file, final_headeronly_tmp, final_out_file)
+
+    print "Complete, removing temporary files"
+    os.remove(regions_file)
+    os.remove(penultimate_out_file)
+    os.remove(final_headeronly_tmp)
+
+def mpileup_in_parts(ref_file, cram_file, region_groups, tmp_dir, parts_dir, output_basename, final_out_file, checkpoint=None):
+    """
+    Runs a separate 'bcftools mpileup | bcftools norm' pipeline for each
+    group of regions in region_groups in turn, each writing an
+    uncompressed BCF part to parts_dir, then concatenates the parts into
+    final_out_file so that the records are only formatted and compressed
+    once. If checkpoint (a checkpoints.TaskCheckpoint of parts_dir) is
+    given, parts finished by an earlier run of this task are restored
+    from it rather than run again and each new part is added to it.
+    """
+    penultimate_out_file = os.path.join(tmp_dir, output_basename + ".provheader.g.vcf.gz")
+    final_headeronly_tmp = os.path.join(tmp_dir, output_basename + ".headeronly.g.vcf")
+    parts_fofn = os.path.join(tmp_dir, output_basename + ".parts_fofn")
+    total_part_count = len(region_groups)
+
+    # anything left in parts_dir is from an earlier run on this node
+    if os.path.exists(parts_dir):
+        shutil.rmtree(parts_dir)
+    os.makedirs(parts_dir)
+
+    part_files = []
+    current_part_num = 0
+    for region_group in region_groups:
+        current_part_num += 1
+        part_name = output_basename + (".part_%s_of_%s.g.bcf" % (current_part_num, total_part_count))
+        part_file = os.path.join(parts_dir, part_name)
+        part_files.append(part_file)
+        if len(region_group) == 1:
+            part_label = "%s/%s [%s]" % (current_part_num, total_part_count, region_group[0])
+        else:
+            part_label = "%s/%s [%s regions from %s]" % (current_part_num, total_part_count, len(region_group), region_group[0])
+        if checkpoint is not None and checkpoint.completed(part_name):
+            print "Part %s was finished by an earlier run of this task" % (part_label)
+            continue
+
+        regions_file = None
+        if len(region_group) == 1:
+            region_args = ["-r", region_group[0]]
+        else:
+            regions_file = os.path.join(tmp_dir, output_basename + (".part_%s_of_%s.regions.txt" % (current_part_num, total_part_count)))
+            with open(regions_file, 'w') as f:
+                for region in region_group:
+                    f.write("%s\t%s\t%s\n" % prefetch.parse_region(region))
+            region_args = ["-R", regions_file]
+        bcftools_mpileup_cmd = (["bcftools-gvcf", "mpileup"] + mpileup_options +
+                                ["-f", ref_file,
+                                 "-Ou"] +
+                                region_args +
+                                [cram_file])
+        bcftools_norm_cmd = ["bcftools", "norm",
+                             "-f", ref_file,
+                             "-Ou",
+                             "-o", part_file]
+
+        print "Creating 'bcftools mpileup | bcftools norm' pipe for part %s" % (part_label)
+        bcftools_norm_stdin_pipe_read, bcftools_norm_stdin_pipe_write = os.pipe()
+        bcftools_mpileup_p = run_child_cmd(bcftools_mpileup_cmd,
+                                           stdout=bcftools_norm_stdin_pipe_write,
+                                           tag="bcftools mpileup %s" % (part_label))
+        bcftools_norm_p = run_child_cmd(bcftools_norm_cmd,
+                                        stdin=bcftools_norm_stdin_pipe_read,
+                                        tag="bcftools norm %s" % (part_label))
+        wait_for_children([[bcftools_mpileup_p, "bcftools mpileup %s" % (part_label), [bcftools_norm_stdin_pipe_write], []],
+                           [bcftools_norm_p, "bcftools norm %s" % (part_label), [bcftools_norm_stdin_pipe_read], []]])
+        if regions_file is not None:
+            os.remove(regions_file)
+        if checkpoint is not None:
+            checkpoint.add(part_name, regions=[prefetch.parse_region(region) for region in region_group])
+
+    print "Preparing fofn for bcftools concat: %s" % (parts_fofn)
+    with open(parts_fofn, 'w') as f:
+        for part_file in part_files:
+            f.write("%s\n" % part_file)
+
+    # the only point at which records are formatted and compressed
+    bcftools_concat_cmd = ["bcftools", "concat", "-Oz", "-o", penultimate_out_file, "-f", parts_fofn]
+    bcftools_concat_p = run_child_cmd(bcftools_concat_cmd, tag="bcftools concat")
+    wait_for_children([[bcftools_concat_p, "bcftools concat", [], []]])
+
+    reheader_without_provenance(penultimate_out_file, final_headeronly_tmp, final_out_file)
+
+    print "Complete, removing temporary files"
+    os.remove(parts_fofn)
+    os.remove(penultimate_out_file)
+    os.remove(final_headeronly_tmp)
+    shutil.rmtree(parts_dir)
+
 def main():
     signal(SIGINT, sigint_handler)
     signal(SIGTERM, sigterm_handler)
@@ -368,10 +480,19 @@ def main():
     if genome_chunks < 1:
         raise InvalidArgumentError("genome_chunks must be a positive integer")
 
+    # if requested, run mpileup once over all of a chunk's regions
+    # rather than once per region (off by default, as its output has
+    # not been compared with the per-region runs' on real data)
+    single_pass_mpileup = False
+    if "single_pass_mpileup" in this_job['script_parameters']:
+        single_pass_mpileup = str(this_job['script_parameters']['single_pass_mpileup']).lower() == 'true'
+    use_checkpoints = checkpoints.checkpoints_requested()
+
     # Setup sub tasks 1-N (and terminate if this is task 0)
-    one_task_per_cram_file(if_sequence=0, and_end_task=True, 
-                           skip_sq_sn_regex=skip_sq_sn_regex, 
-                           genome_chunks=genome_chunks)
+    with timing.span("create tasks"):
+        one_task_per_cram_file(if_sequence=0, and_end_task=True, 
+                               skip_sq_sn_regex=skip_sq_sn_regex, 
+                               genome_chunks=genome_chunks)
 
     # Get object representing the current task
     this_task = arvados.current_task()
@@ -383,6 +504,8 @@ def main():
     ref_file = None
     print "Mounting reference FASTA collection"
     ref_dir = arvados.get_task_param_mount('ref')
+    # share one copy of the reference between the tasks on this node
+    ref_dir = reference.local_reference_dir(arvados.current_task()['parameters']['ref'], ref_dir)
 
     for f in arvados.util.listdir_recursive(ref_dir):
         if re.search(r'\.fa$', f):
@@ -397,6 +520,10 @@ def main():
     ref_fai_file = ref_file + ".fai"
     test_and_prime_input_file(ref_fai_file, error_exception=FileAccessError("reference fai index not readable: %s" % ref_fai_file))
 
+    # let htslib look up the CRAM's reference sequences by MD5 in a
+    # cache on this node rather than in the FASTA (or over the network)
+    reference.use_local_ref_cache(arvados.current_task()['parameters']['ref'], ref_file)
+
     # Get genome chunk intervals file
     chunk_file = None
     print "Mounting chunk collection"
@@ -456,8 +583,6 @@ def main():
     except:
         raise
     output_basename = os.path.basename(cram_file_base) + "." + os.path.basename(chunk_file)
-    out_file_tmp = os.path.join(tmp_dir, output_basename + ".g.vcf.tmp")
-    penultimate_out_file = os.path.join(tmp_dir, output_basename + ".provheader.g.vcf.gz")
     final_out_file = os.path.join(out_dir, output_basename + ".g.vcf.gz")
 
 #    bash_cmd_pipe = "samtools view -h -u -@ 1 -T %s %s | bcftools mpileup -t AD,INFO/AD -C50 -pm2 -F0.1 -d10000 --gvcf 1,2,3,4,5,10,15 -f %s -Ou - | bcftools view  -Ou | bcftools norm -f %s -Ob -o %s" % (ref_file, cram_file, ref_file, ref_file, out_file)
@@ -468,308 +593,33 @@ def main():
             (chr, start, end) = line.rstrip().split()
             region = "%s:%s-%s" % (chr, start, end)
             regions.append(region)
-    total_region_count = len(regions)
-
-    print "Preparing fifos for output from %s bcftools mpileup commands (one for each region) to bcftools concat" % total_region_count
-
-    concat_noheader_fifos = dict()
-    concat_headeronly_tmps = dict()
-    current_region_num = 0
-    for region in regions:
-        current_region_num += 1
-        concat_noheader_fifo = os.path.join(tmp_dir, output_basename + (".part_%s_of_%s.g.vcf" % (current_region_num, total_region_count)))
-        try:
-            os.mkfifo(concat_noheader_fifo, 0600)
-        except:
-            print "ERROR: could not mkfifo %s" % concat_noheader_fifo
-            raise
-        fifos_to_delete.append(concat_noheader_fifo)
-        concat_noheader_fifos[region] = concat_noheader_fifo
-        concat_headeronly_tmp = os.path.join(tmp_dir, output_basename + (".part_%s_of_%s.headeronly.g.vcf.gz" % (current_region_num, total_region_count)))
-        concat_headeronly_tmps[region] = concat_headeronly_tmp
-
-    region_concat_cmd = ["cat"]
-    region_concat_cmd.extend([concat_noheader_fifos[region] for region in regions])
-
-    # open file for output file
-    out_file_tmp_f = open(out_file_tmp, 'wb')
-    
-    region_concat_p = run_child_cmd(region_concat_cmd,
-                                    stdout=out_file_tmp_f,
-                                    tag="bcftools concat (stderr)")
-    
-    current_region_num = 0
-    current_concat_noheader_fifo_f = None
-    regions_to_process = list(regions)
-    bcftools_mpileup_p = None
-    bcftools_norm_p = None
-    part_tee_p = None
-    bcftools_view_headeronly_p = None
-    bcftools_view_noheader_p = None
-    while True:
-        # at least one of the regional aggregation processes is still running
 
-        watch_fds_and_print_output()
-    
-        if (
-                (bcftools_mpileup_p is None) and
-                (bcftools_norm_p is None) and 
-                (part_tee_p is None) and
-                (bcftools_view_headeronly_p is None) and 
-                (bcftools_view_noheader_p is None)
-        ):
-            # no per-region processes are running (they have finished or 
-            # have not yet started)
-            if len(regions_to_process) > 0:
-                # have more regions to run
-                region = regions_to_process.pop(0)
-                current_region_num += 1
-                region_label = "%s/%s [%s]" % (current_region_num, total_region_count, region)
-                concat_noheader_fifo = concat_noheader_fifos[region]
-                bcftools_view_noheader_input_fifo = os.path.join(tmp_dir, output_basename + (".part_%s_of_%s.noheader.g.bcf" % (current_region_num, total_region_count)))
-                part_tee_cmd = ["teepot", bcftools_view_noheader_input_fifo, "-"]
-                bcftools_view_noheader_cmd = ["bcftools", "view", "-H", "-Ov", bcftools_view_noheader_input_fifo]
-                concat_headeronly_tmp = concat_headeronly_tmps[region]
-                bcftools_view_headeronly_cmd = ["bcftools", "view", "-h", "-Oz", "-o", concat_headeronly_tmp]
-                bcftools_norm_cmd = ["bcftools", "norm", 
-                                     "-f", ref_file, 
-                                     "-Ou"]
-                bcftools_mpileup_cmd = ["bcftools-gvcf", "mpileup",
-                                        "-t", "AD,INFO/AD",
-                                        "-C50", 
-                                        "-pm2", 
-                                        "-F0.1",
-                                        "-d10000",
-                                        "--gvcf", "1,2,3,4,5,10,15",
-                                        "-f", ref_file,
-                                        "-Ou",
-                                        "-r", region,
-                                        cram_file]
-
-                print "Creating 'bcftools mpileup | bcftools norm' pipe for region %s" % (region_label)
-                bcftools_norm_stdin_pipe_read, bcftools_norm_stdin_pipe_write = os.pipe()
-
-                print "Creating 'bcftools norm | tee' pipe for region %s" % (region_label)
-                part_tee_stdin_pipe_read, part_tee_stdin_pipe_write = os.pipe()
-                
-                print "Creating 'tee | bcftools view -h' pipe for region %s" % (region_label)
-                bcftools_view_headeronly_stdin_pipe_read, bcftools_view_headeronly_stdin_pipe_write = os.pipe()
-                
-                print "Creating 'tee | bcftools view' named pipe [%s] for region %s" % (bcftools_view_noheader_input_fifo, region_label)
-                try:
-                    os.mkfifo(bcftools_view_noheader_input_fifo, 0600)
-                except:
-                    print "ERROR: could not mkfifo %s" % bcftools_view_noheader_input_fifo
-                    raise
-                fifos_to_delete.append(bcftools_view_noheader_input_fifo)
-
-                print "Opening concat fifo %s for writing" % concat_noheader_fifo
-                if current_concat_noheader_fifo_f is not None:
-                    #print "ERROR: current_concat_noheader_fifo_f was not closed properly"
-                    #raise Exception("current_concat_noheader_fifo_f was not closed properly")
-                    current_concat_noheader_fifo_f.close()
-                current_concat_noheader_fifo_f = open(concat_noheader_fifo, 'wb')
-
-                bcftools_mpileup_p = run_child_cmd(bcftools_mpileup_cmd,
-                                                   stdout=bcftools_norm_stdin_pipe_write,
-                                                   tag="bcftools mpileup %s" % (region_label))
-                
-                bcftools_norm_p = run_child_cmd(bcftools_norm_cmd,
-                                                stdin=bcftools_norm_stdin_pipe_read,
-                                                stdout=part_tee_stdin_pipe_write,
-                                                tag="bcftools norm %s" % (region_label))
-
-                part_tee_p = run_child_cmd(part_tee_cmd,
-                                           stdin=part_tee_stdin_pipe_read,
-                                           stdout=bcftools_view_headeronly_stdin_pipe_write,
-                                           tag="tee %s" % (region_label))
-                
-                bcftools_view_headeronly_p = run_child_cmd(bcftools_view_headeronly_cmd,
-                                                           stdin=bcftools_view_headeronly_stdin_pipe_read,
-                                                           tag="bcftools view -h %s" % (region_label))
-
-                bcftools_view_noheader_p = run_child_cmd(bcftools_view_noheader_cmd,
-                                                         stdout=current_concat_noheader_fifo_f,
-                                                         tag="bcftools view %s" % (region_label))
-
-        bcftools_mpileup_p = close_process_if_finished(bcftools_mpileup_p,
-                                                       "bcftools mpileup %s" % (region_label),
-                                                       close_fds=[bcftools_norm_stdin_pipe_write])
-
-        bcftools_norm_p = close_process_if_finished(bcftools_norm_p,
-                                                    "bcftools norm %s" % (region_label),
-                                                    close_fds=[bcftools_norm_stdin_pipe_read, 
-                                                               part_tee_stdin_pipe_write])
-        
-        part_tee_p = close_process_if_finished(part_tee_p,
-                                               "tee %s" % (region_label),
-                                               close_fds=[part_tee_stdin_pipe_read,
-                                                          bcftools_view_headeronly_stdin_pipe_write],
-                                               ignore_error=True)
-
-        bcftools_view_headeronly_p = close_process_if_finished(bcftools_view_headeronly_p,
-                                                               "bcftools view -h %s" % (region_label),
-                                                               close_fds=[bcftools_view_headeronly_stdin_pipe_read])
-
-        bcftools_view_noheader_p = close_process_if_finished(bcftools_view_noheader_p,
-                                                             "bcftools view %s" % (region_label),
-                                                             close_files=[current_concat_noheader_fifo_f])
-
-        region_concat_p = close_process_if_finished(region_concat_p,
-                                                      "bcftools concat",
-                                                      close_files=[out_file_tmp_f])
-
-        # end loop once all processes have finished
-        if (
-            (region_concat_p is None)
-            and (bcftools_view_noheader_p is None)
-            and (bcftools_view_headeronly_p is None)
-            and (part_tee_p is None)
-            and (bcftools_norm_p is None)
-            and (bcftools_mpileup_p is None)
-            ):
-            print "All region work has completed"
-            break
-        else:
-            sleep(0.01)
-            # continue to next loop iteration
-
-
-    if len(child_pids) > 0:
-        print "WARNING: some children are still alive: [%s]" % (child_pids)
-        for pid in child_pids:
-            print "Attempting to terminate %s forcefully" % (pid)
-            try:
-                os.kill(pid, SIGTERM)
-            except Exception as e:
-                print "Could not kill pid %s: %s" % (pid, e)
-
-    for fifo in fifos_to_delete:
-        try:
-            os.remove(fifo)
-        except:
-            raise
-
-    concat_headeronly_tmp_fofn = os.path.join(tmp_dir, output_basename + ".fifos_fofn")
-    tmp_files_to_delete = []
-    print "Preparing fofn for bcftools concat (headeronly): %s" % (concat_headeronly_tmp_fofn)
-    with open(concat_headeronly_tmp_fofn, 'w') as f:
-        print "Checking files for regions: %s" % regions
-        for concat_headeronly_tmp in [concat_headeronly_tmps[region] for region in regions]:
-            if os.path.exists(concat_headeronly_tmp):
-                print "Adding %s to fofn" % concat_headeronly_tmp
-                f.write("%s\n" % concat_headeronly_tmp)
-                tmp_files_to_delete.append(concat_headeronly_tmp)
+    # warm the Keep blocks the first mpileup commands will read while they start up
+    prefetcher = prefetch.prime_alignment_inputs(ref_file, cram_file, [prefetch.parse_region(region) for region in regions])
+
+    if single_pass_mpileup and not regions_grouped_by_contig(regions):
+        print "WARNING: regions in chunk file are not grouped by contig in increasing order, running mpileup once per region"
+        single_pass_mpileup = False
+    with timing.span("run tool") as span:
+        parts_dir = os.path.join(tmp_dir, "parts")
+        if use_checkpoints:
+            # keep each finished part in a checkpoint so that a rerun of
+            # this task only runs the parts still to do, running a single
+            # pass as checkpoint_passes passes over consecutive regions
+            checkpoint = checkpoints.TaskCheckpoint(parts_dir)
+            if single_pass_mpileup:
+                region_groups = [regions[i * len(regions) / checkpoint_passes:(i + 1) * len(regions) / checkpoint_passes]
+                                 for i in range(checkpoint_passes)]
+                region_groups = [region_group for region_group in region_groups if len(region_group) > 0]
             else:
-                print "WARNING: no output file for %s (there was probably no data in the region)" % concat_headeronly_tmp
-
-    final_headeronly_tmp = os.path.join(tmp_dir, output_basename + ".headeronly.g.vcf")
-    final_headeronly_tmp_f = open(final_headeronly_tmp, 'wb')
-
-    print "Creating 'bcftools concat | grep' pipe" 
-    grep_headeronly_stdin_pipe_read, grep_headeronly_stdin_pipe_write = os.pipe()
-
-    grep_headeronly_cmd = ["egrep", "-v", "^[#][#](bcftools|mpileup|reference)"]
-    grep_headeronly_p = run_child_cmd(grep_headeronly_cmd,
-                                      stdin=grep_headeronly_stdin_pipe_read,
-                                      stdout=final_headeronly_tmp_f,
-                                      tag="grep (headeronly)")
-    bcftools_concat_headeronly_cmd = ["bcftools", "concat", "-Ov", "-f", concat_headeronly_tmp_fofn]
-    bcftools_concat_headeronly_p = run_child_cmd(bcftools_concat_headeronly_cmd,
-                                                 stdout=grep_headeronly_stdin_pipe_write,
-                                                 tag="bcftools concat (headeronly)")
-    while True:
-        watch_fds_and_print_output()
-        bcftools_concat_headeronly_p = close_process_if_finished(bcftools_concat_headeronly_p,
-                                                                 "bcftools concat (headeronly)",
-                                                                 close_fds=[grep_headeronly_stdin_pipe_write])
-        grep_headeronly_p = close_process_if_finished(grep_headeronly_p,
-                                                      "grep (headeronly)",
-                                                      close_fds=[grep_headeronly_stdin_pipe_read],
-                                                      close_files=[final_headeronly_tmp_f])
-        if ((bcftools_concat_headeronly_p is None)
-            and (grep_headeronly_p is None)):
-            # none of the processes are still running, we're done! 
-            break
+                region_groups = [[region] for region in regions]
+            mpileup_in_parts(ref_file, cram_file, region_groups, tmp_dir, parts_dir, output_basename, final_out_file,
+                             checkpoint=checkpoint)
+        elif single_pass_mpileup:
+            mpileup_single_pass(ref_file, cram_file, regions, tmp_dir, output_basename, final_out_file)
         else:
-            sleep(0.01)
-            # continue to next loop iteration
-
-    if bcftools_concat_headeronly_p is not None:
-        print "ERROR: failed to cleanly terminate bcftools concat (headeronly)"
-
-    if grep_headeronly_p is not None:
-        print "ERROR: failed to cleanly terminate grep (headeronly)"
-
-
-    # check if there was any data output
-    if os.stat(out_file_tmp)[6] == 0:
-        # 0-byte data file, there is no point in concatenating and 
-        # reheader will reject the file, so we need to bgzip it ourselves
-        print "Handling 0-byte data file - compressing headeronly vcf with bgzip to create [%s]" % (final_out_file)
-        final_out_file_f = open(final_out_file, 'wb')
-        final_bgzip_cmd = ["bgzip", "-c", final_headeronly_tmp]
-        final_bgzip_p = run_child_cmd(final_bgzip_cmd, tag="final bgzip", stdout=final_out_file_f)
-        while True:
-            watch_fds_and_print_output()
-            final_bgzip_p = close_process_if_finished(final_bgzip_p,
-                                                      "final bgzip",
-                                                      close_files=[final_out_file_f])
-            if (final_bgzip_p is None):
-                # none of the processes are still running, we're done! 
-                break
-            else:
-                sleep(0.01)
-                # continue to next loop iteration
-        if final_bgzip_p is not None:
-            print "ERROR: failed to cleanly terminate final bgzip (header with no data)"
-    else:
-        # there is some data in the data file
-        print "Creating final 'cat | bcftools view -Oz' pipe"
-        final_bcftools_view_stdin_pipe_read, final_bcftools_view_stdin_pipe_write = os.pipe()
-        print "Preparing penultimate output file [%s]" % (penultimate_out_file)
-        final_bcftools_view_cmd = ["bcftools", "view", "-Oz", "-o", penultimate_out_file]
-        final_concat_cmd = ["cat", final_headeronly_tmp, out_file_tmp]
-        final_bcftools_view_p = run_child_cmd(final_bcftools_view_cmd, tag="final bcftools view -Oz", stdin=final_bcftools_view_stdin_pipe_read)
-        final_concat_p = run_child_cmd(final_concat_cmd, tag="final cat (header+data)", stdout=final_bcftools_view_stdin_pipe_write)
-        while True:
-            watch_fds_and_print_output()
-            final_bcftools_view_p = close_process_if_finished(final_bcftools_view_p,
-                                                              "final bcftools view -Oz",
-                                                              close_fds=[final_bcftools_view_stdin_pipe_read])
-            final_concat_p = close_process_if_finished(final_concat_p,
-                                                       "final cat (header+data)",
-                                                       close_fds=[final_bcftools_view_stdin_pipe_write])
-            if ((final_concat_p is None)
-                and (final_bcftools_view_p is None)):
-                # none of the processes are still running, we're done! 
-                break
-            else:
-                sleep(0.01)
-                # continue to next loop iteration
-
-        if final_bcftools_view_p is not None:
-            print "ERROR: failed to cleanly terminate final bcftools view -Oz"
-
-        if final_concat_p is not None:
-            print "ERROR: failed to cleanly terminate final cat (header+data)"
-
-        print "Reheadering penultimate output file into final out file [%s]" % (final_out_file)
-        final_bcftools_reheader_cmd = ["bcftools", "reheader", "-h", final_headeronly_tmp, "-o", final_out_file, penultimate_out_file]
-        final_bcftools_reheader_p = run_child_cmd(final_bcftools_reheader_cmd, tag="final bcftools reheader")
-        while True:
-            watch_fds_and_print_output()
-            final_bcftools_reheader_p = close_process_if_finished(final_bcftools_reheader_p,
-                                                              "final bcftools reheader")
-            if (final_bcftools_reheader_p is None):
-                # none of the processes are still running, we're done! 
-                break
-            else:
-                sleep(0.01)
-                # continue to next loop iteration
-        if final_bcftools_reheader_p is not None:
-            print "ERROR: failed to cleanly terminate final bcftools reheader"
-        os.remove(penultimate_out_file)
+            mpileup_in_parts(ref_file, cram_file, [[region] for region in regions], tmp_dir, parts_dir, output_basename, final_out_file)
+        span.add_bytes(timing.file_size(final_out_file))
 
     print "Indexing final output file [%s]" % (final_out_file)
     bcftools_index_cmd = ["bcftools", "index", final_out_file]
@@ -787,22 +637,21 @@ def main():
     if bcftools_index_p is not None:
         print "ERROR: failed to cleanly terminate bcftools index"
 
-    print "Complete, removing temporary files"
-    os.remove(concat_headeronly_tmp_fofn)
-    os.remove(out_file_tmp)
-    os.remove(final_headeronly_tmp)
-    for tmp_file in tmp_files_to_delete:
-        os.remove(tmp_file)
+    prefetcher.stop()
 
     # Write a new collection as output
     out = arvados.CollectionWriter()
 
     # Write out_dir to keep
     print "Writing Keep Collection from [%s] to [%s]" % (out_dir, stream_name)
-    out.write_directory_tree(out_dir, stream_name)
+    with timing.span("write_directory_tree") as span:
+        out.write_directory_tree(out_dir, stream_name)
+        span.add_bytes(timing.directory_size(out_dir))
+    timing.write_summary(out)
 
     # Commit the output to Keep.
-    output_locator = out.finish()
+    with timing.span("finish"):
+        output_locator = out.finish()
     print "Task output locator [%s]" % output_locator
 
     # Use the resulting locator as the output for this task.
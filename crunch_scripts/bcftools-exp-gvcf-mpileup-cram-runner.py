@@ -6,16 +6,14 @@ import re
 import subprocess
 import jinja2
 
+from hgi_arvados import reference
+from hgi_arvados import sequence_dictionary
+
 RUNNER_CONFIG_TEMPLATE = "/etc/runner/gvcf.mpileup.conf.j2"
 
 # TODO: make genome_chunks a parameter
 genome_chunks = 1
 
-# TODO: make skip_sq_sn_regex a paramter
-#skip_sq_sn_regex = '_decoy$'
-skip_sq_sn_regex = '([_-]|EBV)'
-skip_sq_sn_r = re.compile(skip_sq_sn_regex)
-
 class InvalidArgumentError(Exception):
     pass
 
@@ -37,117 +35,30 @@ def one_task_per_cram_file(if_sequence=0, and_end_task=True):
         return
 
     # Ensure we have a .fa reference file with corresponding .fai index and .dict
-    reference_coll = arvados.current_job()['script_parameters']['reference_collection']
-    rcr = arvados.CollectionReader(reference_coll)
-    ref_fasta = {}
-    ref_fai = {}
-    ref_dict = {}
-    ref_input = None
-    dict_reader = None
-    for rs in rcr.all_streams():
-        for rf in rs.all_files():
-            if re.search(r'\.fa$', rf.name()):
-                ref_fasta[rs.name(), rf.name()] = rf
-            elif re.search(r'\.fai$', rf.name()):
-                ref_fai[rs.name(), rf.name()] = rf
-            elif re.search(r'\.dict$', rf.name()):
-                ref_dict[rs.name(), rf.name()] = rf
-    for ((s_name, f_name), fasta_f) in ref_fasta.items():
-        fai_f = ref_fai.get((s_name, re.sub(r'fa$', 'fai', f_name)), 
-                            ref_fai.get((s_name, re.sub(r'fa$', 'fa.fai', f_name)), 
-                                        None))
-        dict_f = ref_dict.get((s_name, re.sub(r'fa$', 'dict', f_name)), 
-                              ref_dict.get((s_name, re.sub(r'fa$', 'fa.dict', f_name)), 
-                                           None))
-        if fasta_f and fai_f and dict_f:
-            # found a set of all three! 
-            ref_input = fasta_f.as_manifest()
-            ref_input += fai_f.as_manifest()
-            ref_input += dict_f.as_manifest()
-            dict_reader = dict_f
-            break
-    if ref_input is None:
-        raise InvalidArgumentError("Expected a reference fasta with fai and dict in reference_collection. Found [%s]" % ' '.join(rf.name() for rf in rs.all_files()))
-    if dict_reader is None:
-        raise InvalidArgumentError("Could not find .dict file in reference_collection. Found [%s]" % ' '.join(rf.name() for rf in rs.all_files()))
-
-    # Create a portable data hash for the ref_input manifest
-    try:
-        r = arvados.api().collections().create(body={"manifest_text": ref_input}).execute()
-        ref_input_pdh = r["portable_data_hash"]
-    except:
-        raise 
+    ref = reference.resolve_reference(arvados.current_job()['script_parameters']['reference_collection'])
+    ref_input_pdh = ref['ref_pdh']
+    dict_name = os.path.basename(ref['dict'])
 
     # Load the dict data
-    interval_header = ""
-    dict_lines = dict_reader.readlines()
-    dict_header = dict_lines.pop(0)
-    if re.search(r'^@HD', dict_header) is None:
-        raise InvalidArgumentError("Dict file in reference collection does not have correct header: [%s]" % dict_header)
-    interval_header += dict_header
-    print "Dict header is %s" % dict_header
-    sn_intervals = dict()
-    sns = []
-    total_len = 0
-    for sq in dict_lines:
-        if re.search(r'^@SQ', sq) is None:
-            raise InvalidArgumentError("Dict file contains malformed SQ line: [%s]" % sq)
-        interval_header += sq
-        sn = None
-        ln = None
-        for tagval in sq.split("\t"):
-            tv = tagval.split(":", 1)
-            if tv[0] == "SN":
-                sn = tv[1]
-            if tv[0] == "LN":
-                ln = tv[1]
-            if sn and ln:
-                break
-        if not (sn and ln):
-            raise InvalidArgumentError("Dict file SQ entry missing required SN and/or LN parameters: [%s]" % sq)
-        assert(sn and ln)
-        if sn_intervals.has_key(sn):
-            raise InvalidArgumentError("Dict file has duplicate SQ entry for SN %s: [%s]" % (sn, sq))
-        if skip_sq_sn_r.search(sn):
-            next
-        sn_intervals[sn] = (1, int(ln))
-        sns.append(sn)
-        total_len += int(ln)
+    print "Dict header is %s" % ref['dict_lines'][0]
+    seqdict = sequence_dictionary.SequenceDictionary.from_dict_lines(ref['dict_lines'])
+    # every SQ is chunked unless exclude_sq_sn_regex is given
+    included = seqdict
+    if 'exclude_sq_sn_regex' in arvados.current_job()['script_parameters']:
+        included = seqdict.subset(re.compile(arvados.current_job()['script_parameters']['exclude_sq_sn_regex']))
 
     # Chunk the genome into genome_chunks equally sized pieces and create intervals files
-    print "Total genome length is %s" % total_len
-    chunk_len = int(total_len / genome_chunks)
+    print "Total genome length is %s" % included.total_length()
     chunk_input_pdh_name = []
-    print "Chunking genome into %s chunks of size ~%s" % (genome_chunks, chunk_len)
-    for chunk_i in range(0, genome_chunks):
+    print "Chunking genome into %s chunks of size ~%s" % (genome_chunks, int(included.total_length() / genome_chunks))
+    for chunk_i, chunk_intervals in enumerate(included.weighted_chunks(genome_chunks)):
         chunk_num = chunk_i + 1
-        chunk_intervals_count = 0
-        chunk_input_name = dict_reader.name() + (".%s_of_%s.region_list.txt" % (chunk_num, genome_chunks))
-        print "Creating interval file for chunk %s" % chunk_num
-        chunk_c = arvados.collection.CollectionWriter(num_retries=3)
-        chunk_c.start_new_file(newfilename=chunk_input_name)
-        # chunk_c.write(interval_header)
-        remaining_len = chunk_len
-        while len(sns) > 0:
-            sn = sns.pop(0)
-            if not sn_intervals.has_key(sn):
-                raise ValueError("sn_intervals missing entry for sn [%s]" % sn)
-            start, end = sn_intervals[sn]
-            if (end-start+1) > remaining_len:
-                # not enough space for the whole sq, split it
-                real_end = end
-                end = remaining_len + start - 1
-                assert((end-start+1) <= remaining_len)
-                sn_intervals[sn] = (end+1, real_end)
-                sns.insert(0, sn)
-            #interval = "%s\t%s\t%s\t+\t%s\n" % (sn, start, end, "interval_%s_of_%s_%s" % (chunk_num, genome_chunks, sn))
-            interval = "%s\t%s\t%s\n" % (sn, start, end)
-            remaining_len -= (end-start+1)
-            chunk_c.write(interval)
-            chunk_intervals_count += 1
-            if remaining_len <= 0:
-                break
-        if chunk_intervals_count > 0:
+        chunk_input_name = dict_name + (".%s_of_%s.region_list.txt" % (chunk_num, genome_chunks))
+        if len(chunk_intervals) > 0:
+            print "Creating interval file for chunk %s" % chunk_num
+            chunk_c = arvados.collection.CollectionWriter(num_retries=3)
+            chunk_c.start_new_file(newfilename=chunk_input_name)
+            chunk_c.write(''.join(["%s\t%s\t%s\n" % interval for interval in chunk_intervals]))
             chunk_input_pdh = chunk_c.finish()
             print "Chunk intervals file %s saved as %s" % (chunk_input_name, chunk_input_pdh)
             chunk_input_pdh_name.append((chunk_input_pdh, chunk_input_name))
@@ -224,6 +135,8 @@ def main():
     ref_file = None
     print "Mounting reference FASTA collection"
     ref_dir = arvados.get_task_param_mount('ref')
+    # share one copy of the reference between the tasks on this node
+    ref_dir = reference.local_reference_dir(arvados.current_task()['parameters']['ref'], ref_dir)
 
     for f in arvados.util.listdir_recursive(ref_dir):
         if re.search(r'\.fa$', f):
@@ -235,6 +148,10 @@ def main():
         raise FileAccessError("reference FASTA file not readable: %s" % ref_file)
     # TODO: could check readability of .fai and .dict as well?
 
+    # let htslib look up the CRAM's reference sequences by MD5 in a
+    # cache on this node rather than in the FASTA (or over the network)
+    reference.use_local_ref_cache(arvados.current_task()['parameters']['ref'], ref_file)
+
     # Get genome chunk intervals file
     chunk_file = None
     print "Mounting chunk collection"
@@ -6,16 +6,13 @@ import re
 import subprocess
 import jinja2
 
+from hgi_arvados import reference
+
 RUNNER_CONFIG_TEMPLATE = "/etc/runner/gvcf.mpileup.conf.j2"
 
 # TODO: make genome_chunks a parameter
 #genome_chunks = 1
 
-# TODO: make skip_sq_sn_regex a paramter
-#skip_sq_sn_regex = '_decoy$'
-skip_sq_sn_regex = '([_-]|EBV)'
-skip_sq_sn_r = re.compile(skip_sq_sn_regex)
-
 class InvalidArgumentError(Exception):
     pass
 
@@ -37,82 +34,11 @@ def one_task_per_cram_file(if_sequence=0, and_end_task=True):
         return
 
     # Ensure we have a .fa reference file with corresponding .fai index and .dict
-    reference_coll = arvados.current_job()['script_parameters']['reference_collection']
-    rcr = arvados.CollectionReader(reference_coll)
-    ref_fasta = {}
-    ref_fai = {}
-    ref_dict = {}
-    ref_input = None
-    dict_reader = None
-    for rs in rcr.all_streams():
-        for rf in rs.all_files():
-            if re.search(r'\.fa$', rf.name()):
-                ref_fasta[rs.name(), rf.name()] = rf
-            elif re.search(r'\.fai$', rf.name()):
-                ref_fai[rs.name(), rf.name()] = rf
-            elif re.search(r'\.dict$', rf.name()):
-                ref_dict[rs.name(), rf.name()] = rf
-    for ((s_name, f_name), fasta_f) in ref_fasta.items():
-        fai_f = ref_fai.get((s_name, re.sub(r'fa$', 'fai', f_name)), 
-                            ref_fai.get((s_name, re.sub(r'fa$', 'fa.fai', f_name)), 
-                                        None))
-        dict_f = ref_dict.get((s_name, re.sub(r'fa$', 'dict', f_name)), 
-                              ref_dict.get((s_name, re.sub(r'fa$', 'fa.dict', f_name)), 
-                                           None))
-        if fasta_f and fai_f and dict_f:
-            # found a set of all three! 
-            ref_input = fasta_f.as_manifest()
-            ref_input += fai_f.as_manifest()
-            ref_input += dict_f.as_manifest()
-            dict_reader = dict_f
-            break
-    if ref_input is None:
-        raise InvalidArgumentError("Expected a reference fasta with fai and dict in reference_collection. Found [%s]" % ' '.join(rf.name() for rf in rs.all_files()))
-    if dict_reader is None:
-        raise InvalidArgumentError("Could not find .dict file in reference_collection. Found [%s]" % ' '.join(rf.name() for rf in rs.all_files()))
-
-    # Create a portable data hash for the ref_input manifest
-    try:
-        r = arvados.api().collections().create(body={"manifest_text": ref_input}).execute()
-        ref_input_pdh = r["portable_data_hash"]
-    except:
-        raise 
+    ref = reference.resolve_reference(arvados.current_job()['script_parameters']['reference_collection'])
+    ref_input_pdh = ref['ref_pdh']
 
     # Load the dict data
-    interval_header = ""
-    dict_lines = dict_reader.readlines()
-    dict_header = dict_lines.pop(0)
-    if re.search(r'^@HD', dict_header) is None:
-        raise InvalidArgumentError("Dict file in reference collection does not have correct header: [%s]" % dict_header)
-    interval_header += dict_header
-    print "Dict header is %s" % dict_header
-    sn_intervals = dict()
-    sns = []
-    total_len = 0
-    for sq in dict_lines:
-        if re.search(r'^@SQ', sq) is None:
-            raise InvalidArgumentError("Dict file contains malformed SQ line: [%s]" % sq)
-        interval_header += sq
-        sn = None
-        ln = None
-        for tagval in sq.split("\t"):
-            tv = tagval.split(":", 1)
-            if tv[0] == "SN":
-                sn = tv[1]
-            if tv[0] == "LN":
-                ln = tv[1]
-            if sn and ln:
-                break
-        if not (sn and ln):
-            raise InvalidArgumentError("Dict file SQ entry missing required SN and/or LN parameters: [%s]" % sq)
-        assert(sn and ln)
-        if sn_intervals.has_key(sn):
-            raise InvalidArgumentError("Dict file has duplicate SQ entry for SN %s: [%s]" % (sn, sq))
-        if skip_sq_sn_r.search(sn):
-            next
-        sn_intervals[sn] = (1, int(ln))
-        sns.append(sn)
-        total_len += int(ln)
+    print "Dict header is %s" % ref['dict_lines'][0]
 
     # # Chunk the genome into genome_chunks equally sized pieces and create intervals files
     # print "Total genome length is %s" % total_len
@@ -236,6 +162,8 @@ def main():
     ref_file = None
     print "Mounting reference FASTA collection"
     ref_dir = arvados.get_task_param_mount('ref')
+    # share one copy of the reference between the tasks on this node
+    ref_dir = reference.local_reference_dir(arvados.current_task()['parameters']['ref'], ref_dir)
 
     for f in arvados.util.listdir_recursive(ref_dir):
         if re.search(r'\.fa$', f):
@@ -247,6 +175,10 @@ def main():
         raise FileAccessError("reference FASTA file not readable: %s" % ref_file)
     # TODO: could check readability of .fai and .dict as well?
 
+    # let htslib look up the CRAM's reference sequences by MD5 in a
+    # cache on this node rather than in the FASTA (or over the network)
+    have_ref_cache = reference.use_local_ref_cache(arvados.current_task()['parameters']['ref'], ref_file)
+
     # Get genome chunk intervals file
     # chunk_file = None
     # print "Mounting chunk collection"
@@ -307,7 +239,11 @@ def main():
 #    out_file = os.path.join(out_dir, os.path.basename(cram_file_base) + "." + os.path.basename(chunk_file) + ".g.bcf")
     out_file = os.path.join(out_dir, os.path.basename(cram_file_base) + ".g.bcf")
 
-    bash_cmd_pipe = "samtools view -h -u -@ 1 -T %s %s | bcftools mpileup -t AD,INFO/AD -C50 -pm2 -F0.1 -d10000 --gvcf 1,2,3,4,5,10,15 -f %s -Ou - | bcftools view  -Ou | bcftools norm -f %s -Ob -o %s" % (ref_file, cram_file, ref_file, ref_file, out_file)
+    # samtools only needs the FASTA to decode the CRAM if there is no reference cache
+    samtools_ref_opt = "-T %s" % (ref_file)
+    if have_ref_cache:
+        samtools_ref_opt = ""
+    bash_cmd_pipe = "samtools view -h -u -@ 1 %s %s | bcftools mpileup -t AD,INFO/AD -C50 -pm2 -F0.1 -d10000 --gvcf 1,2,3,4,5,10,15 -f %s -Ou - | bcftools view  -Ou | bcftools norm -f %s -Ob -o %s" % (samtools_ref_opt, cram_file, ref_file, ref_file, out_file)
 
     # Call bcftools
     runner_p = subprocess.Popen(bash_cmd_pipe, 
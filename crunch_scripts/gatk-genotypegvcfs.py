@@ -8,8 +8,13 @@ import subprocess
 import hgi_arvados
 from hgi_arvados import gatk
 from hgi_arvados import gatk_helper
+from hgi_arvados import gvcf_columnar
 from hgi_arvados import errors
+from hgi_arvados import prefetch
+from hgi_arvados import stragglers
 from hgi_arvados import validators
+from hgi_arvados import timing
+from hgi_arvados import vcf_stats
 
 # TODO: make group_by_regex a parameter
 group_by_regex = '(?P<group_by>[0-9]+_of_[0-9]+)[^0-9]'
@@ -19,12 +24,19 @@ def validate_task_output(output_locator):
     return validators.validate_compressed_indexed_vcf_collection(output_locator)
 
 def main():
+    # if requested, read the task's regions of any input gVCFs that
+    # have columnar stores from those stores rather than the gVCF text
+    columnar_inputs = False
+    if "columnar_inputs" in arvados.current_job()['script_parameters']:
+        columnar_inputs = str(arvados.current_job()['script_parameters']['columnar_inputs']).lower() == 'true'
+
     ################################################################################
     # Phase I: Check inputs and setup sub tasks 1-N to process group(s) based on
     #          applying the capturing group named "group_by" in group_by_regex.
     #          (and terminate if this is task 0)
     ################################################################################
-    ref_input_pdh = gatk_helper.prepare_gatk_reference_collection(reference_coll=arvados.current_job()['script_parameters']['reference_collection'])
+    with timing.span("prepare reference"):
+        ref_input_pdh = gatk_helper.prepare_gatk_reference_collection(reference_coll=arvados.current_job()['script_parameters']['reference_collection'])
     job_input_pdh = arvados.current_job()['script_parameters']['inputs_collection']
     interval_lists_pdh = arvados.current_job()['script_parameters']['interval_lists_collection']
     interval_count = 1
@@ -45,17 +57,19 @@ def main():
 
         # retrieve a full set of all possible reusable tasks at sequence 1
         print "Retrieving all potentially reusable tasks"
-        reusable_tasks = hgi_arvados.get_reusable_tasks(1, task_key_params, job_filters)
+        with timing.span("find reusable tasks"):
+            reusable_tasks = hgi_arvados.get_reusable_tasks(1, task_key_params, job_filters)
         print "Have %s tasks for potential reuse" % (len(reusable_tasks))
 
         def create_task_with_validated_reuse(sequence, params):
             return hgi_arvados.create_or_reuse_task(sequence, params, reusable_tasks, task_key_params, validate_task_output)
 
         # Setup sub tasks (and terminate if this is task 0)
-        hgi_arvados.one_task_per_group_combined_inputs(ref_input_pdh, job_input_pdh, interval_lists_pdh,
-                                                       group_by_regex,
-                                                       if_sequence=0, and_end_task=True,
-                                                       create_task_func=create_task_with_validated_reuse)
+        with timing.span("create tasks"):
+            hgi_arvados.one_task_per_group_combined_inputs(ref_input_pdh, job_input_pdh, interval_lists_pdh,
+                                                           group_by_regex,
+                                                           if_sequence=0, and_end_task=True,
+                                                           create_task_func=create_task_with_validated_reuse)
 
     # Get object representing the current task
     this_task = arvados.current_task()
@@ -70,13 +84,37 @@ def main():
         print "This task's work was already done by JobTask %s" % this_task['parameters']['reuse_job_task']
         exit(0)
 
+    # in speculative mode, finish now if this task's speculative
+    # duplicate (or original) has already done the work
+    stragglers.exit_if_superseded()
+
     ################################################################################
     # Phase IIb: Genotype gVCFs!
     ################################################################################
-    ref_file = gatk_helper.mount_gatk_reference(ref_param="ref")
-    gvcf_files = gatk_helper.mount_gatk_gvcf_inputs(inputs_param="inputs")
+    with timing.span("mount reference") as span:
+        ref_file = gatk_helper.mount_gatk_reference(ref_param="ref")
+        span.add_bytes(timing.file_size(ref_file))
+    with timing.span("mount inputs") as span:
+        gvcf_files = gatk_helper.mount_gatk_gvcf_inputs(inputs_param="inputs")
+        span.add_bytes(sum([timing.file_size(gvcf_file) for gvcf_file in gvcf_files]))
+    if not vcf_stats.check_input_stats(gvcf_files):
+        raise errors.InvalidArgumentError("Input gVCFs failed the checks of their stats sidecars")
     out_dir = hgi_arvados.prepare_out_dir()
-    interval_list_file = gatk_helper.mount_single_gatk_interval_list_input(interval_list_param="inputs")
+    with timing.span("mount inputs") as span:
+        interval_list_file = gatk_helper.mount_single_gatk_interval_list_input(interval_list_param="inputs")
+        span.add_bytes(timing.file_size(interval_list_file))
+
+    if columnar_inputs:
+        with timing.span("read columnar stores") as span:
+            try:
+                gvcf_files = gvcf_columnar.localise_region_inputs(gvcf_files, prefetch.read_regions(interval_list_file),
+                                                                  os.path.join(this_task.tmpdir, "columnar"))
+                span.add_bytes(sum([timing.file_size(gvcf_file) for gvcf_file in gvcf_files]))
+            except (errors.InvalidArgumentError, IOError, OSError, ValueError) as e:
+                print "WARNING: could not read the columnar stores of the input gVCFs, reading the gVCFs instead: %s" % (e)
+
+    # warm the Keep blocks GATK will read first while it starts up
+    prefetcher = prefetch.prime_vcf_inputs(ref_file, gvcf_files, prefetch.read_regions(interval_list_file, limit=16))
     name = this_task['parameters'].get('name')
     if not name:
         name = "unknown"
@@ -86,13 +124,20 @@ def main():
     out_file = out_file.replace(".bcf", "._cf")
 
     # GenotypeGVCFs!
-    gatk_exit = gatk.genotype_gvcfs(ref_file, interval_list_file, gvcf_files, os.path.join(out_dir, out_file), cores="4", java_mem="19g")
+    with timing.span("run tool"):
+        gatk_exit = gatk.genotype_gvcfs(ref_file, interval_list_file, gvcf_files, os.path.join(out_dir, out_file), cores="4", java_mem="19g")
+    prefetcher.stop()
 
     if gatk_exit != 0:
         print "WARNING: GATK exited with exit code %s (NOT WRITING OUTPUT)" % gatk_exit
         arvados.api().job_tasks().update(uuid=this_task['uuid'],
                                          body={'success':False}
                                          ).execute()
+    elif not vcf_stats.write_dir_stats(out_dir, regions={out_file: prefetch.read_regions(interval_list_file)}):
+        print "ERROR: GATK output failed validation (NOT WRITING OUTPUT)"
+        arvados.api().job_tasks().update(uuid=this_task['uuid'],
+                                         body={'success':False}
+                                         ).execute()
     else:
         print "GATK exited successfully, writing output to keep"
 
@@ -100,16 +145,23 @@ def main():
         out = arvados.CollectionWriter()
 
         # Write out_dir to keep
-        out.write_directory_tree(out_dir)
+        with timing.span("write_directory_tree") as span:
+            out.write_directory_tree(out_dir)
+            span.add_bytes(timing.directory_size(out_dir))
+        timing.write_summary(out)
 
         # Commit the output to Keep.
-        output_locator = out.finish()
+        with timing.span("finish"):
+            output_locator = out.finish()
 
-        if validate_task_output(output_locator):
+        with timing.span("validate"):
+            output_valid = validate_task_output(output_locator)
+        if output_valid:
             print "Task output validated, setting output to %s" % (output_locator)
 
             # Use the resulting locator as the output for this task.
-            this_task.set_output(output_locator)
+            stragglers.set_task_output(output_locator)
+            stragglers.queue_speculative_duplicates()
         else:
             print "ERROR: Failed to validate task output (%s)" % (output_locator)
             arvados.api().job_tasks().update(uuid=this_task['uuid'],
@@ -6,8 +6,13 @@ import re
 import subprocess
 
 import hgi_arvados
+from hgi_arvados import checkpoints
 from hgi_arvados import gatk
 from hgi_arvados import gatk_helper
+from hgi_arvados import prefetch
+from hgi_arvados import stragglers
+from hgi_arvados import timing
+from hgi_arvados import vcf_stats
 from hgi_arvados import validators
 
 def validate_task_output(output_locator):
@@ -20,18 +25,25 @@ def main():
     #          applying the capturing group named "group_by" in group_by_regex.
     #          (and terminate if this is task 0)
     ################################################################################
-    ref_input_pdh = gatk_helper.prepare_gatk_reference_collection(reference_coll=arvados.current_job()['script_parameters']['reference_collection'])
+    with timing.span("prepare reference"):
+        ref_input_pdh = gatk_helper.prepare_gatk_reference_collection(reference_coll=arvados.current_job()['script_parameters']['reference_collection'])
     job_input_pdh = arvados.current_job()['script_parameters']['inputs_collection']
     interval_lists_pdh = arvados.current_job()['script_parameters']['interval_lists_collection']
     interval_count = 1
     if "interval_count" in arvados.current_job()['script_parameters']:
         interval_count = arvados.current_job()['script_parameters']['interval_count']
+    # if set, run each chunk as this many parts and hand off the
+    # remaining parts of chunks that fall behind to new tasks
+    straggler_pieces = 0
+    if "straggler_pieces" in arvados.current_job()['script_parameters']:
+        straggler_pieces = int(arvados.current_job()['script_parameters']['straggler_pieces'])
 
     # Setup sub tasks 1-N (and terminate if this is task 0)
-    hgi_arvados.chunked_tasks_per_bam_file(ref_input_pdh, job_input_pdh, interval_lists_pdh, validate_task_output,
-                                            if_sequence=0, and_end_task=True, reuse_tasks=False,
-                                            oldest_git_commit_to_reuse='6ca726fc265f9e55765bf1fdf71b86285b8a0ff2',
-                                            script="gatk-haplotypecaller-bam.py")
+    with timing.span("create tasks"):
+        hgi_arvados.chunked_tasks_per_bam_file(ref_input_pdh, job_input_pdh, interval_lists_pdh, validate_task_output,
+                                                if_sequence=0, and_end_task=True, reuse_tasks=False,
+                                                oldest_git_commit_to_reuse='6ca726fc265f9e55765bf1fdf71b86285b8a0ff2',
+                                                script="gatk-haplotypecaller-bam.py")
 
     # Get object representing the current task
     this_task = arvados.current_task()
@@ -46,12 +58,23 @@ def main():
         print "This task's work was already done by JobTask %s" % this_task['parameters']['reuse_job_task']
         exit(0)
 
+    # in speculative mode, finish now if this task's speculative
+    # duplicate (or original) has already done the work
+    stragglers.exit_if_superseded()
+
     ################################################################################
     # Phase IIb: Call Haplotypes!
     ################################################################################
-    ref_file = gatk_helper.mount_gatk_reference(ref_param="ref")
-    interval_list_file = gatk_helper.mount_single_gatk_interval_list_input(interval_list_param="chunk")
-    bam_file = gatk_helper.mount_gatk_bam_input(input_param="input")
+    with timing.span("mount reference") as span:
+        ref_file = gatk_helper.mount_gatk_reference(ref_param="ref")
+        span.add_bytes(timing.file_size(ref_file))
+    with timing.span("mount inputs") as span:
+        interval_list_file = gatk_helper.mount_single_gatk_interval_list_input(interval_list_param="chunk")
+        bam_file = gatk_helper.mount_gatk_bam_input(input_param="input")
+        span.add_bytes(timing.file_size(interval_list_file) + timing.file_size(bam_file))
+
+    # warm the Keep blocks GATK will read first while it starts up
+    prefetcher = prefetch.prime_alignment_inputs(ref_file, bam_file, prefetch.read_regions(interval_list_file, limit=16))
     bam_file_base, bam_file_ext = os.path.splitext(bam_file)
     out_dir = hgi_arvados.prepare_out_dir()
     out_filename = os.path.basename(bam_file_base) + "." + os.path.basename(interval_list_file) + ".vcf.gz"
@@ -59,14 +82,42 @@ def main():
     # because of a GATK bug, name cannot contain the string '.bcf' anywhere within it or we will get BCF output
     out_filename = out_filename.replace(".bcf", "._cf")
 
+    # the regions each output VCF should cover, for its stats sidecar
+    out_regions = {}
+
     # HaplotypeCaller!
-    gatk_exit = gatk.haplotype_caller(ref_file, bam_file, interval_list_file, os.path.join(out_dir, out_filename))
+    with timing.span("run tool"):
+        if straggler_pieces > 0:
+            def run_piece(piece_interval_list_file, progress_callback):
+                piece_out_filename = os.path.basename(bam_file_base) + "." + os.path.basename(piece_interval_list_file) + ".vcf.gz"
+                piece_out_filename = piece_out_filename.replace(".bcf", "._cf")
+                out_regions[piece_out_filename] = prefetch.read_regions(piece_interval_list_file)
+                return gatk.haplotype_caller(ref_file, bam_file, piece_interval_list_file, os.path.join(out_dir, piece_out_filename),
+                                             progress_callback=progress_callback)
+            # if requested, keep each finished part in a checkpoint so
+            # that a rerun of this task only runs the parts still to do
+            checkpoint = None
+            if checkpoints.checkpoints_requested():
+                checkpoint = checkpoints.TaskCheckpoint(out_dir)
+            gatk_exit = stragglers.run_chunk_in_pieces(interval_list_file, run_piece, pieces=straggler_pieces,
+                                                       checkpoint=checkpoint)
+            if checkpoint is not None:
+                out_regions.update(checkpoint.file_regions())
+        else:
+            out_regions[out_filename] = prefetch.read_regions(interval_list_file)
+            gatk_exit = gatk.haplotype_caller(ref_file, bam_file, interval_list_file, os.path.join(out_dir, out_filename))
+    prefetcher.stop()
 
     if gatk_exit != 0:
         print "ERROR: GATK exited with exit code %s (NOT WRITING OUTPUT)" % gatk_exit
         arvados.api().job_tasks().update(uuid=arvados.current_task()['uuid'],
                                          body={'success':False}
                                          ).execute()
+    elif not vcf_stats.write_dir_stats(out_dir, regions=out_regions):
+        print "ERROR: GATK output failed validation (NOT WRITING OUTPUT)"
+        arvados.api().job_tasks().update(uuid=arvados.current_task()['uuid'],
+                                         body={'success':False}
+                                         ).execute()
     else:
         print "GATK exited successfully, writing output to keep"
 
@@ -74,17 +125,24 @@ def main():
         out = arvados.CollectionWriter()
 
         # Write out_dir to keep
-        out.write_directory_tree(out_dir)
+        with timing.span("write_directory_tree") as span:
+            out.write_directory_tree(out_dir)
+            span.add_bytes(timing.directory_size(out_dir))
+        timing.write_summary(out)
 
         # Commit the output to Keep.
-        output_locator = out.finish()
+        with timing.span("finish"):
+            output_locator = out.finish()
 
         print "Task output written to keep, validating it"
-        if validate_task_output(output_locator):
+        with timing.span("validate"):
+            output_valid = validate_task_output(output_locator)
+        if output_valid:
             print "Task output validated, setting output to %s" % (output_locator)
 
             # Use the resulting locator as the output for this task.
-            this_task.set_output(output_locator)
+            stragglers.set_task_output(output_locator)
+            stragglers.queue_speculative_duplicates()
         else:
             print "ERROR: Failed to validate task output (%s)" % (output_locator)
             arvados.api().job_tasks().update(uuid=arvados.current_task()['uuid'],
@@ -6,8 +6,14 @@ import re
 import subprocess
 
 import hgi_arvados
+from hgi_arvados import checkpoints
+from hgi_arvados import errors
 from hgi_arvados import gatk
 from hgi_arvados import gatk_helper
+from hgi_arvados import prefetch
+from hgi_arvados import stragglers
+from hgi_arvados import timing
+from hgi_arvados import vcf_stats
 from hgi_arvados import validators
 
 def validate_task_output(output_locator):
@@ -20,18 +26,36 @@ def main():
     #          applying the capturing group named "group_by" in group_by_regex.
     #          (and terminate if this is task 0)
     ################################################################################
-    ref_input_pdh = gatk_helper.prepare_gatk_reference_collection(reference_coll=arvados.current_job()['script_parameters']['reference_collection'])
+    with timing.span("prepare reference"):
+        ref_input_pdh = gatk_helper.prepare_gatk_reference_collection(reference_coll=arvados.current_job()['script_parameters']['reference_collection'])
     job_input_pdh = arvados.current_job()['script_parameters']['inputs_collection']
     interval_lists_pdh = arvados.current_job()['script_parameters']['interval_lists_collection']
     interval_count = 1
     if "interval_count" in arvados.current_job()['script_parameters']:
         interval_count = arvados.current_job()['script_parameters']['interval_count']
+    # if set, run each chunk as this many parts and hand off the
+    # remaining parts of chunks that fall behind to new tasks
+    straggler_pieces = 0
+    if "straggler_pieces" in arvados.current_job()['script_parameters']:
+        straggler_pieces = int(arvados.current_job()['script_parameters']['straggler_pieces'])
+    # unless disabled, copy just the parts of the CRAM that the chunk
+    # needs to local scratch instead of reading it through the Keep mount
+    fetch_cram_regions = True
+    if "fetch_cram_regions" in arvados.current_job()['script_parameters']:
+        fetch_cram_regions = str(arvados.current_job()['script_parameters']['fetch_cram_regions']).lower() == 'true'
+    # if set, give each task this many CRAMs to call one after another,
+    # so that small (e.g. exome) samples share the per-task overhead
+    crams_per_task = 1
+    if "crams_per_task" in arvados.current_job()['script_parameters']:
+        crams_per_task = int(arvados.current_job()['script_parameters']['crams_per_task'])
 
     # Setup sub tasks 1-N (and terminate if this is task 0)
-    hgi_arvados.chunked_tasks_per_cram_file(ref_input_pdh, job_input_pdh, interval_lists_pdh, validate_task_output,
-                                            if_sequence=0, and_end_task=True, reuse_tasks=False,
-                                            oldest_git_commit_to_reuse='6ca726fc265f9e55765bf1fdf71b86285b8a0ff2',
-                                            script="gatk-haplotypecaller-cram.py")
+    with timing.span("create tasks"):
+        hgi_arvados.chunked_tasks_per_cram_file(ref_input_pdh, job_input_pdh, interval_lists_pdh, validate_task_output,
+                                                if_sequence=0, and_end_task=True, reuse_tasks=False,
+                                                oldest_git_commit_to_reuse='6ca726fc265f9e55765bf1fdf71b86285b8a0ff2',
+                                                script="gatk-haplotypecaller-cram.py",
+                                                crams_per_task=crams_per_task)
 
     # Get object representing the current task
     this_task = arvados.current_task()
@@ -46,27 +70,103 @@ def main():
         print "This task's work was already done by JobTask %s" % this_task['parameters']['reuse_job_task']
         exit(0)
 
+    # in speculative mode, finish now if this task's speculative
+    # duplicate (or original) has already done the work
+    stragglers.exit_if_superseded()
+
     ################################################################################
     # Phase IIb: Call Haplotypes!
     ################################################################################
-    ref_file = gatk_helper.mount_gatk_reference(ref_param="ref")
-    interval_list_file = gatk_helper.mount_single_gatk_interval_list_input(interval_list_param="chunk")
-    cram_file = gatk_helper.mount_gatk_cram_input(input_param="input")
-    cram_file_base, cram_file_ext = os.path.splitext(cram_file)
+    with timing.span("mount reference") as span:
+        ref_file = gatk_helper.mount_gatk_reference(ref_param="ref")
+        span.add_bytes(timing.file_size(ref_file))
+    with timing.span("mount inputs") as span:
+        interval_list_file = gatk_helper.mount_single_gatk_interval_list_input(interval_list_param="chunk")
+        cram_files = gatk_helper.mount_gatk_cram_inputs(input_param="input")
+        span.add_bytes(timing.file_size(interval_list_file) + sum([timing.file_size(cram_file) for cram_file in cram_files]))
+    inputs_dir = arvados.get_task_param_mount("input")
+    cram_file_bases = [os.path.basename(os.path.splitext(cram_file)[0]) for cram_file in cram_files]
+    if len(set(cram_file_bases)) != len(cram_file_bases):
+        raise errors.InvalidArgumentError("CRAM files for the same task must have distinct names: %s" % (' '.join(cram_files)))
+    if len(cram_files) > 1 and straggler_pieces > 0:
+        print "WARNING: not running chunk in pieces as this task has a batch of %s CRAMs" % (len(cram_files))
+        straggler_pieces = 0
     out_dir = hgi_arvados.prepare_out_dir()
-    out_filename = os.path.basename(cram_file_base) + "." + os.path.basename(interval_list_file) + ".vcf.gz"
-
-    # because of a GATK bug, name cannot contain the string '.bcf' anywhere within it or we will get BCF output
-    out_filename = out_filename.replace(".bcf", "._cf")
 
-    # HaplotypeCaller!
-    gatk_exit = gatk.haplotype_caller(ref_file, cram_file, interval_list_file, os.path.join(out_dir, out_filename))
+    # the regions each output VCF should cover, for its stats sidecar
+    out_regions = {}
+
+    def call_haplotypes(cram_file):
+        fetched = False
+        if fetch_cram_regions:
+            with timing.span("fetch cram regions") as span:
+                try:
+                    cram_path = os.path.join(".", os.path.relpath(cram_file, inputs_dir))
+                    cram_file = gatk_helper.fetch_gatk_cram_input_regions(prefetch.read_regions(interval_list_file), input_param="input",
+                                                                          cram_path=cram_path)
+                    fetched = True
+                    span.add_bytes(timing.file_size(cram_file))
+                except (errors.InvalidArgumentError, errors.FileAccessError, errors.APIError, IOError, OSError) as e:
+                    print "WARNING: could not fetch the CRAM regions for this chunk, reading the mounted CRAM instead: %s" % (e)
+
+        # warm the Keep blocks GATK will read first while it starts up
+        prefetcher = prefetch.prime_alignment_inputs(ref_file, cram_file, prefetch.read_regions(interval_list_file, limit=16))
+        cram_file_base, cram_file_ext = os.path.splitext(cram_file)
+        out_filename = os.path.basename(cram_file_base) + "." + os.path.basename(interval_list_file) + ".vcf.gz"
+
+        # because of a GATK bug, name cannot contain the string '.bcf' anywhere within it or we will get BCF output
+        out_filename = out_filename.replace(".bcf", "._cf")
+
+        # HaplotypeCaller!
+        with timing.span("run tool"):
+            if straggler_pieces > 0:
+                def run_piece(piece_interval_list_file, progress_callback):
+                    piece_out_filename = os.path.basename(cram_file_base) + "." + os.path.basename(piece_interval_list_file) + ".vcf.gz"
+                    piece_out_filename = piece_out_filename.replace(".bcf", "._cf")
+                    out_regions[piece_out_filename] = prefetch.read_regions(piece_interval_list_file)
+                    return gatk.haplotype_caller(ref_file, cram_file, piece_interval_list_file, os.path.join(out_dir, piece_out_filename),
+                                                 progress_callback=progress_callback)
+                gatk_exit = stragglers.run_chunk_in_pieces(interval_list_file, run_piece, pieces=straggler_pieces,
+                                                           checkpoint=checkpoint)
+            else:
+                out_regions[out_filename] = prefetch.read_regions(interval_list_file)
+                gatk_exit = gatk.haplotype_caller(ref_file, cram_file, interval_list_file, os.path.join(out_dir, out_filename))
+        prefetcher.stop()
+        if fetched and len(cram_files) > 1:
+            # free the scratch space for the next CRAM of the batch
+            os.remove(cram_file)
+            os.remove(cram_file + ".crai")
+        return gatk_exit
+
+    # if requested, keep each finished part (or, for a batch of CRAMs,
+    # each finished CRAM) in a checkpoint so that a rerun of this task
+    # only runs the parts still to do
+    checkpoint = None
+    if (straggler_pieces > 0 or len(cram_files) > 1) and checkpoints.checkpoints_requested():
+        checkpoint = checkpoints.TaskCheckpoint(out_dir)
+
+    gatk_exit = 0
+    for (cram_file, cram_file_base) in zip(cram_files, cram_file_bases):
+        if len(cram_files) > 1 and checkpoint is not None and checkpoint.completed(cram_file_base):
+            continue
+        gatk_exit = call_haplotypes(cram_file)
+        if gatk_exit != 0:
+            break
+        if len(cram_files) > 1 and checkpoint is not None:
+            checkpoint.add(cram_file_base, prefetch.read_regions(interval_list_file))
+    if checkpoint is not None:
+        out_regions.update(checkpoint.file_regions())
 
     if gatk_exit != 0:
         print "ERROR: GATK exited with exit code %s (NOT WRITING OUTPUT)" % gatk_exit
         arvados.api().job_tasks().update(uuid=arvados.current_task()['uuid'],
                                          body={'success':False}
                                          ).execute()
+    elif not vcf_stats.write_dir_stats(out_dir, regions=out_regions):
+        print "ERROR: GATK output failed validation (NOT WRITING OUTPUT)"
+        arvados.api().job_tasks().update(uuid=arvados.current_task()['uuid'],
+                                         body={'success':False}
+                                         ).execute()
     else:
         print "GATK exited successfully, writing output to keep"
 
@@ -74,17 +174,24 @@ def main():
         out = arvados.CollectionWriter()
 
         # Write out_dir to keep
-        out.write_directory_tree(out_dir)
+        with timing.span("write_directory_tree") as span:
+            out.write_directory_tree(out_dir)
+            span.add_bytes(timing.directory_size(out_dir))
+        timing.write_summary(out)
 
         # Commit the output to Keep.
-        output_locator = out.finish()
+        with timing.span("finish"):
+            output_locator = out.finish()
 
         print "Task output written to keep, validating it"
-        if validate_task_output(output_locator):
+        with timing.span("validate"):
+            output_valid = validate_task_output(output_locator)
+        if output_valid:
             print "Task output validated, setting output to %s" % (output_locator)
 
             # Use the resulting locator as the output for this task.
-            this_task.set_output(output_locator)
+            stragglers.set_task_output(output_locator)
+            stragglers.queue_speculative_duplicates()
         else:
             print "ERROR: Failed to validate task output (%s)" % (output_locator)
             arvados.api().job_tasks().update(uuid=arvados.current_task()['uuid'],
@@ -5,18 +5,13 @@ import arvados      # Import the Arvados sdk module
 import re
 import subprocess
 
+from hgi_arvados import errors
+from hgi_arvados import intervals
+from hgi_arvados import timing
+
 # the amount to weight each sequence contig
 weight_seq = 120000
 
-class InvalidArgumentError(Exception):
-    pass
-
-class FileAccessError(Exception):
-    pass
-
-class APIError(Exception):
-    pass
-
 def prepare_gatk_interval_list_collection(interval_list_coll):
     """
     Checks that the supplied interval_list_collection has the required 
@@ -32,9 +27,9 @@ def prepare_gatk_interval_list_collection(interval_list_coll):
             if re.search(r'\.interval_list$', ilf.name()):
                 interval_list[ils.name(), ilf.name()] = ilf
     if len(interval_list) < 1:
-        raise InvalidArgumentError("Expected an interval_list dict in interval_list_collection, but found none. Found [%s]" % ' '.join(ilf.name() for ilf in ils.all_files()))
+        raise errors.InvalidArgumentError("Expected an interval_list dict in interval_list_collection, but found none. Found [%s]" % ' '.join(ilf.name() for ilf in ils.all_files()))
     if len(interval_list) > 1:
-        raise InvalidArgumentError("Expected a single interval_list dict in interval_list_collection, but found multuple. Found [%s]" % ' '.join(ilf.name() for ilf in ils.all_files()))
+        raise errors.InvalidArgumentError("Expected a single interval_list dict in interval_list_collection, but found multuple. Found [%s]" % ' '.join(ilf.name() for ilf in ils.all_files()))
     for ((s_name, f_name), interval_list_f) in interval_list.items():
             ref_input = interval_list_f.as_manifest()
             break
@@ -55,9 +50,9 @@ def create_interval_lists(genome_chunks, interval_list_coll):
             if re.search(r'\.interval_list$', rf.name()):
                 interval_list.append(rf)
     if len(interval_list) < 1:
-        raise InvalidArgumentError("Interval_List collection does not contain any .interval_list files but one is required.")
+        raise errors.InvalidArgumentError("Interval_List collection does not contain any .interval_list files but one is required.")
     if len(interval_list) > 1:
-        raise InvalidArgumentError("Interval_List collection contains multiple .interval_list files but only one is allowed.")
+        raise errors.InvalidArgumentError("Interval_List collection contains multiple .interval_list files but only one is allowed.")
     interval_list_reader = interval_list[0]
 
     # Load the interval_list data
@@ -80,7 +75,7 @@ def create_interval_lists(genome_chunks, interval_list_coll):
     for interval_line in interval_list_lines:
         sn_start_stop_plus_target = interval_line.split("\t")
         if len(sn_start_stop_plus_target) != 5:
-            raise InvalidArgumentError("interval_list file had line with unexpected number of columns: [%s]" % interval_line)
+            raise errors.InvalidArgumentError("interval_list file had line with unexpected number of columns: [%s]" % interval_line)
         sn = sn_start_stop_plus_target[0]
         start = sn_start_stop_plus_target[1]
         stop = sn_start_stop_plus_target[2]
@@ -144,18 +139,95 @@ def create_interval_lists(genome_chunks, interval_list_coll):
     print "Chunk intervals collection saved as: %s" % (chunk_input_pdh)
     return chunk_input_pdh
 
+def read_single_interval_file(coll, seqdict=None):
+    """
+    Reads the single .interval_list (or, if seqdict is given, .bed) file
+    in the collection coll. Returns the file and its IntervalList.
+    """
+    rcr = arvados.CollectionReader(coll)
+    interval_files = []
+    for rs in rcr.all_streams():
+        for rf in rs.all_files():
+            if re.search(r'\.interval_list$', rf.name()) or (seqdict is not None and re.search(r'\.bed$', rf.name())):
+                interval_files.append(rf)
+    if len(interval_files) < 1:
+        raise errors.InvalidArgumentError("Collection %s does not contain any interval files but one is required." % (coll))
+    if len(interval_files) > 1:
+        raise errors.InvalidArgumentError("Collection %s contains multiple interval files but only one is allowed." % (coll))
+    interval_file = interval_files[0]
+    if re.search(r'\.bed$', interval_file.name()):
+        return (interval_file, intervals.read_bed(interval_file.readlines(), seqdict))
+    return (interval_file, intervals.read_interval_list(interval_file.readlines(), seqdict=seqdict))
+
+def create_processed_interval_lists(genome_chunks, interval_list_coll, padding=0, merge_intervals=False, blacklist_coll=None):
+    """
+    As create_interval_lists, but pads, merges and removes blacklisted
+    intervals from the targets first, and splits them with
+    IntervalList.partition (which does not charge the per-target weight
+    again for the remainder of a split target, so its chunk boundaries
+    differ from create_interval_lists').
+    """
+    interval_list_reader, interval_list = read_single_interval_file(interval_list_coll)
+    print "Read %s targets from %s" % (len(interval_list), interval_list_reader.name())
+
+    if padding > 0 or merge_intervals:
+        # padded targets are merged so that no base is called twice
+        interval_list = interval_list.pad(padding).merge()
+        print "Padded targets by %s and merged them into %s intervals" % (padding, len(interval_list))
+    if blacklist_coll:
+        blacklist_reader, blacklist = read_single_interval_file(blacklist_coll, seqdict=interval_list.seqdict)
+        interval_list = interval_list.subtract(blacklist)
+        print "Removed the %s intervals in %s, leaving %s intervals" % (len(blacklist), blacklist_reader.name(), len(interval_list))
+
+    # Chunk the genome into genome_chunks equally sized pieces and create intervals files
+    print "Total targets included: %s" % (len(interval_list))
+    print "Total genome length is %s" % interval_list.total_length()
+    chunks_c = arvados.collection.CollectionWriter(num_retries=3)
+    print "Chunking genome into %s chunks weighted by length plus %s points per target" % (genome_chunks, weight_seq)
+    for chunk_i, chunk_intervals in enumerate(interval_list.partition(genome_chunks, weight_seq)):
+        chunk_num = chunk_i + 1
+        chunk_input_name = interval_list_reader.name() + (".%s_of_%s.interval_list" % (chunk_num, genome_chunks))
+        print "Creating interval file for chunk %s" % chunk_num
+        chunks_c.start_new_file(newfilename=chunk_input_name)
+        chunks_c.write(chunk_intervals.to_interval_list(name_prefix="interval_%s_of_%s_" % (chunk_num, genome_chunks)))
+        if len(chunk_intervals) > 0:
+            print "Chunk intervals file %s saved." % (chunk_input_name)
+        else:
+            print "WARNING: skipping empty intervals for %s" % chunk_input_name
+    print "Finished, writing output collection!"
+    chunk_input_pdh = chunks_c.finish()
+    print "Chunk intervals collection saved as: %s" % (chunk_input_pdh)
+    return chunk_input_pdh
+
 def main():
     current_job = arvados.current_job()
 
     genome_chunks = int(current_job['script_parameters']['genome_chunks'])
     if genome_chunks < 1:
-        raise InvalidArgumentError("genome_chunks must be a positive integer")
+        raise errors.InvalidArgumentError("genome_chunks must be a positive integer")
 
     # Limit the scope of the interval_list collection to only those files relevant to gatk
-    il_input_pdh = prepare_gatk_interval_list_collection(interval_list_coll=current_job['script_parameters']['interval_list_collection'])
+    with timing.span("prepare interval list"):
+        il_input_pdh = prepare_gatk_interval_list_collection(interval_list_coll=current_job['script_parameters']['interval_list_collection'])
+
+    padding = 0
+    if 'padding' in current_job['script_parameters']:
+        padding = int(current_job['script_parameters']['padding'])
+    merge_intervals = False
+    if 'merge_intervals' in current_job['script_parameters']:
+        merge_intervals = str(current_job['script_parameters']['merge_intervals']).lower() == 'true'
+    blacklist_coll = None
+    if 'blacklist_collection' in current_job['script_parameters']:
+        blacklist_coll = current_job['script_parameters']['blacklist_collection']
 
     # Create an interval_list file for each chunk based on the .interval_list in the interval_list collection
-    output_locator = create_interval_lists(genome_chunks, il_input_pdh)
+    with timing.span("create interval lists"):
+        if padding > 0 or merge_intervals or blacklist_coll:
+            output_locator = create_processed_interval_lists(genome_chunks, il_input_pdh, padding=padding,
+                                                             merge_intervals=merge_intervals, blacklist_coll=blacklist_coll)
+        else:
+            # split as before, so that earlier chunks (and the tasks run on them) can be reused
+            output_locator = create_interval_lists(genome_chunks, il_input_pdh)
 
     # Use the resulting locator as the output for this task.
     arvados.current_task().set_output(output_locator)
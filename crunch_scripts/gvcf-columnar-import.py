@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+import os           # Import the os module for basic path manipulation
+import arvados      # Import the Arvados sdk module
+import re
+
+import hgi_arvados
+from hgi_arvados import gatk_helper
+from hgi_arvados import gvcf_columnar
+from hgi_arvados import validators
+from hgi_arvados import timing
+from hgi_arvados import vcf_stats
+
+def validate_task_output(output_locator):
+    print "Validating task output %s" % (output_locator)
+    return (validators.validate_compressed_indexed_vcf_collection(output_locator) and
+            validators.validate_gvcf_columnar_collection(output_locator))
+
+def one_task_per_gvcf_file(if_sequence=0, and_end_task=True):
+    """
+    Queue one task for each gVCF in this job's inputs_collection that
+    does not already have a columnar store. Each new task will have an
+    "input" parameter: a manifest containing the gVCF along with its
+    .tbi index and stats sidecar (if it has them), in its stream.
+    if_sequence and and_end_task arguments have the same significance
+    as in arvados.job_setup.one_task_per_input_file().
+    """
+    if if_sequence != arvados.current_task()['sequence']:
+        return
+
+    job_input = arvados.current_job()['script_parameters']['inputs_collection']
+    cr = arvados.CollectionReader(job_input)
+    gvcfs = {}
+    companions = {}
+    for s in cr.all_streams():
+        if timing.is_summary_path(s.name()):
+            continue
+        for f in s.all_files():
+            if re.search(r'\.vcf\.gz$', f.name()):
+                gvcfs[s.name(), f.name()] = f
+            else:
+                companions[s.name(), f.name()] = f
+
+    task_count = 0
+    for ((s_name, f_name), gvcf_f) in sorted(gvcfs.items()):
+        if (s_name, f_name + gvcf_columnar.GVCF_COLUMNAR_SUFFIX) in companions:
+            print "gVCF %s/%s already has a columnar store, skipping it" % (s_name, f_name)
+            continue
+        task_input = gvcf_f.as_manifest()
+        for suffix in [".tbi", vcf_stats.VCF_STATS_SUFFIX]:
+            companion_f = companions.get((s_name, f_name + suffix), None)
+            if companion_f:
+                task_input += companion_f.as_manifest()
+        r = arvados.api().collections().create(body={"manifest_text": task_input}).execute()
+        hgi_arvados.create_task(if_sequence + 1, {'input': r["portable_data_hash"]})
+        task_count += 1
+    print "Created %s tasks to import gVCFs" % (task_count)
+
+    if and_end_task:
+        print "Ending task 0 successfully"
+        arvados.api().job_tasks().update(uuid=arvados.current_task()['uuid'],
+                                         body={'success':True}
+                                         ).execute()
+        exit(0)
+
+def main():
+    ################################################################################
+    # Phase I: Create one task per gVCF in the inputs_collection
+    #          (and terminate if this is task 0)
+    ################################################################################
+    with timing.span("create tasks"):
+        one_task_per_gvcf_file(if_sequence=0, and_end_task=True)
+
+    # Get object representing the current task
+    this_task = arvados.current_task()
+
+    # We will never reach this point if we are in the 0th task sequence
+    assert(this_task['sequence'] > 0)
+
+    ################################################################################
+    # Phase II: Convert the gVCF to a columnar store
+    ################################################################################
+    with timing.span("mount inputs") as span:
+        gvcf_files = gatk_helper.mount_gatk_gvcf_inputs(inputs_param="input")
+        span.add_bytes(sum([timing.file_size(gvcf_file) for gvcf_file in gvcf_files]))
+    inputs_dir = arvados.get_task_param_mount("input")
+    out_dir = hgi_arvados.prepare_out_dir()
+
+    for gvcf_file in gvcf_files:
+        # keep the store in the same stream as its gVCF
+        store_file = os.path.join(out_dir, os.path.relpath(gvcf_file, inputs_dir) + gvcf_columnar.GVCF_COLUMNAR_SUFFIX)
+        if not os.path.isdir(os.path.dirname(store_file)):
+            os.makedirs(os.path.dirname(store_file))
+        with timing.span("run tool") as span:
+            records = gvcf_columnar.write_store(gvcf_file, store_file)
+            span.add_bytes(timing.file_size(gvcf_file))
+        print "Wrote columnar store %s with %s records (%s bytes, gVCF was %s bytes)" % (
+            store_file, records, timing.file_size(store_file), timing.file_size(gvcf_file))
+
+    # Write a new collection as output
+    out = arvados.CollectionWriter()
+
+    # Write out_dir to keep
+    with timing.span("write_directory_tree") as span:
+        out.write_directory_tree(out_dir)
+        span.add_bytes(timing.directory_size(out_dir))
+    timing.write_summary(out)
+
+    # Commit the output to Keep, along with the input gVCF and its index
+    # and sidecars so that the stores travel with their gVCFs
+    with timing.span("finish"):
+        store_locator = out.finish()
+        manifest_text = arvados.CollectionReader(this_task['parameters']['input']).manifest_text()
+        manifest_text += arvados.CollectionReader(store_locator).manifest_text()
+        r = arvados.api().collections().create(body={"manifest_text": manifest_text}).execute()
+        output_locator = r["portable_data_hash"]
+
+    with timing.span("validate"):
+        output_valid = validate_task_output(output_locator)
+    if output_valid:
+        print "Task output validated, setting output to %s" % (output_locator)
+
+        # Use the resulting locator as the output for this task.
+        this_task.set_output(output_locator)
+    else:
+        print "ERROR: Failed to validate task output (%s)" % (output_locator)
+        arvados.api().job_tasks().update(uuid=this_task['uuid'],
+                                         body={'success':False}
+                                         ).execute()
+
+    # Done!
+
+
+if __name__ == '__main__':
+    main()
@@ -25,13 +25,78 @@ import arvados      # Import the Arvados sdk module
 import re
 import sys
 import json
+import time
+import signal
+import hashlib
+import subprocess
 
+_import_started = time.time()
 import gatk_helper
+import gvcf_columnar
+import timing
+import vcf_stats
 
 import errors
-__all__ = ["errors", "gatk", "gatk_helper", "validators"]
+timing.record_import("hgi_arvados", time.time() - _import_started)
+__all__ = ["bgzf", "checkpoints", "cram_slice", "errors", "gatk", "gatk_helper", "gvcf_columnar", "intervals", "prefetch", "reference", "sequence_dictionary", "report", "runtime_model", "stragglers", "timing", "validators", "vcf_stats"]
+
+# Portable data hash of the empty collection, the output of tasks that
+# finish without doing any work of their own
+EMPTY_COLLECTION_PDH = "d41d8cd98f00b204e9800998ecf8427e+0"
+
+# Task parameter holding the key of a task created by a fan-out, which
+# is the same however many times the task creating it is run
+FANOUT_KEY_PARAM = "fanout_key"
+
+# Task parameters that are not part of a task's fan-out key (including
+# runtime_model's prediction, which can change between runs)
+FANOUT_KEY_IGNORED_PARAMS = [FANOUT_KEY_PARAM, "reuse_job_task", "predicted_runtime"]
+
+# Fan-out keys of the tasks created by earlier runs of the current task,
+# by sequence
+_earlier_fanout_keys = {}
+
+# Tools started by start_tool that may still be running
+_tool_processes = []
+
+def fanout_key(params):
+    """
+    Returns the fan-out key of a task with parameters params: a digest
+    of all of them except FANOUT_KEY_IGNORED_PARAMS.
+    """
+    key_params = dict([(k, v) for (k, v) in params.items() if k not in FANOUT_KEY_IGNORED_PARAMS])
+    return hashlib.md5(json.dumps(key_params, sort_keys=True)).hexdigest()
+
+def task_already_created(sequence, params):
+    """
+    Sets the fan-out key parameter of params and returns True if an
+    earlier run of the current task (e.g. one that died part way through
+    a fan-out) already created a task at sequence with the same key, in
+    which case it should not be created again. The tasks created earlier
+    are listed once per sequence.
+    """
+    if sequence not in _earlier_fanout_keys:
+        keys = set()
+        for task in list_all_by_uuid(arvados.api().job_tasks(),
+                                     filters=[['created_by_job_task_uuid', '=', arvados.current_task()['uuid']],
+                                              ['sequence', '=', str(sequence)]],
+                                     select=['uuid', 'parameters']):
+            if FANOUT_KEY_PARAM in task['parameters']:
+                keys.add(task['parameters'][FANOUT_KEY_PARAM])
+        if len(keys) > 0:
+            print "Have %s tasks at sequence %s created by an earlier run of this task, not creating them again" % (len(keys), sequence)
+        _earlier_fanout_keys[sequence] = keys
+    params[FANOUT_KEY_PARAM] = fanout_key(params)
+    return params[FANOUT_KEY_PARAM] in _earlier_fanout_keys[sequence]
 
 def create_task(sequence, params):
+    """
+    Creates a task at sequence with parameters params, unless an earlier
+    run of the current task already created it (see task_already_created),
+    in which case returns None.
+    """
+    if task_already_created(sequence, params):
+        return None
     new_task_attrs = {
         'job_uuid': arvados.current_job()['uuid'],
         'created_by_job_task_uuid': arvados.current_task()['uuid'],
@@ -46,11 +111,14 @@ def chunked_tasks_per_cram_file(ref_input, job_input, interval_lists, validate_t
                                 reuse_tasks=True, reuse_tasks_retrieve_all=True,
                                 interval_list_param="interval_list",
                                 oldest_git_commit_to_reuse='6ca726fc265f9e55765bf1fdf71b86285b8a0ff2',
-                                script=arvados.current_job()['script']):
+                                script=None, crams_per_task=1):
     """
     Queue one task for each cram file in this job's input collection.
     Each new task will have an "input" parameter: a manifest
     containing one .cram file and its corresponding .crai index file.
+    If crams_per_task is more than one, each task gets that many
+    .cram files (and their .crai files) instead, so that small (e.g.
+    exome) samples do not each pay the overhead of a task per chunk.
     Files in the input collection that are not named *.cram or *.crai
     (as well as *.crai files that do not match any .cram file present)
     are silently ignored.
@@ -60,6 +128,12 @@ def chunked_tasks_per_cram_file(ref_input, job_input, interval_lists, validate_t
     if if_sequence != arvados.current_task()['sequence']:
         return
 
+    if script is None:
+        script = arvados.current_job()['script']
+
+    if crams_per_task < 1:
+        raise errors.InvalidArgumentError("crams_per_task must be at least 1 (got %s)" % (crams_per_task))
+
     # prepare interval lists
     cr = arvados.CollectionReader(interval_lists)
     chunk_interval_list = {}
@@ -91,16 +165,25 @@ def chunked_tasks_per_cram_file(ref_input, job_input, interval_lists, validate_t
                 cram[s.name(), f.name()] = f
             elif re.search(r'\.crai$', f.name()):
                 crai[s.name(), f.name()] = f
-    for ((s_name, f_name), cram_f) in cram.items():
+    # imported here as runtime_model itself imports hgi_arvados
+    from hgi_arvados import runtime_model
+    cram_inputs = []
+    for ((s_name, f_name), cram_f) in sorted(cram.items()):
         crai_f = crai.get((s_name, re.sub(r'cram$', 'crai', f_name)),
                           crai.get((s_name, re.sub(r'cram$', 'cram.crai', f_name)),
                                    None))
-        task_input = cram_f.as_manifest()
-        if crai_f:
-            task_input += crai_f.as_manifest()
-        else:
+        if not crai_f:
             # no CRAI for CRAM
             raise errors.InvalidArgumentError("No correponding CRAI file found for CRAM file %s" % f_name)
+        cram_inputs.append((f_name, cram_f.as_manifest() + crai_f.as_manifest(), cram_f.size()))
+
+    new_tasks = []
+    for batch_start in range(0, len(cram_inputs), crams_per_task):
+        # each task calls crams_per_task CRAMs (usually just one)
+        batch = cram_inputs[batch_start:batch_start + crams_per_task]
+        f_name = ', '.join([batch_f_name for (batch_f_name, batch_input, batch_size) in batch])
+        task_input = ''.join([batch_input for (batch_f_name, batch_input, batch_size) in batch])
+        task_input_bytes = sum([batch_size for (batch_f_name, batch_input, batch_size) in batch])
 
         # Create a portable data hash for the task's subcollection
         try:
@@ -109,39 +192,52 @@ def chunked_tasks_per_cram_file(ref_input, job_input, interval_lists, validate_t
         except:
             raise
 
-        if reuse_tasks:
-            task_key_params=['input', 'ref', 'chunk']
-            # get candidates for task reuse
-            job_filters = [
-                ['script', '=', script],
-                ['repository', '=', arvados.current_job()['repository']],
-                ['script_version', 'in git', oldest_git_commit_to_reuse],
-                ['docker_image_locator', 'in docker', arvados.current_job()['docker_image_locator']],
-            ]
-            if reuse_tasks_retrieve_all:
-                # retrieve a full set of all possible reusable tasks
-                reusable_tasks = get_reusable_tasks(if_sequence + 1, task_key_params, job_filters)
-                print "Have %s tasks for potential reuse" % (len(reusable_tasks))
-            else:
-                reusable_task_jobs = get_jobs_for_task_reuse(job_filters)
-                print "Have %s jobs for potential task reuse" % (len(reusable_task_jobs))
-                reusable_task_job_uuids = [job['uuid'] for job in reusable_task_jobs['items']]
-
         for chunk_input_pdh, chunk_input_name in chunk_input_pdh_names:
-            # Create task for each CRAM / chunk
-            new_task_params = {
+            # Queue a task for each CRAM (or batch of CRAMs) / chunk
+            new_tasks.append(({
                 'input': task_input_pdh,
                 'ref': ref_input,
-                'chunk': chunk_input_pdh
-            }
-            print "Creating new task to process %s with chunk interval %s " % (f_name, chunk_input_name)
-            if reuse_tasks:
-                if reuse_tasks_retrieve_all:
-                    task = create_or_reuse_task(if_sequence + 1, new_task_params, reusable_tasks, task_key_params, validate_task_output)
-                else:
-                    task = create_or_reuse_task_from_jobs(if_sequence + 1, new_task_params, reusable_task_job_uuids, task_key_params, validate_task_output)
+                'chunk': chunk_input_pdh,
+                runtime_model.INPUT_BYTES_PARAM: task_input_bytes
+            }, f_name, chunk_input_name))
+
+    # Create the tasks expected to run longest first, as they are started
+    # in the order they are created
+    model = runtime_model.RuntimeModel([['script', '=', script],
+                                        ['repository', '=', arvados.current_job()['repository']]],
+                                       if_sequence + 1, 'chunk')
+    names = dict([((new_task_params['input'], new_task_params['chunk']), (f_name, chunk_input_name))
+                  for (new_task_params, f_name, chunk_input_name) in new_tasks])
+    ordered_params = model.longest_first([new_task_params for (new_task_params, f_name, chunk_input_name) in new_tasks])
+
+    if reuse_tasks:
+        task_key_params=['input', 'ref', 'chunk']
+        # get candidates for task reuse
+        job_filters = [
+            ['script', '=', script],
+            ['repository', '=', arvados.current_job()['repository']],
+            ['script_version', 'in git', oldest_git_commit_to_reuse],
+            ['docker_image_locator', 'in docker', arvados.current_job()['docker_image_locator']],
+        ]
+        if reuse_tasks_retrieve_all:
+            # retrieve a full set of all possible reusable tasks
+            reusable_tasks = get_reusable_tasks(if_sequence + 1, task_key_params, job_filters)
+            print "Have %s tasks for potential reuse" % (len(reusable_tasks))
+        else:
+            reusable_task_jobs = get_jobs_for_task_reuse(job_filters)
+            print "Have %s jobs for potential task reuse" % (len(reusable_task_jobs))
+            reusable_task_job_uuids = [job['uuid'] for job in reusable_task_jobs['items']]
+
+    for new_task_params in ordered_params:
+        (f_name, chunk_input_name) = names[new_task_params['input'], new_task_params['chunk']]
+        print "Creating new task to process %s with chunk interval %s (predicted run time in seconds: %s)" % (f_name, chunk_input_name, new_task_params.get(runtime_model.PREDICTED_RUNTIME_PARAM, "unknown"))
+        if reuse_tasks:
+            if reuse_tasks_retrieve_all:
+                task = create_or_reuse_task(if_sequence + 1, new_task_params, reusable_tasks, task_key_params, validate_task_output)
             else:
-                task = create_task(if_sequence + 1, new_task_params)
+                task = create_or_reuse_task_from_jobs(if_sequence + 1, new_task_params, reusable_task_job_uuids, task_key_params, validate_task_output)
+        else:
+            task = create_task(if_sequence + 1, new_task_params)
 
     if and_end_task:
         print "Ending task 0 successfully"
@@ -155,7 +251,7 @@ def chunked_tasks_per_bam_file(ref_input, job_input, interval_lists, validate_ta
                                 reuse_tasks=True, reuse_tasks_retrieve_all=True,
                                 interval_list_param="interval_list",
                                 oldest_git_commit_to_reuse='6ca726fc265f9e55765bf1fdf71b86285b8a0ff2',
-                                script=arvados.current_job()['script']):
+                                script=None):
     """
     Queue one task for each bam file in this job's input collection.
     Each new task will have an "input" parameter: a manifest
@@ -169,6 +265,9 @@ def chunked_tasks_per_bam_file(ref_input, job_input, interval_lists, validate_ta
     if if_sequence != arvados.current_task()['sequence']:
         return
 
+    if script is None:
+        script = arvados.current_job()['script']
+
     # prepare interval lists
     cr = arvados.CollectionReader(interval_lists)
     chunk_interval_list = {}
@@ -200,6 +299,9 @@ def chunked_tasks_per_bam_file(ref_input, job_input, interval_lists, validate_ta
                 bam[s.name(), f.name()] = f
             elif re.search(r'\.bai$', f.name()):
                 bai[s.name(), f.name()] = f
+    # imported here as runtime_model itself imports hgi_arvados
+    from hgi_arvados import runtime_model
+    new_tasks = []
     for ((s_name, f_name), bam_f) in bam.items():
         bai_f = bai.get((s_name, re.sub(r'bam$', 'bai', f_name)),
                           bai.get((s_name, re.sub(r'bam$', 'bam.bai', f_name)),
@@ -218,39 +320,52 @@ def chunked_tasks_per_bam_file(ref_input, job_input, interval_lists, validate_ta
         except:
             raise
 
-        if reuse_tasks:
-            task_key_params=['input', 'ref', 'chunk']
-            # get candidates for task reuse
-            job_filters = [
-                ['script', '=', script],
-                ['repository', '=', arvados.current_job()['repository']],
-                ['script_version', 'in git', oldest_git_commit_to_reuse],
-                ['docker_image_locator', 'in docker', arvados.current_job()['docker_image_locator']],
-            ]
-            if reuse_tasks_retrieve_all:
-                # retrieve a full set of all possible reusable tasks
-                reusable_tasks = get_reusable_tasks(if_sequence + 1, task_key_params, job_filters)
-                print "Have %s tasks for potential reuse" % (len(reusable_tasks))
-            else:
-                reusable_task_jobs = get_jobs_for_task_reuse(job_filters)
-                print "Have %s jobs for potential task reuse" % (len(reusable_task_jobs))
-                reusable_task_job_uuids = [job['uuid'] for job in reusable_task_jobs['items']]
-
         for chunk_input_pdh, chunk_input_name in chunk_input_pdh_names:
-            # Create task for each BAM / chunk
-            new_task_params = {
+            # Queue a task for each BAM / chunk
+            new_tasks.append(({
                 'input': task_input_pdh,
                 'ref': ref_input,
-                'chunk': chunk_input_pdh
-            }
-            print "Creating new task to process %s with chunk interval %s " % (f_name, chunk_input_name)
-            if reuse_tasks:
-                if reuse_tasks_retrieve_all:
-                    task = create_or_reuse_task(if_sequence + 1, new_task_params, reusable_tasks, task_key_params, validate_task_output)
-                else:
-                    task = create_or_reuse_task_from_jobs(if_sequence + 1, new_task_params, reusable_task_job_uuids, task_key_params, validate_task_output)
+                'chunk': chunk_input_pdh,
+                runtime_model.INPUT_BYTES_PARAM: bam_f.size()
+            }, f_name, chunk_input_name))
+
+    # Create the tasks expected to run longest first, as they are started
+    # in the order they are created
+    model = runtime_model.RuntimeModel([['script', '=', script],
+                                        ['repository', '=', arvados.current_job()['repository']]],
+                                       if_sequence + 1, 'chunk')
+    names = dict([((new_task_params['input'], new_task_params['chunk']), (f_name, chunk_input_name))
+                  for (new_task_params, f_name, chunk_input_name) in new_tasks])
+    ordered_params = model.longest_first([new_task_params for (new_task_params, f_name, chunk_input_name) in new_tasks])
+
+    if reuse_tasks:
+        task_key_params=['input', 'ref', 'chunk']
+        # get candidates for task reuse
+        job_filters = [
+            ['script', '=', script],
+            ['repository', '=', arvados.current_job()['repository']],
+            ['script_version', 'in git', oldest_git_commit_to_reuse],
+            ['docker_image_locator', 'in docker', arvados.current_job()['docker_image_locator']],
+        ]
+        if reuse_tasks_retrieve_all:
+            # retrieve a full set of all possible reusable tasks
+            reusable_tasks = get_reusable_tasks(if_sequence + 1, task_key_params, job_filters)
+            print "Have %s tasks for potential reuse" % (len(reusable_tasks))
+        else:
+            reusable_task_jobs = get_jobs_for_task_reuse(job_filters)
+            print "Have %s jobs for potential task reuse" % (len(reusable_task_jobs))
+            reusable_task_job_uuids = [job['uuid'] for job in reusable_task_jobs['items']]
+
+    for new_task_params in ordered_params:
+        (f_name, chunk_input_name) = names[new_task_params['input'], new_task_params['chunk']]
+        print "Creating new task to process %s with chunk interval %s (predicted run time in seconds: %s)" % (f_name, chunk_input_name, new_task_params.get(runtime_model.PREDICTED_RUNTIME_PARAM, "unknown"))
+        if reuse_tasks:
+            if reuse_tasks_retrieve_all:
+                task = create_or_reuse_task(if_sequence + 1, new_task_params, reusable_tasks, task_key_params, validate_task_output)
             else:
-                task = create_task(if_sequence + 1, new_task_params)
+                task = create_or_reuse_task_from_jobs(if_sequence + 1, new_task_params, reusable_task_job_uuids, task_key_params, validate_task_output)
+        else:
+            task = create_task(if_sequence + 1, new_task_params)
 
     if and_end_task:
         print "Ending task 0 successfully"
@@ -292,6 +407,10 @@ def one_task_per_gvcf_group_in_stream(stream_name, gvcf_by_group, gvcf_indices,
                 # no index for gVCF - TODO: should this be an error or warning?
                 print "WARNING: No correponding .tbi index file found for gVCF file %s" % gvcf_name
                 #raise errors.InvalidArgumentError("No correponding .tbi index file found for gVCF file %s" % gvcf_name)
+            for suffix in [vcf_stats.VCF_STATS_SUFFIX, gvcf_columnar.GVCF_COLUMNAR_SUFFIX]:
+                gvcf_companion_f = gvcf_indices.get((s_name, gvcf_name + suffix), None)
+                if gvcf_companion_f:
+                    task_inputs_manifest += gvcf_companion_f.as_manifest()
 
         # Create a portable data hash for the task's subcollection
         try:
@@ -348,6 +467,10 @@ def one_task_per_gvcf_group_in_stream_combined_inputs(stream_name, gvcf_by_group
                 # no index for gVCF - TODO: should this be an error or warning?
                 print "WARNING: No correponding .tbi index file found for gVCF file %s" % gvcf_name
                 #raise errors.InvalidArgumentError("No correponding .tbi index file found for gVCF file %s" % gvcf_name)
+            for suffix in [vcf_stats.VCF_STATS_SUFFIX, gvcf_columnar.GVCF_COLUMNAR_SUFFIX]:
+                gvcf_companion_f = gvcf_indices.get((s_name, gvcf_name + suffix), None)
+                if gvcf_companion_f:
+                    task_inputs_manifest += gvcf_companion_f.as_manifest()
 
         # Create a portable data hash for the task's subcollection
         try:
@@ -430,6 +553,9 @@ def one_task_per_group_and_per_n_gvcfs(ref_input, job_input, interval_lists, gro
     gvcf_by_group = {}
     gvcf_indices = {}
     for s in sorted(cr.all_streams(), key=lambda stream: stream.name()):
+        # skip timing summaries written into the outputs of earlier jobs
+        if timing.is_summary_path(s.name()):
+            continue
         stream_name = s.name()
         # handle each stream name separately
         if stream_name != last_stream_name:
@@ -445,7 +571,8 @@ def one_task_per_group_and_per_n_gvcfs(ref_input, job_input, interval_lists, gro
 
         # loop over all the files in this stream (there may be only one)
         for f in s.all_files():
-            if re.search(r'\.tbi$', f.name()):
+            # stats sidecars and columnar stores travel with their gVCF, as the index does
+            if re.search(r'\.tbi$', f.name()) or vcf_stats.is_stats_path(f.name()) or gvcf_columnar.is_store_path(f.name()):
                 gvcf_indices[s.name(), f.name()] = f
                 continue
             m = re.search(group_by_r, f.name())
@@ -537,6 +664,9 @@ def one_task_per_group_combined_inputs(ref_input, job_input, interval_lists, gro
     gvcf_by_group = {}
     gvcf_indices = {}
     for s in sorted(cr.all_streams(), key=lambda stream: stream.name()):
+        # skip timing summaries written into the outputs of earlier jobs
+        if timing.is_summary_path(s.name()):
+            continue
         stream_name = s.name()
         # handle each stream name separately
         if stream_name != last_stream_name:
@@ -552,7 +682,8 @@ def one_task_per_group_combined_inputs(ref_input, job_input, interval_lists, gro
 
         # loop over all the files in this stream (there may be only one)
         for f in s.all_files():
-            if re.search(r'\.tbi$', f.name()):
+            # stats sidecars and columnar stores travel with their gVCF, as the index does
+            if re.search(r'\.tbi$', f.name()) or vcf_stats.is_stats_path(f.name()) or gvcf_columnar.is_store_path(f.name()):
                 gvcf_indices[s.name(), f.name()] = f
                 continue
             m = re.search(group_by_r, f.name())
@@ -600,7 +731,7 @@ def one_task_per_interval(interval_count, validate_task_output,
                           interval_list_param="interval_list",
                           oldest_git_commit_to_reuse='6ca726fc265f9e55765bf1fdf71b86285b8a0ff2',
                           task_key_params=['name', 'inputs', 'interval', 'ref'],
-                          script=arvados.current_job()['script']):
+                          script=None):
     """
     Queue one task for each of interval_count intervals, splitting
     the genome chunk (described by the .interval_list file) evenly.
@@ -620,59 +751,24 @@ def one_task_per_interval(interval_count, validate_task_output,
     if if_sequence != arvados.current_task()['sequence']:
         return
 
+    if script is None:
+        script = arvados.current_job()['script']
+
     interval_list_file = gatk_helper.mount_single_gatk_interval_list_input(interval_list_param=interval_list_param)
 
-    interval_reader = open(interval_list_file, mode="r")
+    # imported here so that scripts that never split intervals do not need numpy
+    from hgi_arvados import intervals as interval_lists
+    with open(interval_list_file, mode="r") as interval_reader:
+        interval_list = interval_lists.read_interval_list(interval_reader.readlines())
 
-    lines = interval_reader.readlines()
-    sn_intervals = dict()
-    sns = []
-    total_len = 0
-    for line in lines:
-        if line[0] == '@':
-            # skip all lines starting with '@'
-            continue
-        fields = line.split("\t")
-        if len(fields) != 5:
-            raise errors.InvalidArgumentError("interval_list %s has invalid line [%s] - expected 5 fields but got %s" % (interval_list_file, line, len(fields)))
-        sn = fields[0]
-        start = int(fields[1])
-        end = int(fields[2])
-        length = int(end) - int(start) + 1
-        total_len += int(length)
-        sn_intervals[sn] = (start, end)
-        sns.append(sn)
-
-    print "Total chunk length is %s" % total_len
-    interval_len = int(total_len / interval_count)
+    print "Total chunk length is %s" % interval_list.total_length()
+    print "Splitting chunk into %s intervals of size ~%s" % (interval_count, int(interval_list.total_length() / interval_count))
     intervals = []
-    print "Splitting chunk into %s intervals of size ~%s" % (interval_count, interval_len)
-    for interval_i in range(0, interval_count):
-        interval_num = interval_i + 1
-        intervals_count = 0
-        remaining_len = interval_len
-        interval = []
-        while len(sns) > 0:
-            sn = sns.pop(0)
-            if not sn_intervals.has_key(sn):
-                raise errors.ValueError("sn_intervals missing entry for sn [%s]" % sn)
-            start, end = sn_intervals[sn]
-            if (end-start+1) > remaining_len:
-                # not enough space for the whole sq, split it
-                real_end = end
-                end = remaining_len + start - 1
-                assert((end-start+1) <= remaining_len)
-                sn_intervals[sn] = (end+1, real_end)
-                sns.insert(0, sn)
-            interval.append("%s:%s-%s" % (sn, start, end))
-            remaining_len -= (end-start+1)
-            intervals_count += 1
-            if remaining_len <= 0:
-                break
-        if intervals_count > 0:
-            intervals.append(interval)
+    for interval_i, interval in enumerate(interval_list.partition(interval_count)):
+        if len(interval) > 0:
+            intervals.append(interval.region_strings())
         else:
-            print "WARNING: skipping empty intervals for %s" % interval_input_name
+            print "WARNING: skipping empty interval %s of %s" % (interval_i + 1, interval_count)
     print "Have %s intervals" % (len(intervals))
 
     if reuse_tasks:
@@ -686,11 +782,21 @@ def one_task_per_interval(interval_count, validate_task_output,
         reusable_tasks = get_reusable_tasks(if_sequence + 1, task_key_params, job_filters)
         print "Have %s potentially reusable tasks" % (len(reusable_tasks))
 
+    # Create the tasks expected to run longest first, as they are started
+    # in the order they are created
+    from hgi_arvados import runtime_model
+    model = runtime_model.RuntimeModel([['script', '=', script],
+                                        ['repository', '=', arvados.current_job()['repository']]],
+                                       if_sequence + 1, 'interval')
+    new_tasks = []
     for interval in intervals:
-        interval_str = ' '.join(interval)
-        print "Creating task to process interval: [%s]" % interval_str
-        new_task_params = arvados.current_task()['parameters']
-        new_task_params['interval'] = interval_str
+        new_task_params = dict(arvados.current_task()['parameters'])
+        new_task_params.pop(runtime_model.PREDICTED_RUNTIME_PARAM, None)
+        new_task_params['interval'] = ' '.join(interval)
+        new_tasks.append(new_task_params)
+
+    for new_task_params in model.longest_first(new_tasks):
+        print "Creating task to process interval: [%s] (predicted run time in seconds: %s)" % (new_task_params['interval'], new_task_params.get(runtime_model.PREDICTED_RUNTIME_PARAM, "unknown"))
         if reuse_tasks:
             task = create_or_reuse_task(if_sequence + 1, new_task_params, reusable_tasks, task_key_params, validate_task_output)
         else:
@@ -735,6 +841,34 @@ def execute_list_all(api_obj, **kwargs):
     results['items'] = _gen_items(first_batch, batch_size, offset, num_retries, limit)
     return results
 
+def list_all_by_uuid(api_obj, filters=None, select=None, batch_size=1000, num_retries=3):
+    """
+    Yields every item of api_obj matching filters. Unlike
+    execute_list_all, pages are fetched in uuid order by filtering on
+    uuid > the last uuid seen rather than by offset, and without asking
+    for items_available, so that each page costs the API server the same
+    however far into a listing of (say) 100k job_tasks it is.
+    """
+    filters = list(filters or [])
+    if select is not None and 'uuid' not in select:
+        select = list(select) + ['uuid']
+    last_uuid = None
+    while True:
+        page_filters = filters
+        if last_uuid is not None:
+            page_filters = filters + [['uuid', '>', last_uuid]]
+        kwargs = {'filters': page_filters, 'order': ['uuid asc'], 'limit': batch_size, 'count': 'none'}
+        if select is not None:
+            kwargs['select'] = select
+        items = api_obj.list(**kwargs).execute(num_retries=num_retries)['items']
+        if len(items) == 0:
+            # the server may return fewer than batch_size items per page,
+            # so only an empty page marks the end of the listing
+            break
+        for item in items:
+            yield item
+        last_uuid = items[-1]['uuid']
+
 def get_jobs_for_task_reuse(job_filters):
     print "Querying API server for jobs matching filters %s" % (json.dumps(job_filters))
     jobs = execute_list_all(arvados.api().jobs(), filters=job_filters, distinct=True, select=['uuid'])
@@ -742,10 +876,13 @@ def get_jobs_for_task_reuse(job_filters):
 
 
 def create_or_reuse_task_from_jobs(sequence, parameters, reusable_task_job_uuids, task_key_params, validate_task_output):
+    if task_already_created(sequence, parameters):
+        return None
     reusable_tasks = {}
     task_filters = [
         ['sequence', '=', str(sequence)],
         ['success', '=', 'True'],
+        ['output', '!=', EMPTY_COLLECTION_PDH],
     ]
     # create horrible 'like' filters to match each task parameter (assumes they are stored as YAML)
     for param in task_key_params:
@@ -790,6 +927,7 @@ def get_reusable_tasks(sequence, task_key_params, job_filters):
         ['job_uuid', 'in', [job['uuid'] for job in jobs['items']]],
         ['sequence', '=', str(sequence)],
         ['success', '=', 'True'],
+        ['output', '!=', EMPTY_COLLECTION_PDH],
     ]
     #print "Querying API server for tasks matching filters %s" % (json.dumps(task_filters))
     tasks = execute_list_all(arvados.api().job_tasks(),
@@ -820,6 +958,8 @@ def get_reusable_tasks(sequence, task_key_params, job_filters):
 
 
 def create_or_reuse_task(sequence, parameters, reusable_tasks, task_key_params, validate_task_output):
+    if task_already_created(sequence, parameters):
+        return None
     new_task_attrs = {
             'job_uuid': arvados.current_job()['uuid'],
             'created_by_job_task_uuid': arvados.current_task()['uuid'],
@@ -843,6 +983,8 @@ def create_or_reuse_task(sequence, parameters, reusable_tasks, task_key_params,
             # crunch seems to ignore the fact that the job says it is done and queue it anyway
             # signal ourselves to just immediately exit successfully when we are run
             new_task_attrs['parameters']['reuse_job_task'] = reuse_task['uuid']
+            # keep the key of this task, not of the task being reused
+            new_task_attrs['parameters'][FANOUT_KEY_PARAM] = parameters[FANOUT_KEY_PARAM]
         else:
             print "Output %s for potential task reuse did not validate" % (reuse_task['output'])
     else:
@@ -871,6 +1013,27 @@ def prepare_out_dir():
         raise
     return out_dir
 
+def start_tool(args, **kwargs):
+    """
+    Starts a tool as subprocess.Popen(args, **kwargs) would, but in its
+    own process group, so that kill_tools can end it along with anything
+    it has started.
+    """
+    tool_p = subprocess.Popen(args, preexec_fn=os.setpgrp, **kwargs)
+    _tool_processes[:] = [p for p in _tool_processes if p.poll() is None] + [tool_p]
+    return tool_p
+
+def kill_tools():
+    """
+    Kills the process group of every tool started by start_tool that is
+    still running.
+    """
+    for tool_p in _tool_processes:
+        if tool_p.poll() is None:
+            try:
+                os.killpg(tool_p.pid, signal.SIGKILL)
+            except OSError as e:
+                print "WARNING: could not kill process group %s: %s" % (tool_p.pid, e)
 
 if __name__ == '__main__':
     print "This module is not intended to be executed as a script"
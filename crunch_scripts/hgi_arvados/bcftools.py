@@ -5,6 +5,7 @@ import arvados      # Import the Arvados sdk module
 import re
 import subprocess
 
+import hgi_arvados
 from hgi_arvados import errors
 
 def _execute(bcftools_args, **kwargs):
@@ -12,7 +13,7 @@ def _execute(bcftools_args, **kwargs):
     if len(kwargs) > 0:
         print "Extraneous keyword arguments passed to _execute: %s" %(kwargs)
     print "Calling %s%s" % (output_prefix, bcftools_args)
-    bcftools_p = subprocess.Popen(
+    bcftools_p = hgi_arvados.start_tool(
         bcftools_args,
         stdin=None,
         stdout=subprocess.PIPE,
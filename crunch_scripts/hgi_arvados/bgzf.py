@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+import os           # Import the os module for basic path manipulation
+import sys
+import zlib
+import gzip
+import struct
+import collections
+from StringIO import StringIO
+from multiprocessing import Pool, cpu_count
+
+from hgi_arvados import errors
+
+# gzip magic, deflate method and FEXTRA flag that start every BGZF block
+BGZF_MAGIC = "\x1f\x8b\x08\x04"
+
+# size of the fixed part of a BGZF block header (up to and including XLEN)
+BGZF_HEADER_SIZE = 12
+
+# size of the CRC32 and ISIZE that end every BGZF block
+BGZF_FOOTER_SIZE = 8
+
+# largest possible BGZF block
+BGZF_MAX_BLOCK_SIZE = 65536
+
+# bytes read from the file at a time while scanning it
+SCAN_READ_SIZE = 8 * 1024 * 1024
+
+# compressed bytes of whole blocks handed to a worker at a time
+SCAN_BATCH_SIZE = 4 * 1024 * 1024
+
+# pseudo-bin holding metadata rather than chunks in a tabix/BAM index
+TBI_META_BIN = 37450
+
+def _block_size(data, pos):
+    # returns the total size of the BGZF block whose header starts at pos
+    if len(data) - pos < BGZF_HEADER_SIZE or data[pos:pos + 4] != BGZF_MAGIC:
+        return None
+    (xlen,) = struct.unpack_from("<H", data, pos + 10)
+    extra_pos = pos + BGZF_HEADER_SIZE
+    extra_end = extra_pos + xlen
+    if extra_end > len(data):
+        return None
+    while extra_pos + 4 <= extra_end:
+        (si1, si2, slen) = struct.unpack_from("<ccH", data, extra_pos)
+        if si1 == "B" and si2 == "C" and slen == 2:
+            (bsize,) = struct.unpack_from("<H", data, extra_pos + 4)
+            return bsize + 1
+        extra_pos += 4 + slen
+    return None
+
+def check_blocks(batch, text_function=None):
+    """
+    Inflates each block of a batch (base_offset, data, [(start, size)])
+    and checks its CRC32 and ISIZE. Returns (isizes, error, result),
+    where error is None or a description of the first bad block and
+    result is what text_function (if given) returns for the inflated
+    data of the whole batch.
+    """
+    (base_offset, data, blocks) = batch
+    isizes = []
+    udatas = []
+    for (start, size) in blocks:
+        (xlen,) = struct.unpack_from("<H", data, start + 10)
+        cdata = data[start + BGZF_HEADER_SIZE + xlen:start + size - BGZF_FOOTER_SIZE]
+        (crc, isize) = struct.unpack_from("<II", data, start + size - BGZF_FOOTER_SIZE)
+        try:
+            inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+            udata = inflater.decompress(cdata) + inflater.flush()
+        except zlib.error as e:
+            return (isizes, "block at offset %s does not inflate: %s" % (base_offset + start, e), None)
+        if len(inflater.unused_data) > 0:
+            return (isizes, "block at offset %s has %s bytes of trailing data" % (base_offset + start, len(inflater.unused_data)), None)
+        if len(udata) != isize:
+            return (isizes, "block at offset %s inflates to %s bytes but ISIZE is %s" % (base_offset + start, len(udata), isize), None)
+        if zlib.crc32(udata) & 0xffffffff != crc:
+            return (isizes, "block at offset %s fails its CRC32 check" % (base_offset + start), None)
+        isizes.append(isize)
+        if text_function is not None:
+            udatas.append(udata)
+    if text_function is not None:
+        return (isizes, None, text_function("".join(udatas)))
+    return (isizes, None, None)
+
+def _batches(f, read_size, batch_size):
+    # yields (base_offset, data, [(start, size)]) of whole blocks read from f
+    buf = ""
+    base_offset = 0
+    eof = False
+    while True:
+        # a block is at most 64KiB, so unless f is exhausted every block
+        # starting in the first batch_size bytes of buf is complete
+        while not eof and len(buf) < batch_size + BGZF_MAX_BLOCK_SIZE:
+            data = f.read(read_size)
+            if len(data) == 0:
+                eof = True
+            buf += data
+        if len(buf) == 0:
+            return
+        blocks = []
+        pos = 0
+        while pos < len(buf) and pos < batch_size:
+            size = _block_size(buf, pos)
+            if size is None:
+                raise errors.InvalidArgumentError("no BGZF block header at offset %s" % (base_offset + pos))
+            if pos + size > len(buf):
+                raise errors.InvalidArgumentError("BGZF block at offset %s is truncated (needs %s bytes, %s left)" % (base_offset + pos, size, len(buf) - pos))
+            blocks.append((pos, size))
+            pos += size
+        yield (base_offset, buf[:pos], blocks)
+        buf = buf[pos:]
+        base_offset += pos
+
+def scan_blocks(f, processes=None, read_size=SCAN_READ_SIZE, batch_size=SCAN_BATCH_SIZE, stats=None, pool=None):
+    """
+    Reads the BGZF file f from its current position to the end, checking
+    the header of every block and inflating each one to check its CRC32
+    and ISIZE. Block headers are parsed as the file is streamed in and
+    batches of blocks are inflated by processes worker processes (by
+    default one per core), with no more than two batches per worker held
+    in memory at a time. Returns (block_offsets, isizes) and raises
+    InvalidArgumentError at the first bad block. If pool (a
+    multiprocessing.Pool of processes workers) is given, the batches are
+    inflated by it rather than by a pool started for this file.
+
+    If stats is given, its text_function (a module level function, so
+    that it can be sent to the workers) is applied to the inflated data
+    of each batch in the worker and the results are passed, in file
+    order, to its add_batch method.
+    """
+    if processes is None:
+        processes = cpu_count()
+    text_function = stats.text_function if stats is not None else None
+    block_offsets = []
+    isizes = []
+
+    def collect(batch, result):
+        (batch_isizes, error, text_result) = result
+        if error is not None:
+            raise errors.InvalidArgumentError(error)
+        block_offsets.extend([batch[0] + start for (start, size) in batch[2]])
+        isizes.extend(batch_isizes)
+        if stats is not None:
+            stats.add_batch(text_result)
+
+    if processes <= 1:
+        for batch in _batches(f, read_size, batch_size):
+            collect(batch, check_blocks(batch, text_function))
+        return (block_offsets, isizes)
+
+    own_pool = pool is None
+    if own_pool:
+        pool = Pool(processes=processes)
+    try:
+        pending = collections.deque()
+        for batch in _batches(f, read_size, batch_size):
+            # keep only the offsets of a pending batch, not its data
+            pending.append(((batch[0], None, batch[2]), pool.apply_async(check_blocks, (batch, text_function))))
+            while len(pending) >= 2 * processes:
+                (done, result) = pending.popleft()
+                collect(done, result.get())
+        while len(pending) > 0:
+            (done, result) = pending.popleft()
+            collect(done, result.get())
+        if own_pool:
+            pool.close()
+    finally:
+        if own_pool:
+            pool.terminate()
+            pool.join()
+    return (block_offsets, isizes)
+
+def tbi_virtual_offsets(tbi_data):
+    """
+    Returns the virtual offsets held in the chunks and linear indices of
+    a tabix .tbi (given as its compressed bytes), as a list of
+    (description, virtual_offset).
+    """
+    data = gzip.GzipFile(fileobj=StringIO(tbi_data)).read()
+    if data[:4] != "TBI\1":
+        raise errors.InvalidArgumentError("not a tabix index (magic was %r)" % (data[:4]))
+    (n_ref, fmt, col_seq, col_beg, col_end, meta, skip, l_nm) = struct.unpack_from("<8i", data, 4)
+    names = data[36:36 + l_nm].rstrip("\0").split("\0")
+    pos = 36 + l_nm
+    voffsets = []
+    for ref in range(n_ref):
+        name = names[ref] if ref < len(names) else str(ref)
+        (n_bin,) = struct.unpack_from("<i", data, pos)
+        pos += 4
+        for b in range(n_bin):
+            (bin_id, n_chunk) = struct.unpack_from("<Ii", data, pos)
+            pos += 8
+            chunks = struct.unpack_from("<%sQ" % (2 * n_chunk), data, pos)
+            pos += 16 * n_chunk
+            if bin_id == TBI_META_BIN:
+                # holds the span of the contig's records and record counts
+                voffsets.extend([("%s meta chunk" % (name), v) for v in chunks[:2]])
+                continue
+            voffsets.extend([("%s bin %s chunk" % (name, bin_id), v) for v in chunks])
+        (n_intv,) = struct.unpack_from("<i", data, pos)
+        pos += 4
+        ioff = struct.unpack_from("<%sQ" % (n_intv), data, pos)
+        pos += 8 * n_intv
+        voffsets.extend([("%s linear index %s" % (name, i), v) for (i, v) in enumerate(ioff)])
+    return voffsets
+
+def check_virtual_offsets(voffsets, block_offsets, isizes, file_size):
+    """
+    Checks that every (description, virtual_offset) points at the start
+    of a block of a BGZF file (or its end) and within the data of that
+    block. Raises InvalidArgumentError at the first that does not.
+    """
+    block_isize = dict(zip(block_offsets, isizes))
+    for (description, voffset) in voffsets:
+        coffset = voffset >> 16
+        uoffset = voffset & 0xffff
+        if coffset == file_size and uoffset == 0:
+            continue
+        if coffset not in block_isize:
+            raise errors.InvalidArgumentError("%s virtual offset %s:%s is not on a BGZF block boundary" % (description, coffset, uoffset))
+        if uoffset > block_isize[coffset]:
+            raise errors.InvalidArgumentError("%s virtual offset %s:%s is past the end of a %s byte block" % (description, coffset, uoffset, block_isize[coffset]))
+
+if __name__ == '__main__':
+    print "This module is not intended to be executed as a script"
+    sys.exit(1)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+import os           # Import the os module for basic path manipulation
+import arvados      # Import the Arvados sdk module
+import sys
+import json
+import time
+import shutil
+
+# Bump this whenever the layout of a checkpoint collection changes, so
+# that checkpoints written by older versions are ignored.
+CHECKPOINT_VERSION = 1
+
+# Task parameter holding the uuid of the task's checkpoint collection
+CHECKPOINT_PARAM = "checkpoint"
+
+# Name of a task's checkpoint collection
+CHECKPOINT_COLLECTION_NAME = "hgi_arvados checkpoint v%s for task %s"
+
+# Stream of a checkpoint collection holding one <piece>.json per piece
+CHECKPOINT_PIECES_STREAM = "checkpoint_pieces"
+
+# Least number of seconds between two checkpoints of the same task
+CHECKPOINT_MIN_INTERVAL = 300
+
+# Buffer size for copying checkpointed files out of Keep
+CHECKPOINT_COPY_BUFFER_SIZE = 16 * 1024 * 1024
+
+class TaskCheckpoint(object):
+    """
+    Records the output of each piece of a task's work that has finished
+    in a checkpoint collection whose uuid is the task's "checkpoint"
+    parameter, so that if the task is run again (e.g. after losing its
+    node) it can restore those pieces instead of computing them again.
+    Each task has at most one checkpoint collection, which is updated
+    in place by every save.
+
+    The output of pieces is kept as files directly within
+    checkpoint_dir: add() takes every file there that is not already
+    part of the checkpoint to be the output of the piece just finished.
+    A new checkpoint is saved at most every min_interval seconds.
+    """
+    def __init__(self, checkpoint_dir, min_interval=CHECKPOINT_MIN_INTERVAL):
+        self.task = arvados.current_task()
+        self.checkpoint_dir = checkpoint_dir
+        self.min_interval = min_interval
+        self.last_saved = time.time()
+        self.locator = self.task['parameters'].get(CHECKPOINT_PARAM, None)
+        self.manifest_text = ""
+        self.pieces = {}
+        self.unsaved = {}
+        self.files = set()
+        if self.locator is not None:
+            try:
+                self._read(self.locator)
+                print "Task has a checkpoint %s with %s finished pieces" % (self.locator, len(self.pieces))
+            except Exception as e:
+                # start again from an empty checkpoint in the same collection
+                print "WARNING: ignoring unreadable task checkpoint %s: %s" % (self.locator, e)
+                self.manifest_text = ""
+                self.pieces = {}
+
+    def _read(self, locator):
+        cr = arvados.CollectionReader(locator)
+        self.manifest_text = cr.manifest_text()
+        for s in cr.all_streams():
+            if s.name() != os.path.join(".", CHECKPOINT_PIECES_STREAM):
+                continue
+            for f in s.all_files():
+                piece = json.loads(f.read(2**30))
+                if piece.get('version') != CHECKPOINT_VERSION:
+                    continue
+                self.pieces[piece['name']] = piece
+
+    def completed(self, name):
+        """
+        True if the piece name finished before the task was run again,
+        in which case its files have been restored to checkpoint_dir.
+        """
+        if name not in self.pieces:
+            return False
+        if not os.path.isdir(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+        cr = arvados.CollectionReader(self.locator)
+        for f in self.pieces[name]['files']:
+            dst = os.path.join(self.checkpoint_dir, f)
+            with cr.open(f) as src_f:
+                with open(dst, 'wb') as dst_f:
+                    shutil.copyfileobj(src_f, dst_f, CHECKPOINT_COPY_BUFFER_SIZE)
+            self.files.add(f)
+        print "Restored %s files of piece %s from checkpoint %s" % (len(self.pieces[name]['files']), name, self.locator)
+        return True
+
+    def file_regions(self):
+        """
+        Returns a dict from the name of each file restored by completed()
+        to the regions (a list of (contig, start, end)) of its piece.
+        """
+        regions = {}
+        for piece in self.pieces.values():
+            for f in piece['files']:
+                if f in self.files:
+                    regions[f] = [tuple(region) for region in piece['regions']]
+        return regions
+
+    def add(self, name, regions=None):
+        """
+        Records the files in checkpoint_dir that are not yet part of the
+        checkpoint as the output of piece name (covering regions, a list
+        of (contig, start, end)), saving a new checkpoint if min_interval
+        seconds have passed since the last one.
+        """
+        files = sorted([f for f in os.listdir(self.checkpoint_dir)
+                        if os.path.isfile(os.path.join(self.checkpoint_dir, f)) and f not in self.files])
+        self.files.update(files)
+        self.unsaved[name] = {'version': CHECKPOINT_VERSION,
+                              'name': name,
+                              'files': files,
+                              'regions': [list(region) for region in (regions or [])]}
+        if time.time() - self.last_saved >= self.min_interval:
+            self.save()
+
+    def save(self):
+        """
+        Adds the pieces added since the last checkpoint to the task's
+        checkpoint collection, creating it (and recording its uuid in
+        the task's parameters) the first time. Failing to save is not
+        fatal: the pieces will just have to be computed again if the
+        task is.
+        """
+        if len(self.unsaved) == 0:
+            return
+        parameters = self.task['parameters']
+        try:
+            cw = arvados.CollectionWriter(num_retries=3)
+            for piece in self.unsaved.values():
+                for f in piece['files']:
+                    cw.start_new_file(newfilename=f)
+                    with open(os.path.join(self.checkpoint_dir, f), 'rb') as src_f:
+                        while True:
+                            data = src_f.read(CHECKPOINT_COPY_BUFFER_SIZE)
+                            if len(data) == 0:
+                                break
+                            cw.write(data)
+            cw.start_new_stream(os.path.join(".", CHECKPOINT_PIECES_STREAM))
+            for piece in self.unsaved.values():
+                cw.start_new_file(newfilename="%s.json" % (piece['name']))
+                cw.write(json.dumps(piece, sort_keys=True))
+            cw.finish()
+            manifest_text = self.manifest_text + cw.manifest_text()
+            if self.locator is not None and arvados.util.collection_uuid_pattern.match(self.locator):
+                arvados.api().collections().update(uuid=self.locator,
+                                                   body={"manifest_text": manifest_text}
+                                                   ).execute(num_retries=3)
+                locator = self.locator
+            else:
+                r = arvados.api().collections().create(body={
+                    "name": CHECKPOINT_COLLECTION_NAME % (CHECKPOINT_VERSION, self.task['uuid']),
+                    "manifest_text": manifest_text}).execute(num_retries=3)
+                locator = r["uuid"]
+                parameters = dict(self.task['parameters'])
+                parameters[CHECKPOINT_PARAM] = locator
+                arvados.api().job_tasks().update(uuid=self.task['uuid'],
+                                                 body={'parameters': parameters}
+                                                 ).execute(num_retries=3)
+        except Exception as e:
+            print "WARNING: could not save task checkpoint: %s" % (e)
+            return
+        self.task['parameters'] = parameters
+        self.locator = locator
+        self.manifest_text = manifest_text
+        self.pieces.update(self.unsaved)
+        print "Saved checkpoint %s with %s finished pieces" % (self.locator, len(self.pieces))
+        self.unsaved = {}
+        self.last_saved = time.time()
+
+def checkpoints_requested():
+    """
+    True if the job's checkpoints parameter is true.
+    """
+    if 'checkpoints' in arvados.current_job()['script_parameters']:
+        return str(arvados.current_job()['script_parameters']['checkpoints']).lower() == 'true'
+    return False
+
+if __name__ == '__main__':
+    print "This module is not intended to be executed as a script"
+    sys.exit(1)
@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+
+import os           # Import the os module for basic path manipulation
+import arvados      # Import the Arvados sdk module
+import re
+import sys
+import zlib
+import gzip
+import bisect
+import struct
+import threading
+from StringIO import StringIO
+
+from hgi_arvados import errors
+
+# size of the CRAM file definition (magic, version and file id)
+CRAM_FILE_DEFINITION_SIZE = 26
+
+# size of the EOF container that ends a CRAM, by major version
+CRAM_EOF_SIZE = {2: 30, 3: 38}
+
+LOCATOR_RE = re.compile(r'^[0-9a-f]{32}\+\d+')
+
+# Bytes of Keep blocks fetch_ranges may hold in memory at a time
+FETCH_MAX_BUFFER = 256 * 1024 * 1024
+
+def file_segments(manifest_text, file_path):
+    """
+    Returns the Keep block segments of file_path (stream/name, with or
+    without a leading "./") in a manifest as a list of
+    (locator, block_offset, size, file_offset).
+    """
+    (stream_name, file_name) = os.path.split(os.path.join(".", os.path.normpath(file_path)))
+    segments = []
+    file_offset = 0
+    for line in manifest_text.splitlines():
+        tokens = line.split(" ")
+        if tokens[0] != stream_name:
+            continue
+        blocks = []
+        stream_offset = 0
+        for token in tokens[1:]:
+            if LOCATOR_RE.match(token):
+                size = int(token.split("+")[1])
+                blocks.append((token, stream_offset, size))
+                stream_offset += size
+                continue
+            (pos, size, name) = token.split(":", 2)
+            if name.replace("\\040", " ") != file_name:
+                continue
+            (pos, size) = (int(pos), int(size))
+            for (locator, block_start, block_size) in blocks:
+                start = max(pos, block_start)
+                end = min(pos + size, block_start + block_size)
+                if start < end:
+                    segments.append((locator, start - block_start, end - start, file_offset + start - pos))
+            file_offset += size
+    return segments
+
+def fetch_ranges(segments, ranges, out, keep_client=None, threads=8, max_buffer=FETCH_MAX_BUFFER):
+    """
+    Writes the bytes of each (start, end) range of a file (given by its
+    Keep block segments) to out, in order. The Keep blocks the ranges
+    overlap are each fetched once, by threads concurrent GETs, holding
+    no more than max_buffer bytes of blocks in memory at a time (other
+    than the one block being written if it is larger than that).
+    Returns the number of bytes of Keep blocks fetched.
+    """
+    if keep_client is None:
+        keep_client = arvados.KeepClient()
+
+    # the pieces of each block to write, in output order
+    pieces = []
+    for (start, end) in ranges:
+        for (locator, block_offset, size, file_offset) in segments:
+            piece_start = max(start, file_offset)
+            piece_end = min(end, file_offset + size)
+            if piece_start < piece_end:
+                pieces.append((locator, block_offset + piece_start - file_offset, piece_end - piece_start))
+    order = []
+    last_use = {}
+    for (i, (locator, offset, size)) in enumerate(pieces):
+        if locator not in last_use:
+            order.append(locator)
+        last_use[locator] = i
+
+    def block_size(locator):
+        return int(locator.split("+")[1])
+
+    blocks = {}
+    failures = []
+    condition = threading.Condition()
+    next_block = [0]
+    # bytes of the blocks being fetched or waiting to be written
+    buffered = [0]
+    # the block the writer is waiting for, which is always fetched
+    # (even over max_buffer) so that the writer cannot be starved
+    waiting_for = [None]
+
+    def fetch():
+        while True:
+            with condition:
+                while True:
+                    if next_block[0] >= len(order) or len(failures) > 0:
+                        return
+                    locator = order[next_block[0]]
+                    if (buffered[0] == 0 or buffered[0] + block_size(locator) <= max_buffer or
+                        locator == waiting_for[0]):
+                        break
+                    condition.wait(1)
+                next_block[0] += 1
+                buffered[0] += block_size(locator)
+            try:
+                data = keep_client.get(locator, num_retries=3)
+            except Exception as e:
+                with condition:
+                    failures.append((locator, e))
+                    condition.notify_all()
+                return
+            with condition:
+                blocks[locator] = data
+                condition.notify_all()
+
+    workers = [threading.Thread(target=fetch, name="cram-slice-%s" % (i)) for i in range(threads)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    fetched = 0
+    try:
+        for (i, (locator, offset, size)) in enumerate(pieces):
+            with condition:
+                while locator not in blocks and len(failures) == 0:
+                    waiting_for[0] = locator
+                    condition.notify_all()
+                    condition.wait(1)
+                if len(failures) > 0:
+                    raise errors.APIError("Failed to fetch Keep block %s: %s" % failures[0])
+                data = blocks[locator]
+            out.write(data[offset:offset + size])
+            if last_use[locator] == i:
+                fetched += len(data)
+                with condition:
+                    del blocks[locator]
+                    buffered[0] -= block_size(locator)
+                    condition.notify_all()
+    finally:
+        with condition:
+            failures.append((None, "finished"))
+            # wake any workers waiting for space so that they see we are done
+            condition.notify_all()
+        for worker in workers:
+            worker.join()
+    return fetched
+
+def _itf8(data, pos):
+    b0 = ord(data[pos])
+    if b0 & 0x80 == 0:
+        return (b0, pos + 1)
+    if b0 & 0x40 == 0:
+        return (((b0 & 0x7f) << 8) | ord(data[pos + 1]), pos + 2)
+    if b0 & 0x20 == 0:
+        return (((b0 & 0x3f) << 16) | (ord(data[pos + 1]) << 8) | ord(data[pos + 2]), pos + 3)
+    if b0 & 0x10 == 0:
+        return (((b0 & 0x1f) << 24) | (ord(data[pos + 1]) << 16) | (ord(data[pos + 2]) << 8) | ord(data[pos + 3]), pos + 4)
+    value = ((b0 & 0x0f) << 28) | (ord(data[pos + 1]) << 20) | (ord(data[pos + 2]) << 12) | (ord(data[pos + 3]) << 4) | (ord(data[pos + 4]) & 0x0f)
+    if value >= 2 ** 31:
+        value -= 2 ** 32
+    return (value, pos + 5)
+
+def _ltf8(data, pos):
+    b0 = ord(data[pos])
+    extra = 0
+    while extra < 8 and b0 & (0x80 >> extra):
+        extra += 1
+    value = b0 & (0xff >> (extra + 1)) if extra < 8 else 0
+    for i in range(extra):
+        value = (value << 8) | ord(data[pos + 1 + i])
+    return (value, pos + 1 + extra)
+
+def cram_version(header_bytes):
+    """
+    Returns the (major, minor) version of the CRAM starting with header_bytes.
+    """
+    if header_bytes[:4] != "CRAM":
+        raise errors.InvalidArgumentError("Not a CRAM file (magic was %r)" % (header_bytes[:4]))
+    return (ord(header_bytes[4]), ord(header_bytes[5]))
+
+def cram_sq_names(header_bytes):
+    """
+    Returns the @SQ names, in order, from the SAM header held in the
+    header container of a CRAM (header_bytes runs from the start of
+    the file to the first data container).
+    """
+    (major, minor) = cram_version(header_bytes)
+    pos = CRAM_FILE_DEFINITION_SIZE + 4
+    for field in ['ref_seq_id', 'start', 'span', 'n_records']:
+        (value, pos) = _itf8(header_bytes, pos)
+    for field in ['record_counter', 'bases']:
+        (value, pos) = _ltf8(header_bytes, pos)
+    (n_blocks, pos) = _itf8(header_bytes, pos)
+    (n_landmarks, pos) = _itf8(header_bytes, pos)
+    for i in range(n_landmarks):
+        (landmark, pos) = _itf8(header_bytes, pos)
+    if major >= 3:
+        pos += 4
+    method = ord(header_bytes[pos])
+    (content_id, pos) = _itf8(header_bytes, pos + 2)
+    (compressed_size, pos) = _itf8(header_bytes, pos)
+    (raw_size, pos) = _itf8(header_bytes, pos)
+    data = header_bytes[pos:pos + compressed_size]
+    if method == 1:
+        data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    elif method != 0:
+        raise errors.InvalidArgumentError("Unsupported CRAM header block compression method %s" % (method))
+    (text_length,) = struct.unpack_from("<i", data, 0)
+    names = []
+    for line in data[4:4 + text_length].splitlines():
+        if line.startswith("@SQ"):
+            for field in line.split("\t")[1:]:
+                if field.startswith("SN:"):
+                    names.append(field[3:])
+    return names
+
+def read_crai(crai_data):
+    """
+    Returns the entries of a (gzipped) .crai as lists of
+    [seq_id, start, span, container_offset, slice_offset, slice_size].
+    """
+    entries = []
+    for line in gzip.GzipFile(fileobj=StringIO(crai_data)).read().splitlines():
+        fields = line.split()
+        if len(fields) >= 6:
+            entries.append([int(x) for x in fields[:6]])
+    return entries
+
+def select_containers(entries, sq_names, regions):
+    """
+    Returns the sorted offsets of the containers holding slices that
+    overlap any of regions ((contig, start, end), 1-based inclusive).
+    """
+    by_seq_id = {}
+    for (i, name) in enumerate(sq_names):
+        by_seq_id.setdefault(name, i)
+    # per contig: slice starts in order, and the largest slice end so far,
+    # so each region is found by bisection rather than a scan of the index
+    slices = {}
+    for (seq_id, start, span, container_offset, slice_offset, slice_size) in entries:
+        slices.setdefault(seq_id, []).append((start, start + span - 1, container_offset))
+    for seq_id in slices:
+        slices[seq_id].sort()
+    max_ends = {}
+    for (seq_id, seq_slices) in slices.items():
+        max_end = []
+        for (start, end, container_offset) in seq_slices:
+            max_end.append(max(end, max_end[-1]) if max_end else end)
+        max_ends[seq_id] = max_end
+    selected = set()
+    for (contig, start, end) in regions:
+        seq_id = by_seq_id.get(contig)
+        if seq_id not in slices:
+            continue
+        seq_slices = slices[seq_id]
+        first = bisect.bisect_left(max_ends[seq_id], start)
+        last = len(seq_slices)
+        if end is not None:
+            last = bisect.bisect_right(seq_slices, (end, sys.maxint, sys.maxint))
+        for (slice_start, slice_end, container_offset) in seq_slices[first:last]:
+            if slice_end >= start:
+                selected.add(container_offset)
+    return sorted(selected)
+
+def write_sliced_cram(collection_reader, cram_path, crai_path, regions, out_dir, keep_client=None, threads=8):
+    """
+    Writes to out_dir a CRAM holding only the containers of cram_path (in
+    collection_reader) that overlap regions, along with the CRAM header
+    and EOF container, and a .crai for it. Only the Keep blocks behind
+    those byte ranges are fetched, with parallel GETs, so a chunk task
+    reads its part of a sample CRAM sequentially and never fetches the
+    rest. Returns the path of the local CRAM.
+    """
+    manifest_text = collection_reader.manifest_text(normalize=True)
+    cram_segments = file_segments(manifest_text, cram_path)
+    crai_segments = file_segments(manifest_text, crai_path)
+    if len(cram_segments) == 0 or len(crai_segments) == 0:
+        raise errors.InvalidArgumentError("Could not find %s and %s in collection" % (cram_path, crai_path))
+    cram_size = sum([size for (locator, offset, size, file_offset) in cram_segments])
+
+    crai_data = StringIO()
+    fetch_ranges(crai_segments, [(0, sum([s[2] for s in crai_segments]))], crai_data, keep_client=keep_client, threads=threads)
+    entries = read_crai(crai_data.getvalue())
+    container_offsets = sorted(set([entry[3] for entry in entries]))
+    if len(container_offsets) == 0:
+        raise errors.InvalidArgumentError("CRAM index %s has no entries" % (crai_path))
+
+    header = StringIO()
+    fetch_ranges(cram_segments, [(0, container_offsets[0])], header, keep_client=keep_client, threads=threads)
+    header_bytes = header.getvalue()
+    (major, minor) = cram_version(header_bytes)
+    if major not in CRAM_EOF_SIZE:
+        raise errors.InvalidArgumentError("Unsupported CRAM version %s.%s" % (major, minor))
+    eof_start = cram_size - CRAM_EOF_SIZE[major]
+
+    selected = select_containers(entries, cram_sq_names(header_bytes), regions)
+    container_end = dict(zip(container_offsets, container_offsets[1:] + [eof_start]))
+    ranges = [(offset, container_end[offset]) for offset in selected]
+
+    # containers are copied whole, so slice offsets within them are unchanged
+    new_offset = {}
+    position = len(header_bytes)
+    for (start, end) in ranges:
+        new_offset[start] = position
+        position += end - start
+
+    local_cram = os.path.join(out_dir, os.path.basename(cram_path))
+    with open(local_cram, 'wb') as out:
+        out.write(header_bytes)
+        fetched = fetch_ranges(cram_segments, ranges + [(eof_start, cram_size)], out,
+                               keep_client=keep_client, threads=threads)
+    crai = gzip.open(local_cram + ".crai", 'wb')
+    for entry in entries:
+        if entry[3] in new_offset:
+            crai.write("\t".join([str(x) for x in entry[:3] + [new_offset[entry[3]]] + entry[4:6]]) + "\n")
+    crai.close()
+    print "Wrote %s containers (%s of %s bytes) of %s for %s regions to %s, fetching %s bytes of Keep blocks" % (
+        len(ranges), position, cram_size, cram_path, len(regions), local_cram, fetched)
+    return local_cram
+
+if __name__ == '__main__':
+    print "This module is not intended to be executed as a script"
+    sys.exit(1)
@@ -5,6 +5,7 @@ import arvados      # Import the Arvados sdk module
 import re
 import subprocess
 
+import hgi_arvados
 from hgi_arvados import errors
 
 def _execute(gatk_args, **kwargs):
@@ -15,6 +16,7 @@ def _execute(gatk_args, **kwargs):
     output_prefix = kwargs.pop("output_prefix", "GATK: ")
     extra_java_args = kwargs.pop("extra_java_args", None)
     extra_gatk_args = kwargs.pop("extra_gatk_args", None)
+    progress_callback = kwargs.pop("progress_callback", None)
     if len(kwargs) > 0:
         print "Extraneous keyword arguments passed to _execute: %s" %(kwargs)
     print "Calling %s%s" % (output_prefix, gatk_args)
@@ -27,7 +29,7 @@ def _execute(gatk_args, **kwargs):
     java_args.extend(gatk_args)
     if extra_gatk_args:
         java_args.extend(extra_gatk_args)
-    gatk_p = subprocess.Popen(
+    gatk_p = hgi_arvados.start_tool(
         java_args,
         stdin=None,
         stdout=subprocess.PIPE,
@@ -43,6 +45,8 @@ def _execute(gatk_args, **kwargs):
             print "%s%s" % (output_prefix, line.rstrip())
         elif re.search(print_lines_matching_regex, line):
             print "%s%s" % (output_prefix, line.rstrip())
+        if progress_callback is not None and "ProgressMeter" in line:
+            progress_callback(line)
 
     gatk_exit = gatk_p.wait()
     return gatk_exit
@@ -6,6 +6,11 @@ import re
 import sys
 
 from hgi_arvados import errors
+from hgi_arvados import cram_slice
+from hgi_arvados import gvcf_columnar
+from hgi_arvados import reference
+from hgi_arvados import timing
+from hgi_arvados import vcf_stats
 
 def prepare_gatk_reference_collection(reference_coll):
     """
@@ -13,52 +18,15 @@ def prepare_gatk_reference_collection(reference_coll):
     files and only the required files for GATK.
     Returns: a portable data hash for the reference collection
     """
-    # Ensure we have a .fa reference file with corresponding .fai index and .dict
-    # see: http://gatkforums.broadinstitute.org/discussion/1601/how-can-i-prepare-a-fasta-file-to-use-as-reference
-    rcr = arvados.CollectionReader(reference_coll)
-    ref_fasta = {}
-    ref_fai = {}
-    ref_dict = {}
-    ref_input = None
-    dict_reader = None
-    for rs in rcr.all_streams():
-        for rf in rs.all_files():
-            if re.search(r'\.fa$', rf.name()):
-                ref_fasta[rs.name(), rf.name()] = rf
-            elif re.search(r'\.fai$', rf.name()):
-                ref_fai[rs.name(), rf.name()] = rf
-            elif re.search(r'\.dict$', rf.name()):
-                ref_dict[rs.name(), rf.name()] = rf
-    for ((s_name, f_name), fasta_f) in ref_fasta.items():
-        fai_f = ref_fai.get((s_name, re.sub(r'fa$', 'fai', f_name)),
-                            ref_fai.get((s_name, re.sub(r'fa$', 'fa.fai', f_name)),
-                                        None))
-        dict_f = ref_dict.get((s_name, re.sub(r'fa$', 'dict', f_name)),
-                              ref_dict.get((s_name, re.sub(r'fa$', 'fa.dict', f_name)),
-                                           None))
-        if fasta_f and fai_f and dict_f:
-            # found a set of all three!
-            ref_input = fasta_f.as_manifest()
-            ref_input += fai_f.as_manifest()
-            ref_input += dict_f.as_manifest()
-            dict_reader = dict_f
-            break
-    if ref_input is None:
-        raise errors.InvalidArgumentError("Expected a reference fasta with fai and dict in reference_collection. Found [%s]" % ' '.join(rf.name() for rf in rs.all_files()))
-    if dict_reader is None:
-        raise errors.InvalidArgumentError("Could not find .dict file in reference_collection. Found [%s]" % ' '.join(rf.name() for rf in rs.all_files()))
-    # Create and return a portable data hash for the ref_input manifest
-    try:
-        r = arvados.api().collections().create(body={"manifest_text": ref_input}).execute()
-        ref_input_pdh = r["portable_data_hash"]
-    except:
-        raise
-    return ref_input_pdh
-
-def mount_gatk_reference(ref_param="ref"):
+    return reference.resolve_reference(reference_coll)['ref_pdh']
+
+def mount_gatk_reference(ref_param="ref", local_copy=True):
     # Get reference FASTA
     print "Mounting reference FASTA collection"
     ref_dir = arvados.get_task_param_mount(ref_param)
+    if local_copy:
+        # share one copy of the reference between the tasks on this node
+        ref_dir = reference.local_reference_dir(arvados.current_task()['parameters'][ref_param], ref_dir)
 
     # Sanity check reference FASTA
     for f in arvados.util.listdir_recursive(ref_dir):
@@ -74,33 +42,76 @@ def mount_gatk_reference(ref_param="ref"):
 
 def mount_gatk_cram_input(input_param="input"):
     # Get single CRAM file for this task
+    input_cram_files = mount_gatk_cram_inputs(input_param=input_param)
+    if len(input_cram_files) != 1:
+        raise errors.InvalidArgumentError("Expected exactly one cram file per task.")
+
+    # There is only one CRAM file
+    return input_cram_files[0]
+
+def mount_gatk_cram_inputs(input_param="input"):
+    # Get all CRAM files for this task (in collection order)
     print "Mounting task input collection"
     input_dir = arvados.get_task_param_mount('input')
 
     input_cram_files = []
-    for f in arvados.util.listdir_recursive(input_dir):
+    for f in sorted(arvados.util.listdir_recursive(input_dir)):
         if re.search(r'\.cram$', f):
-            stream_name, input_file_name = os.path.split(f)
             input_cram_files += [os.path.join(input_dir, f)]
-    if len(input_cram_files) != 1:
-        raise errors.InvalidArgumentError("Expected exactly one cram file per task.")
-
-    # There is only one CRAM file
-    cram_file = input_cram_files[0]
-
-    # Ensure we can read the CRAM file
-    if not os.access(cram_file, os.R_OK):
-        raise errors.FileAccessError("CRAM file not readable: %s" % cram_file)
-
-    # Ensure we have corresponding CRAI index and can read it as well
-    cram_file_base, cram_file_ext = os.path.splitext(cram_file)
-    assert(cram_file_ext == ".cram")
-    crai_file = cram_file_base + ".crai"
-    if not os.access(crai_file, os.R_OK):
-        crai_file = cram_file_base + ".cram.crai"
+    if len(input_cram_files) == 0:
+        raise errors.InvalidArgumentError("Expected one or more cram files per task.")
+
+    for cram_file in input_cram_files:
+        # Ensure we can read the CRAM file
+        if not os.access(cram_file, os.R_OK):
+            raise errors.FileAccessError("CRAM file not readable: %s" % cram_file)
+
+        # Ensure we have corresponding CRAI index and can read it as well
+        cram_file_base, cram_file_ext = os.path.splitext(cram_file)
+        assert(cram_file_ext == ".cram")
+        crai_file = cram_file_base + ".crai"
         if not os.access(crai_file, os.R_OK):
-            raise errors.FileAccessError("No readable CRAM index file for CRAM file: %s" % cram_file)
-    return cram_file
+            crai_file = cram_file_base + ".cram.crai"
+            if not os.access(crai_file, os.R_OK):
+                raise errors.FileAccessError("No readable CRAM index file for CRAM file: %s" % cram_file)
+    return input_cram_files
+
+def fetch_gatk_cram_input_regions(regions, input_param="input", cram_path=None):
+    """
+    Fetches the parts of the task's single CRAM file (or, if given, of
+    the CRAM at cram_path within the input collection) that overlap
+    regions into a CRAM (and .crai) in the task's scratch space, so that
+    the caller reads it from local disk rather than from the Keep mount.
+    Returns: the path of the local CRAM file
+    """
+    print "Fetching CRAM containers for %s regions from task input collection" % (len(regions))
+    reader = arvados.CollectionReader(arvados.current_task()['parameters'][input_param])
+    cram_paths = []
+    crai_paths = {}
+    for s in reader.all_streams():
+        for f in s.all_files():
+            path = os.path.join(s.name(), f.name())
+            if re.search(r'\.cram$', f.name()):
+                cram_paths.append(path)
+            elif re.search(r'\.crai$', f.name()):
+                crai_paths[path] = True
+    if cram_path is None:
+        if len(cram_paths) != 1:
+            raise errors.InvalidArgumentError("Expected exactly one cram file per task.")
+        cram_path = cram_paths[0]
+    elif cram_path not in cram_paths:
+        raise errors.InvalidArgumentError("No cram file %s in task input collection" % (cram_path))
+    crai_path = re.sub(r'cram$', 'crai', cram_path)
+    if crai_path not in crai_paths:
+        crai_path = cram_path + ".crai"
+        if crai_path not in crai_paths:
+            raise errors.FileAccessError("No CRAM index file for CRAM file: %s" % cram_path)
+
+    # keep the stream of the CRAM, as a task may have more than one
+    local_dir = os.path.normpath(os.path.join(arvados.current_task().tmpdir, 'input', os.path.dirname(cram_path)))
+    if not os.path.exists(local_dir):
+        os.makedirs(local_dir)
+    return cram_slice.write_sliced_cram(reader, cram_path, crai_path, regions, local_dir)
 
 def mount_gatk_bam_input(input_param="input"):
     # Get single BAM file for this task
@@ -150,6 +161,12 @@ def mount_gatk_gvcf_inputs(inputs_param="inputs"):
             pass
         elif re.search(r'\.interval_list$', f):
             pass
+        elif timing.is_summary_path(f):
+            pass
+        elif vcf_stats.is_stats_path(f):
+            pass
+        elif gvcf_columnar.is_store_path(f):
+            pass
         else:
             print "WARNING: collection contains unexpected file %s" % f
     if len(input_gvcf_files) == 0:
@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+
+import os           # Import the os module for basic path manipulation
+import re
+import sys
+import json
+import zlib
+import gzip
+import mmap
+import heapq
+import array
+import bisect
+import struct
+
+from hgi_arvados import errors
+
+# Bump this whenever the layout of a columnar store changes
+GVCF_COLUMNAR_VERSION = 1
+
+# Suffix of the columnar store written next to each gVCF
+GVCF_COLUMNAR_SUFFIX = ".gvcfc"
+
+# Magic at the start and end of a columnar store
+GVCF_COLUMNAR_MAGIC = "GVCFC\1\0\0"
+
+# Records per chunk of a contig's column arrays
+CHUNK_RECORDS = 65536
+
+# Bytes of decompressed gVCF text to parse at a time while importing
+IMPORT_READ_SIZE = 4 * 1024 * 1024
+
+# Typecodes of the numeric columns (stored little-endian); every column
+# of a chunk, numeric or text, is zlib compressed on its own
+NUMERIC_COLUMNS = {
+    'pos': 'i', 'end': 'i', 'gq': 'i', 'dp': 'i',
+    'allele_offsets': 'I', 'pl_offsets': 'I', 'pl': 'i',
+    'ad_offsets': 'I', 'ad': 'i', 'rest_offsets': 'I',
+}
+TEXT_COLUMNS = ['alleles', 'rest']
+
+TRAILER = struct.Struct("<QQ8s")
+
+def is_store_path(path):
+    """
+    True if path is a columnar store written by write_store.
+    """
+    return path.endswith(".vcf.gz" + GVCF_COLUMNAR_SUFFIX)
+
+def _int_list(value):
+    return [int(x) for x in value.split(",") if x != "."]
+
+def _int_or_missing(value):
+    if value == "." or value == "":
+        return -1
+    return int(value)
+
+def _array_bytes(typecode, values):
+    a = array.array(typecode, values)
+    if sys.byteorder != "little":
+        a.byteswap()
+    return a.tostring()
+
+class _ChunkBuilder(object):
+    # holds the columns of the records of one chunk as they are parsed
+
+    def __init__(self):
+        self.columns = dict([(name, []) for name in NUMERIC_COLUMNS])
+        self.alleles = []
+        self.rest = []
+        for name in ['allele_offsets', 'pl_offsets', 'ad_offsets', 'rest_offsets']:
+            self.columns[name].append(0)
+        self.allele_bytes = 0
+        self.rest_bytes = 0
+        self.max_end = 0
+        self.max_span = 1
+
+    def __len__(self):
+        return len(self.columns['pos'])
+
+    def add(self, fields):
+        (pos, ref, alt, info, rest) = (int(fields[1]), fields[3], fields[4], fields[7], fields[2] + "\t" + "\t".join(fields[5:]))
+        end = pos + len(ref) - 1
+        if info.startswith("END="):
+            end = int(info[4:].split(";", 1)[0])
+        elif ";END=" in info:
+            end = int(info.split(";END=", 1)[1].split(";", 1)[0])
+        sample = dict(zip(fields[8].split(":"), fields[9].split(":"))) if len(fields) > 9 else {}
+        c = self.columns
+        c['pos'].append(pos)
+        c['end'].append(end)
+        c['gq'].append(_int_or_missing(sample.get('GQ', ".")))
+        c['dp'].append(_int_or_missing(sample.get('DP', ".")))
+        c['pl'].extend(_int_list(sample.get('PL', ".")))
+        c['pl_offsets'].append(len(c['pl']))
+        c['ad'].extend(_int_list(sample.get('AD', ".")))
+        c['ad_offsets'].append(len(c['ad']))
+        self.alleles.append(ref + "\t" + alt)
+        self.allele_bytes += len(ref) + 1 + len(alt)
+        c['allele_offsets'].append(self.allele_bytes)
+        self.rest.append(rest)
+        self.rest_bytes += len(rest)
+        c['rest_offsets'].append(self.rest_bytes)
+        self.max_end = max(self.max_end, end)
+        self.max_span = max(self.max_span, end - pos + 1)
+
+    def write(self, f):
+        # writes the columns to f, returning the chunk's index entry
+        entry = {
+            'n': len(self),
+            'first_pos': self.columns['pos'][0],
+            'last_pos': self.columns['pos'][-1],
+            'max_end': self.max_end,
+            'max_span': self.max_span,
+            'columns': {},
+        }
+        columns = [(name, _array_bytes(NUMERIC_COLUMNS[name], self.columns[name])) for name in sorted(NUMERIC_COLUMNS)]
+        columns.extend([('alleles', "".join(self.alleles)), ('rest', "".join(self.rest))])
+        for (name, data) in columns:
+            data = zlib.compress(data, 6)
+            entry['columns'][name] = [f.tell(), len(data)]
+            f.write(data)
+        return entry
+
+def _vcf_lines(vcf_file):
+    # yields the lines (without newlines) of a gzipped VCF
+    g = gzip.open(vcf_file, 'rb')
+    try:
+        carry = ""
+        while True:
+            data = g.read(IMPORT_READ_SIZE)
+            if len(data) == 0:
+                break
+            lines = (carry + data).split("\n")
+            carry = lines.pop()
+            for line in lines:
+                yield line
+        if carry != "":
+            yield carry
+    finally:
+        g.close()
+
+def write_store(vcf_file, store_file, chunk_records=CHUNK_RECORDS):
+    """
+    Converts a single sample gVCF (as written by HaplotypeCaller) to a
+    columnar store: for each contig, chunks of chunk_records records
+    holding arrays of positions, reference block ends, GQ, DP, PL and
+    AD, alongside the alleles and the rest of each line so that the
+    gVCF text can be regenerated. Returns the number of records.
+    """
+    header = []
+    contigs = []
+    chunk = None
+    contig = None
+    records = 0
+    with open(store_file, 'wb') as f:
+        f.write(GVCF_COLUMNAR_MAGIC)
+        for line in _vcf_lines(vcf_file):
+            if line.startswith("#"):
+                header.append(line)
+                continue
+            if line == "":
+                continue
+            fields = line.split("\t")
+            if len(fields) < 8:
+                raise errors.InvalidArgumentError("Malformed record in %s: %s" % (vcf_file, line[:200]))
+            if fields[0] != contig:
+                if chunk is not None and len(chunk) > 0:
+                    contigs[-1][1].append(chunk.write(f))
+                contig = fields[0]
+                if contig in [name for (name, chunks) in contigs]:
+                    raise errors.InvalidArgumentError("Records of contig %s are not together in %s" % (contig, vcf_file))
+                contigs.append([contig, []])
+                chunk = _ChunkBuilder()
+            chunk.add(fields)
+            records += 1
+            if len(chunk) >= chunk_records:
+                contigs[-1][1].append(chunk.write(f))
+                chunk = _ChunkBuilder()
+        if chunk is not None and len(chunk) > 0:
+            contigs[-1][1].append(chunk.write(f))
+
+        samples = header[-1].split("\t")[9:] if len(header) > 0 else []
+        if len(samples) != 1:
+            raise errors.InvalidArgumentError("Expected a single sample gVCF but %s has %s samples" % (vcf_file, len(samples)))
+        index = json.dumps({
+            'version': GVCF_COLUMNAR_VERSION,
+            'source': os.path.basename(vcf_file),
+            'sample': samples[0],
+            'header': "\n".join(header) + "\n",
+            'records': records,
+            'contigs': contigs,
+        })
+        index_offset = f.tell()
+        f.write(index)
+        f.write(TRAILER.pack(index_offset, len(index), GVCF_COLUMNAR_MAGIC))
+    return records
+
+class GvcfColumnarReader(object):
+    """
+    Reads records of a region from a columnar store, memory-mapping the
+    store so that only the chunks (and columns) a region needs are read
+    and inflated.
+    """
+
+    def __init__(self, store_file):
+        self.store_file = store_file
+        self._file = open(store_file, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < len(GVCF_COLUMNAR_MAGIC) + TRAILER.size or self._map[:len(GVCF_COLUMNAR_MAGIC)] != GVCF_COLUMNAR_MAGIC:
+            raise errors.InvalidArgumentError("Not a columnar gVCF store: %s" % (store_file))
+        (index_offset, index_length, magic) = TRAILER.unpack(self._map[-TRAILER.size:])
+        if magic != GVCF_COLUMNAR_MAGIC:
+            raise errors.InvalidArgumentError("Columnar gVCF store %s is truncated" % (store_file))
+        self.index = json.loads(self._map[index_offset:index_offset + index_length])
+        if self.index['version'] != GVCF_COLUMNAR_VERSION:
+            raise errors.InvalidArgumentError("Columnar gVCF store %s is version %s, not %s" % (store_file, self.index['version'], GVCF_COLUMNAR_VERSION))
+        self.sample = self.index['sample']
+        self.header = self.index['header']
+        self.contig_names = [name for (name, chunks) in self.index['contigs']]
+        self._chunks = dict([(name, chunks) for (name, chunks) in self.index['contigs']])
+        self._chunk_starts = dict([(name, [chunk['first_pos'] for chunk in chunks]) for (name, chunks) in self.index['contigs']])
+        # the inflated columns of the last chunk read, which the next
+        # region often falls in too
+        self._cached_chunk = None
+        self._cached_columns = {}
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def _column(self, chunk, name):
+        (offset, length) = chunk['columns'][name]
+        if self._cached_chunk is not chunk:
+            self._cached_chunk = chunk
+            self._cached_columns = {}
+        if name in self._cached_columns:
+            return self._cached_columns[name]
+        data = zlib.decompress(self._map[offset:offset + length])
+        if name not in TEXT_COLUMNS:
+            a = array.array(NUMERIC_COLUMNS[name])
+            a.fromstring(data)
+            if sys.byteorder != "little":
+                a.byteswap()
+            data = a
+        self._cached_columns[name] = data
+        return data
+
+    def _chunk_ranges(self, contig, start, end):
+        # yields (chunk_number, chunk, first, last) for the records of
+        # contig that overlap start-end (end None for the contig end)
+        chunks = self._chunks.get(contig, [])
+        first_chunk = 0
+        if end is not None:
+            last_chunk = bisect.bisect_right(self._chunk_starts.get(contig, []), end)
+        else:
+            last_chunk = len(chunks)
+        for chunk_number in range(first_chunk, last_chunk):
+            chunk = chunks[chunk_number]
+            if chunk['max_end'] < start:
+                continue
+            pos = self._column(chunk, 'pos')
+            first = bisect.bisect_left(pos, start - chunk['max_span'] + 1)
+            last = len(pos) if end is None else bisect.bisect_right(pos, end)
+            if first < last:
+                yield (chunk_number, chunk, pos, first, last)
+
+    def rows(self, contig, start=1, end=None):
+        """
+        Yields the records of contig overlapping start-end (1-based,
+        inclusive; end None for the end of the contig) as tuples of
+        (pos, end, ref, alt, gq, dp, pl, ad).
+        """
+        for (chunk_number, chunk, pos, first, last) in self._chunk_ranges(contig, start, end):
+            ends = self._column(chunk, 'end')
+            gq = self._column(chunk, 'gq')
+            dp = self._column(chunk, 'dp')
+            pl = self._column(chunk, 'pl')
+            pl_offsets = self._column(chunk, 'pl_offsets')
+            ad = self._column(chunk, 'ad')
+            ad_offsets = self._column(chunk, 'ad_offsets')
+            alleles = self._column(chunk, 'alleles')
+            allele_offsets = self._column(chunk, 'allele_offsets')
+            for i in xrange(first, last):
+                if ends[i] < start:
+                    continue
+                (ref, alt) = alleles[allele_offsets[i]:allele_offsets[i + 1]].split("\t", 1)
+                yield (pos[i], ends[i], ref, alt, gq[i], dp[i],
+                       pl[pl_offsets[i]:pl_offsets[i + 1]].tolist(),
+                       ad[ad_offsets[i]:ad_offsets[i + 1]].tolist())
+
+    def _lines(self, contig, start, end, after=None):
+        # yields ((chunk_number, i), line) for the records overlapping
+        # start-end, skipping any at or before the key after
+        for (chunk_number, chunk, pos, first, last) in self._chunk_ranges(contig, start, end):
+            ends = self._column(chunk, 'end')
+            alleles = self._column(chunk, 'alleles')
+            allele_offsets = self._column(chunk, 'allele_offsets')
+            rest = self._column(chunk, 'rest')
+            rest_offsets = self._column(chunk, 'rest_offsets')
+            for i in xrange(first, last):
+                if ends[i] < start or (after is not None and (chunk_number, i) <= after):
+                    continue
+                (record_id, rest_fields) = rest[rest_offsets[i]:rest_offsets[i + 1]].split("\t", 1)
+                yield ((chunk_number, i), "\t".join([contig, str(pos[i]), record_id,
+                                                     alleles[allele_offsets[i]:allele_offsets[i + 1]],
+                                                     rest_fields]))
+
+    def write_region_vcf(self, regions, out_file):
+        """
+        Writes the header and the records overlapping any of regions
+        ((contig, start, end), end None for the end of the contig) to an
+        uncompressed VCF, in the contig order of the store and with no
+        record written twice. Returns the number of records written.
+        """
+        by_contig = {}
+        for (contig, start, end) in regions:
+            by_contig.setdefault(contig, []).append((start, end))
+        written = 0
+        with open(out_file, 'w') as out:
+            out.write(self.header)
+            for contig in self.contig_names:
+                last_key = None
+                for (start, end) in sorted(by_contig.get(contig, [])):
+                    for (key, line) in self._lines(contig, start, end, after=last_key):
+                        out.write(line + "\n")
+                        last_key = key
+                        written += 1
+        return written
+
+def merge_rows(readers, contig, start=1, end=None):
+    """
+    Yields the rows (see GvcfColumnarReader.rows) of many samples'
+    stores for a region in position order, as (pos, sample, row).
+    """
+    streams = []
+    for reader in readers:
+        streams.append(((row[0], reader.sample, row) for row in reader.rows(contig, start, end)))
+    return heapq.merge(*streams)
+
+def localise_region_inputs(gvcf_files, regions, out_dir):
+    """
+    Returns gvcf_files with each gVCF that has a columnar store next to
+    it replaced by a local uncompressed VCF (in out_dir) holding only
+    the records overlapping regions, read from the store.
+    """
+    local_files = []
+    localised = 0
+    for (i, gvcf_file) in enumerate(gvcf_files):
+        store_file = gvcf_file + GVCF_COLUMNAR_SUFFIX
+        if not os.path.exists(store_file):
+            local_files.append(gvcf_file)
+            continue
+        local_dir = os.path.join(out_dir, str(i))
+        if not os.path.isdir(local_dir):
+            os.makedirs(local_dir)
+        local_file = os.path.join(local_dir, re.sub(r'\.gz$', '', os.path.basename(gvcf_file)))
+        reader = GvcfColumnarReader(store_file)
+        try:
+            reader.write_region_vcf(regions, local_file)
+        finally:
+            reader.close()
+        local_files.append(local_file)
+        localised += 1
+    print "Read %s of %s input gVCFs for %s regions from their columnar stores" % (localised, len(gvcf_files), len(regions))
+    return local_files
+
+if __name__ == '__main__':
+    print "This module is not intended to be executed as a script"
+    sys.exit(1)
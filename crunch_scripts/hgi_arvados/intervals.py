@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+
+import sys
+import numpy as np
+
+from hgi_arvados import errors
+from hgi_arvados import sequence_dictionary
+
+def _sorted_unique(values):
+    values = np.sort(values, kind='mergesort')
+    distinct = np.ones(len(values), dtype=bool)
+    distinct[1:] = values[1:] != values[:-1]
+    return values[distinct]
+
+class IntervalList(object):
+    """
+    A list of genomic intervals held as parallel NumPy arrays:
+      contigs: index of each interval's contig in seqdict
+      starts, ends: 1-based inclusive coordinates (as in a Picard interval_list)
+      names: target names (an object array), or None if the intervals are unnamed
+    along with the SequenceDictionary that the contig indices refer to and
+    the header lines to write in front of the intervals in an interval_list.
+
+    All operations return a new IntervalList. Strand is not kept (GATK
+    ignores it) and is written as '+'.
+    """
+    def __init__(self, seqdict, contigs, starts, ends, names=None, header_lines=None):
+        self.seqdict = seqdict
+        self.contigs = np.asarray(contigs, dtype=np.int64)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        self.names = np.asarray(names, dtype=object) if names is not None else None
+        self.header_lines = header_lines
+        if not (len(self.contigs) == len(self.starts) == len(self.ends)) or \
+           (self.names is not None and len(self.names) != len(self.contigs)):
+            raise errors.InvalidArgumentError("IntervalList needs the same number of contigs, starts, ends and names")
+
+    def __len__(self):
+        return len(self.contigs)
+
+    def lengths(self):
+        return self.ends - self.starts + 1
+
+    def total_length(self):
+        return int(self.lengths().sum())
+
+    def _offsets(self):
+        return np.array(self.seqdict.offsets, dtype=np.int64)
+
+    def _take(self, idx):
+        return IntervalList(self.seqdict, self.contigs[idx], self.starts[idx], self.ends[idx],
+                            names=self.names[idx] if self.names is not None else None,
+                            header_lines=self.header_lines)
+
+    def _from_genome(self, genome_starts, genome_ends):
+        """
+        Builds an unnamed IntervalList from 0-based half-open genome-wide
+        coordinates (none of which may span a contig boundary).
+        """
+        offsets = self._offsets()
+        contigs = np.searchsorted(offsets, genome_starts, 'right') - 1
+        return IntervalList(self.seqdict, contigs,
+                            genome_starts - offsets[contigs] + 1,
+                            genome_ends - offsets[contigs],
+                            header_lines=self.header_lines)
+
+    def _genome_coordinates(self):
+        """
+        Returns the 0-based half-open genome-wide (starts, ends).
+        """
+        contig_offsets = self._offsets()[self.contigs]
+        return (contig_offsets + self.starts - 1, contig_offsets + self.ends)
+
+    def _in_dictionary_of(self, other):
+        """
+        Returns this list with its contig indices remapped to other's
+        sequence dictionary, dropping intervals on contigs it does not have.
+        """
+        if self.seqdict is other.seqdict or self.seqdict.names == other.seqdict.names:
+            return self
+        lookup = np.array([other.seqdict.index_of.get(name, -1) for name in self.seqdict.names], dtype=np.int64)
+        contigs = lookup[self.contigs]
+        keep = contigs >= 0
+        return IntervalList(other.seqdict, contigs[keep], self.starts[keep], self.ends[keep],
+                            names=self.names[keep] if self.names is not None else None)
+
+    def sort(self):
+        """
+        Sorts the intervals into sequence dictionary order (by start;
+        intervals with the same start keep their relative order).
+        """
+        genome_starts, genome_ends = self._genome_coordinates()
+        if np.all(genome_starts[1:] >= genome_starts[:-1]):
+            # already sorted (as interval_lists usually are)
+            return self
+        return self._take(np.argsort(genome_starts, kind='mergesort'))
+
+    def merge(self, gap=0):
+        """
+        Sorts the intervals and merges those that overlap, abut or are
+        separated by no more than gap bases. Merged intervals are unnamed.
+        """
+        if len(self) == 0:
+            return IntervalList(self.seqdict, [], [], [], header_lines=self.header_lines)
+        s = self.sort()
+        genome_starts, genome_ends = s._genome_coordinates()
+        # furthest genome position covered by any interval so far
+        reach = np.maximum.accumulate(genome_ends)
+        first = np.ones(len(s), dtype=bool)
+        first[1:] = (genome_starts[1:] > reach[:-1] + gap) | (s.contigs[1:] != s.contigs[:-1])
+        first = np.flatnonzero(first)
+        return IntervalList(self.seqdict, s.contigs[first], s.starts[first],
+                            np.maximum.reduceat(s.ends, first),
+                            header_lines=self.header_lines)
+
+    def pad(self, padding):
+        """
+        Extends each interval by padding bases at both ends, clipped to
+        its contig. The result is not merged.
+        """
+        contig_lengths = np.array(self.seqdict.lengths, dtype=np.int64)[self.contigs]
+        return IntervalList(self.seqdict, self.contigs,
+                            np.maximum(self.starts - padding, 1),
+                            np.minimum(self.ends + padding, contig_lengths),
+                            names=self.names, header_lines=self.header_lines)
+
+    def _combine(self, other, keep):
+        a = self.merge()
+        b = other._in_dictionary_of(self).merge()
+        a_starts, a_ends = a._genome_coordinates()
+        b_starts, b_ends = b._genome_coordinates()
+        # every stretch between consecutive boundaries is either wholly
+        # inside or wholly outside each (merged, so disjoint) list
+        bounds = _sorted_unique(np.concatenate((a_starts, a_ends, b_starts, b_ends)))
+        pieces_starts = bounds[:-1]
+        pieces_ends = bounds[1:]
+        in_a = np.searchsorted(a_starts, pieces_starts, 'right') > np.searchsorted(a_ends, pieces_starts, 'right')
+        in_b = np.searchsorted(b_starts, pieces_starts, 'right') > np.searchsorted(b_ends, pieces_starts, 'right')
+        selected = keep(in_a, in_b)
+        return self._from_genome(pieces_starts[selected], pieces_ends[selected]).merge()
+
+    def intersect(self, other):
+        """
+        Returns the (merged) bases covered by both this list and other.
+        """
+        return self._combine(other, lambda in_a, in_b: in_a & in_b)
+
+    def subtract(self, other):
+        """
+        Returns the (merged) bases covered by this list but not by other
+        (e.g. a blacklist).
+        """
+        return self._combine(other, lambda in_a, in_b: in_a & ~in_b)
+
+    def partition(self, chunks, weight=0):
+        """
+        Splits the intervals, in their current order, into chunks lists
+        of roughly equal weight, where each interval costs weight plus
+        its length in bases. Intervals are split across chunks where
+        necessary (the pieces keep their names). Each chunk ends after
+        int(total weight / chunks) points, except for the last, which
+        takes whatever remains. Returns a list of chunks IntervalLists,
+        some of which may be empty.
+        """
+        if chunks < 1:
+            raise errors.InvalidArgumentError("Cannot partition intervals into %s chunks" % (chunks))
+        if len(self) == 0:
+            return [self._take(slice(0, 0)) for chunk_i in range(0, chunks)]
+        lengths = self.lengths()
+        # weighted coordinates: interval i occupies [weighted_starts[i], weighted_ends[i])
+        # of which the first weight points are its charge and the rest its bases
+        weighted_ends = np.cumsum(lengths + weight)
+        base_starts = weighted_ends - lengths
+        chunk_points = weighted_ends[-1] // chunks
+        cuts = chunk_points * np.arange(1, chunks, dtype=np.int64)
+        # a cut that falls within an interval's charge moves to its first base
+        cuts = np.maximum(cuts, base_starts[np.searchsorted(weighted_ends, cuts, 'right')])
+        bounds = _sorted_unique(np.concatenate((base_starts, weighted_ends, cuts)))
+        pieces_starts = bounds[:-1]
+        pieces_ends = bounds[1:]
+        idx = np.searchsorted(weighted_ends, pieces_starts, 'right')
+        bases = pieces_starts >= base_starts[idx]
+        pieces_starts = pieces_starts[bases]
+        pieces_ends = pieces_ends[bases]
+        idx = idx[bases]
+        starts = self.starts[idx] + (pieces_starts - base_starts[idx])
+        pieces = IntervalList(self.seqdict, self.contigs[idx], starts,
+                              starts + (pieces_ends - pieces_starts) - 1,
+                              names=self.names[idx] if self.names is not None else None,
+                              header_lines=self.header_lines)
+        chunk_of_piece = np.searchsorted(cuts, pieces_starts, 'right')
+        chunk_bounds = np.searchsorted(chunk_of_piece, np.arange(0, chunks + 1), 'left')
+        return [pieces._take(slice(chunk_bounds[chunk_i], chunk_bounds[chunk_i + 1]))
+                for chunk_i in range(0, chunks)]
+
+    def bases_before(self, contig_name, pos):
+        """
+        Returns how many bases of the intervals lie at or before 1-based
+        position pos on contig contig_name (in sequence dictionary order),
+        e.g. to turn a tool's current location into progress.
+        """
+        genome_position = self.seqdict.genome_position(contig_name, pos)
+        genome_starts, genome_ends = self._genome_coordinates()
+        return int(np.clip(genome_position + 1 - genome_starts, 0, self.lengths()).sum())
+
+    def _contig_names(self):
+        return np.array(self.seqdict.names, dtype=object)[self.contigs].tolist()
+
+    def region_strings(self):
+        """
+        Returns the intervals as samtools/GATK style "contig:start-end" regions.
+        """
+        return ["%s:%d-%d" % region for region in zip(self._contig_names(), self.starts.tolist(), self.ends.tolist())]
+
+    def to_interval_list(self, name_prefix=""):
+        """
+        Returns the text of a Picard interval_list: the header lines
+        followed by one line per interval. Each interval's name is
+        prefixed by name_prefix; unnamed intervals are named after their
+        region.
+        """
+        if self.names is not None:
+            names = self.names.tolist()
+        else:
+            names = self.region_strings()
+        body = ["%s\t%d\t%d\t+\t%s%s\n" % interval
+                for interval in zip(self._contig_names(), self.starts.tolist(), self.ends.tolist(),
+                                    [name_prefix] * len(self), names)]
+        return ''.join(list(self.header_lines or []) + body)
+
+    def to_bed(self):
+        """
+        Returns the text of a BED file (0-based, half-open) of the intervals.
+        """
+        columns = [self._contig_names(), (self.starts - 1).tolist(), self.ends.tolist()]
+        if self.names is not None:
+            columns.append(self.names.tolist())
+        return ''.join(["\t".join([str(field) for field in fields]) + "\n" for fields in zip(*columns)])
+
+def concatenate(interval_lists):
+    """
+    Returns one IntervalList holding the intervals of each of
+    interval_lists in turn (which must share a sequence dictionary).
+    """
+    first = interval_lists[0]
+    named = all([interval_list.names is not None for interval_list in interval_lists])
+    return IntervalList(first.seqdict,
+                        np.concatenate([interval_list.contigs for interval_list in interval_lists]),
+                        np.concatenate([interval_list.starts for interval_list in interval_lists]),
+                        np.concatenate([interval_list.ends for interval_list in interval_lists]),
+                        names=np.concatenate([interval_list.names for interval_list in interval_lists]) if named else None,
+                        header_lines=first.header_lines)
+
+def _split_columns(lines, min_columns, file_type):
+    """
+    Splits tab-separated lines into a list of columns. When every line
+    has the same number of fields (the usual case) this is done with a
+    single split of the joined text rather than one split per line.
+    """
+    if len(lines) == 0:
+        return [[] for column_i in range(0, min_columns)]
+    column_count = lines[0].count("\t") + 1
+    text = "".join(lines).replace("\r", "")
+    if not text.endswith("\n"):
+        text += "\n"
+    fields = text.replace("\n", "\t").split("\t")[:-1]
+    if len(fields) != column_count * len(lines):
+        lines = [line.rstrip("\r\n") for line in lines]
+        column_count = min([line.count("\t") + 1 for line in lines])
+        fields = [field for line in lines for field in line.split("\t")[:column_count]]
+    if column_count < min_columns:
+        bad_line = [line for line in lines if line.count("\t") + 1 < min_columns][0]
+        raise errors.InvalidArgumentError("%s has line with %s columns but expected at least %s: [%s]" % (file_type, bad_line.count("\t") + 1, min_columns, bad_line.rstrip("\r\n")))
+    return [fields[column_i::column_count] for column_i in range(0, column_count)]
+
+def _build(seqdict, contig_names, starts, ends, names, header_lines, file_type):
+    try:
+        contigs = np.array([seqdict.index_of[name] for name in contig_names], dtype=np.int64)
+    except KeyError as e:
+        raise errors.InvalidArgumentError("%s has interval on contig %s which is not in the sequence dictionary" % (file_type, e.args[0]))
+    starts = np.array([int(start) for start in starts], dtype=np.int64)
+    ends = np.array([int(end) for end in ends], dtype=np.int64)
+    contig_lengths = np.array(seqdict.lengths, dtype=np.int64)[contigs]
+    bad = np.flatnonzero((starts < 1) | (ends < starts) | (ends > contig_lengths))
+    if len(bad) > 0:
+        i = bad[0]
+        raise errors.InvalidArgumentError("%s has invalid interval %s:%s-%s" % (file_type, contig_names[i], starts[i], ends[i]))
+    return IntervalList(seqdict, contigs, starts, ends, names=names, header_lines=header_lines)
+
+def read_interval_list(lines, seqdict=None):
+    """
+    Parses the lines of a Picard interval_list. Unless seqdict is given,
+    the sequence dictionary is taken from the @SQ lines of its header.
+    """
+    header_count = 0
+    while header_count < len(lines) and lines[header_count].startswith("@"):
+        header_count += 1
+    header_lines = lines[:header_count]
+    if seqdict is None:
+        seqdict = sequence_dictionary.SequenceDictionary.from_dict_lines(
+            header_lines[:1] + [line for line in header_lines if line.startswith("@SQ")])
+    body = [line for line in lines[header_count:] if not line.isspace()]
+    columns = _split_columns(body, 5, "interval_list")
+    if len(columns) != 5:
+        raise errors.InvalidArgumentError("interval_list has lines with %s columns but expected 5" % (len(columns)))
+    return _build(seqdict, columns[0], columns[1], columns[2], columns[4], header_lines, "interval_list")
+
+def read_bed(lines, seqdict, header_lines=None):
+    """
+    Parses the lines of a BED file (0-based, half-open) against seqdict,
+    keeping the fourth column (if any) as the interval names. Track,
+    browser and comment lines are skipped. header_lines are kept for
+    writing the result as an interval_list.
+    """
+    body = [line for line in lines
+            if not line.isspace() and not line.startswith(("#", "track", "browser"))]
+    columns = _split_columns(body, 3, "BED file")
+    starts = [int(start) + 1 for start in columns[1]]
+    return _build(seqdict, columns[0], starts, columns[2],
+                  columns[3] if len(columns) > 3 else None, header_lines, "BED file")
+
+if __name__ == '__main__':
+    print "This module is not intended to be executed as a script"
+    sys.exit(1)
@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+
+import os           # Import the os module for basic path manipulation
+import re
+import sys
+import gzip
+import time
+import struct
+import threading
+import Queue
+
+# Keep FUSE mounts fetch whole Keep blocks (up to 64 MiB) on the first read
+# that touches them, so reading a little every TOUCH_STRIDE bytes of a byte
+# range is enough to bring all of its blocks into the mount's cache
+TOUCH_STRIDE = 1024 * 1024
+TOUCH_SIZE = 4096
+
+# ranges are split into pieces of at most this many bytes so that several
+# threads can warm the blocks of one large range at once
+PIECE_SIZE = 64 * 1024 * 1024
+
+# how much of the start of each data file (headers) to prime
+HEADER_SIZE = 1024 * 1024
+
+# largest compressed BGZF block
+BGZF_MAX_BLOCK_SIZE = 65536
+
+# the .bai/.tbi linear index has one entry per 16 kbp window
+LINEAR_INDEX_SHIFT = 14
+
+def parse_region(region):
+    """
+    Returns (contig, start, end) (1-based, inclusive; end None for to
+    the end of the contig) for a region such as chr1:1000-2000 or chr1.
+    """
+    m = re.match(r'^(.+):(\d+)-(\d+)$', region)
+    if m:
+        return (m.group(1), int(m.group(2)), int(m.group(3)))
+    return (region, 1, None)
+
+def read_regions(interval_file, limit=None):
+    """
+    Returns the first limit (contig, start, end) regions in a Picard
+    interval_list (header lines starting with @ are skipped) or in a
+    three column chunk file (contig, start, end).
+    """
+    regions = []
+    with open(interval_file, 'r') as f:
+        for line in f:
+            if line.startswith("@") or line.strip() == "":
+                continue
+            fields = line.split()
+            regions.append((fields[0], int(fields[1]), int(fields[2])))
+            if limit is not None and len(regions) >= limit:
+                break
+    return regions
+
+def read_fai(fai_file):
+    """
+    Returns (names, index) for a FASTA .fai: the contig names in order and
+    a dict mapping each to (length, offset, linebases, linewidth).
+    """
+    names = []
+    index = {}
+    with open(fai_file, 'r') as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 5:
+                continue
+            names.append(fields[0])
+            index[fields[0]] = tuple([int(x) for x in fields[1:5]])
+    return (names, index)
+
+def fasta_ranges(fai_index, regions):
+    """
+    Returns the byte ranges of the FASTA file holding the bases of regions.
+    """
+    ranges = []
+    for (contig, start, end) in regions:
+        if contig not in fai_index:
+            continue
+        (length, offset, linebases, linewidth) = fai_index[contig]
+        if end is None or end > length:
+            end = length
+        first = offset + (start - 1) // linebases * linewidth + (start - 1) % linebases
+        last = offset + (end - 1) // linebases * linewidth + (end - 1) % linebases
+        ranges.append((first, last + 1))
+    return ranges
+
+def crai_ranges(crai_file, contig_names, regions):
+    """
+    Returns the byte ranges of the CRAM slices overlapping regions,
+    according to its .crai. CRAM refers to contigs by their index in its
+    @SQ header lines, which are taken to be in the order of contig_names
+    (those of the reference it was compressed against).
+    """
+    contig_ids = dict([(name, i) for (i, name) in enumerate(contig_names)])
+    entries = {}
+    with gzip.open(crai_file, 'rb') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 6:
+                continue
+            (seq_id, start, span, container_offset, slice_offset, slice_size) = [int(x) for x in fields[:6]]
+            entries.setdefault(seq_id, []).append((start, start + span - 1, container_offset,
+                                                   container_offset + slice_offset + slice_size))
+    ranges = []
+    for (contig, start, end) in regions:
+        for (entry_start, entry_end, range_start, range_end) in entries.get(contig_ids.get(contig), []):
+            if entry_end >= start and (end is None or entry_start <= end):
+                ranges.append((range_start, range_end))
+    return ranges
+
+def _read_linear_indices(data, pos, n_ref):
+    # each reference has a binning index (skipped) then the linear index
+    linear_indices = []
+    for ref in range(n_ref):
+        (n_bin,) = struct.unpack_from("<i", data, pos)
+        pos += 4
+        for b in range(n_bin):
+            (bin_id, n_chunk) = struct.unpack_from("<Ii", data, pos)
+            pos += 8 + 16 * n_chunk
+        (n_intv,) = struct.unpack_from("<i", data, pos)
+        pos += 4
+        linear_indices.append(struct.unpack_from("<%sQ" % (n_intv), data, pos))
+        pos += 8 * n_intv
+    return linear_indices
+
+def read_tbi(tbi_file):
+    """
+    Returns (names, linear_indices) from a tabix .tbi index.
+    """
+    with gzip.open(tbi_file, 'rb') as f:
+        data = f.read()
+    if data[:4] != "TBI\1":
+        raise ValueError("not a tabix index: %s" % (tbi_file))
+    (n_ref, fmt, col_seq, col_beg, col_end, meta, skip, l_nm) = struct.unpack_from("<8i", data, 4)
+    names = data[36:36 + l_nm].rstrip("\0").split("\0")
+    return (names, _read_linear_indices(data, 36 + l_nm, n_ref))
+
+def read_bai(bai_file):
+    """
+    Returns the linear indices from a BAM .bai index (in @SQ order).
+    """
+    with open(bai_file, 'rb') as f:
+        data = f.read()
+    if data[:4] != "BAI\1":
+        raise ValueError("not a BAM index: %s" % (bai_file))
+    (n_ref,) = struct.unpack_from("<i", data, 4)
+    return _read_linear_indices(data, 8, n_ref)
+
+def linear_index_ranges(contig_names, linear_indices, regions):
+    """
+    Returns the byte ranges of a BGZF file (BAM or tabix indexed VCF)
+    holding the records of regions, according to the linear indices of
+    its .bai or .tbi.
+    """
+    contig_ids = dict([(name, i) for (i, name) in enumerate(contig_names)])
+    ranges = []
+    for (contig, start, end) in regions:
+        ref_id = contig_ids.get(contig)
+        if ref_id is None or ref_id >= len(linear_indices) or len(linear_indices[ref_id]) == 0:
+            continue
+        ioff = linear_indices[ref_id]
+        first = ioff[min((start - 1) >> LINEAR_INDEX_SHIFT, len(ioff) - 1)]
+        if end is None:
+            last = max(ioff)
+        else:
+            last = ioff[min((end - 1) >> LINEAR_INDEX_SHIFT, len(ioff) - 1)]
+        # virtual offsets hold the compressed offset in their upper 48 bits
+        ranges.append((first >> 16, (max(first, last) >> 16) + BGZF_MAX_BLOCK_SIZE))
+    return ranges
+
+def find_index(data_file, extensions):
+    """
+    Returns the first readable data_file with one of its extensions replaced
+    by or followed by one of extensions (e.g. foo.crai or foo.cram.crai),
+    or None.
+    """
+    (base, ext) = os.path.splitext(data_file)
+    for index_ext in extensions:
+        for candidate in [base + index_ext, data_file + index_ext]:
+            if os.access(candidate, os.R_OK):
+                return candidate
+    return None
+
+class Prefetcher(object):
+    """
+    Warms the Keep blocks behind byte ranges of files on a Keep mount by
+    reading a little of every TOUCH_STRIDE bytes of each range, using
+    threads threads in the background, in the order the ranges were
+    added. At most budget bytes of ranges are primed per file, so that
+    only the blocks a tool will touch first are fetched.
+
+    Priming is best effort: files that cannot be read are reported and
+    skipped.
+    """
+    def __init__(self, threads=8, budget=512 * 1024 * 1024):
+        self.threads = threads
+        self.budget = budget
+        self.queue = Queue.Queue()
+        self.queued_bytes = {}
+        self.workers = []
+        self.stopped = False
+        self.lock = threading.Lock()
+        self.touched = 0
+        self.started = None
+        self.finished = None
+
+    def add_ranges(self, path, ranges):
+        """
+        Queues byte ranges (start, end) of path to be primed.
+        """
+        queued = self.queued_bytes.get(path, 0)
+        for (start, end) in ranges:
+            start = max(start, 0)
+            if queued >= self.budget:
+                break
+            end = min(end, start + self.budget - queued)
+            if end <= start:
+                continue
+            queued += end - start
+            for piece_start in range(start, end, PIECE_SIZE):
+                self.queue.put((path, piece_start, min(end, piece_start + PIECE_SIZE)))
+        self.queued_bytes[path] = queued
+
+    def add_file(self, path, limit=None):
+        """
+        Queues the start of path (up to limit bytes, or all of it) to be primed.
+        """
+        try:
+            size = os.path.getsize(path)
+        except OSError as e:
+            print "WARNING: not prefetching %s: %s" % (path, e)
+            return
+        if limit is not None:
+            size = min(size, limit)
+        self.add_ranges(path, [(0, size)])
+
+    def _touch(self, path, start, end):
+        touched = 0
+        with open(path, 'rb') as f:
+            for offset in range(start, end, TOUCH_STRIDE):
+                if self.stopped:
+                    break
+                f.seek(offset)
+                if len(f.read(TOUCH_SIZE)) == 0:
+                    break
+                touched += 1
+        return touched
+
+    def _work(self):
+        while not self.stopped:
+            try:
+                (path, start, end) = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            try:
+                touched = self._touch(path, start, end)
+            except (IOError, OSError) as e:
+                print "WARNING: failed to prefetch %s bytes %s-%s: %s" % (path, start, end, e)
+                continue
+            with self.lock:
+                self.touched += touched
+        with self.lock:
+            self.finished = time.time()
+
+    def start(self):
+        """
+        Starts priming in background threads and returns this Prefetcher.
+        """
+        self.started = time.time()
+        for i in range(self.threads):
+            worker = threading.Thread(target=self._work, name="prefetch-%s" % (i))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        return self
+
+    def wait(self, timeout=None):
+        """
+        Waits up to timeout seconds (or until done) for priming to finish.
+        Returns True if it has.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        for worker in self.workers:
+            if deadline is None:
+                worker.join()
+            else:
+                worker.join(max(0, deadline - time.time()))
+        done = not any([worker.is_alive() for worker in self.workers])
+        if done and self.started is not None:
+            print "Prefetched %s bytes of %s files with %s reads in %.1fs" % (
+                sum(self.queued_bytes.values()), len(self.queued_bytes), self.touched, self.finished - self.started)
+        return done
+
+    def stop(self):
+        """
+        Stops priming (after the reads in progress).
+        """
+        self.stopped = True
+
+def _region_ranges(prefetcher, data_file, regions, contig_names, index_extensions, read_ranges):
+    index_file = find_index(data_file, index_extensions)
+    if index_file is None:
+        print "WARNING: no index found for %s, prefetching its start only" % (data_file)
+        prefetcher.add_file(data_file, limit=HEADER_SIZE)
+        return
+    prefetcher.add_file(index_file)
+    prefetcher.add_file(data_file, limit=HEADER_SIZE)
+    try:
+        prefetcher.add_ranges(data_file, read_ranges(index_file, contig_names, regions))
+    except (IOError, OSError, ValueError, struct.error) as e:
+        print "WARNING: could not work out which parts of %s to prefetch from %s: %s" % (data_file, index_file, e)
+
+def _reference(prefetcher, ref_file, regions):
+    # the tools read the .fai and .dict before any bases
+    (ref_base, ref_ext) = os.path.splitext(ref_file)
+    for index_file in [ref_file + ".fai", ref_base + ".dict"]:
+        if os.access(index_file, os.R_OK):
+            prefetcher.add_file(index_file)
+    contig_names = []
+    try:
+        (contig_names, fai_index) = read_fai(ref_file + ".fai")
+        prefetcher.add_ranges(ref_file, fasta_ranges(fai_index, regions))
+    except (IOError, OSError, ValueError) as e:
+        print "WARNING: could not work out which parts of %s to prefetch: %s" % (ref_file, e)
+    return contig_names
+
+def prime_alignment_inputs(ref_file, alignment_file, regions, max_regions=16, threads=8, budget=512 * 1024 * 1024):
+    """
+    Starts priming, in the background, the parts of ref_file and of
+    alignment_file (a CRAM or BAM, located through its .crai or .bai)
+    that a tool working through regions (from read_regions) will read
+    first: the indices and headers, then the first max_regions regions.
+    Returns the started Prefetcher.
+    """
+    regions = regions[:max_regions]
+    prefetcher = Prefetcher(threads=threads, budget=budget)
+    contig_names = _reference(prefetcher, ref_file, regions)
+    if alignment_file.endswith(".cram"):
+        _region_ranges(prefetcher, alignment_file, regions, contig_names, [".crai"], crai_ranges)
+    else:
+        def bai_ranges(bai_file, contig_names, regions):
+            return linear_index_ranges(contig_names, read_bai(bai_file), regions)
+        _region_ranges(prefetcher, alignment_file, regions, contig_names, [".bai"], bai_ranges)
+    return prefetcher.start()
+
+def prime_vcf_inputs(ref_file, vcf_files, regions, max_regions=16, threads=8, budget=128 * 1024 * 1024):
+    """
+    Starts priming, in the background, the parts of ref_file and of each
+    of vcf_files (bgzipped, located through their .tbi) that a tool
+    working through regions will read first. Returns the started Prefetcher.
+    """
+    regions = regions[:max_regions]
+    prefetcher = Prefetcher(threads=threads, budget=budget)
+    if ref_file is not None:
+        _reference(prefetcher, ref_file, regions)
+    def tbi_ranges(tbi_file, contig_names, regions):
+        (tbi_names, linear_indices) = read_tbi(tbi_file)
+        return linear_index_ranges(tbi_names, linear_indices, regions)
+    for vcf_file in vcf_files:
+        _region_ranges(prefetcher, vcf_file, regions, None, [".tbi"], tbi_ranges)
+    return prefetcher.start()
+
+if __name__ == '__main__':
+    print "This module is not intended to be executed as a script"
+    sys.exit(1)
@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+
+import os           # Import the os module for basic path manipulation
+import arvados      # Import the Arvados sdk module
+import re
+import sys
+import json
+import string
+import hashlib
+import glob
+import fcntl
+import shutil
+import tempfile
+
+from hgi_arvados import errors
+
+# Bump this whenever the layout of the resolved reference dict changes,
+# so that sidecars written by older versions are ignored.
+REFERENCE_METADATA_VERSION = 2
+
+# Name of the JSON file within a reference metadata sidecar collection
+REFERENCE_METADATA_FILE = "reference.json"
+
+# Name given to the sidecar collection for a (version, input PDH)
+REFERENCE_METADATA_NAME = "hgi_arvados reference metadata v%s for %s"
+
+# Marker written into a node-local copy of a reference once it is complete
+LOCAL_COPY_COMPLETE = ".hgi_arvados_complete"
+
+# Buffer size for copying reference files out of Keep
+LOCAL_COPY_BUFFER_SIZE = 16 * 1024 * 1024
+
+# Space to leave free when making a node-local copy of a reference
+LOCAL_COPY_MIN_FREE = 10 * 1024 * 1024 * 1024
+
+# Suffix of the node-local htslib reference cache built for a reference
+REF_CACHE_SUFFIX = ".ref_cache"
+
+# In-process memo of resolved references, keyed by reference_coll
+_resolved_references = {}
+
+def _local_cache_dir():
+    if 'HGI_ARVADOS_REFERENCE_CACHE' in os.environ:
+        return os.environ['HGI_ARVADOS_REFERENCE_CACHE']
+    return os.path.join(os.environ.get('CRUNCH_TMP', tempfile.gettempdir()),
+                        "hgi_arvados_reference_cache")
+
+def _is_portable_data_hash(locator):
+    return re.match(r'^[0-9a-f]{32}\+[0-9]+$', locator) is not None
+
+def _read_local_cache(reference_coll):
+    cache_file = os.path.join(_local_cache_dir(), "%s.v%s.json" % (reference_coll, REFERENCE_METADATA_VERSION))
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        with open(cache_file, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError) as e:
+        print "WARNING: ignoring unreadable local reference cache %s: %s" % (cache_file, e)
+        return None
+
+def _write_local_cache(reference_coll, ref):
+    cache_dir = _local_cache_dir()
+    cache_file = os.path.join(cache_dir, "%s.v%s.json" % (reference_coll, REFERENCE_METADATA_VERSION))
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # write to a temporary file and rename it into place, so that
+        # concurrent tasks never see a partially written cache file
+        fd, tmp_file = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(ref, f)
+        os.rename(tmp_file, cache_file)
+    except (IOError, OSError) as e:
+        print "WARNING: could not write local reference cache %s: %s" % (cache_file, e)
+
+def _read_keep_sidecar(reference_coll):
+    # only trust sidecars written by jobs of the same owner, for the same input
+    name = REFERENCE_METADATA_NAME % (REFERENCE_METADATA_VERSION, reference_coll)
+    sidecars = arvados.api().collections().list(filters=[['name', '=', name],
+                                                         ['owner_uuid', '=', arvados.current_job()['owner_uuid']]],
+                                                select=['portable_data_hash'],
+                                                limit=1).execute(num_retries=3)
+    if len(sidecars['items']) == 0:
+        return None
+    sidecar_pdh = sidecars['items'][0]['portable_data_hash']
+    try:
+        with arvados.CollectionReader(sidecar_pdh).open(REFERENCE_METADATA_FILE) as f:
+            ref = json.loads(f.read(2**30))
+    except Exception as e:
+        print "WARNING: ignoring unreadable reference metadata sidecar %s: %s" % (sidecar_pdh, e)
+        return None
+    if ref.pop('source_pdh', None) != reference_coll:
+        print "WARNING: ignoring reference metadata sidecar %s, which is not for %s" % (sidecar_pdh, reference_coll)
+        return None
+    return ref
+
+def _write_keep_sidecar(reference_coll, ref):
+    name = REFERENCE_METADATA_NAME % (REFERENCE_METADATA_VERSION, reference_coll)
+    sidecar = arvados.CollectionWriter(num_retries=3)
+    sidecar.start_new_file(newfilename=REFERENCE_METADATA_FILE)
+    sidecar.write(json.dumps(dict(ref, source_pdh=reference_coll)))
+    sidecar.finish()
+    try:
+        arvados.api().collections().create(body={"name": name,
+                                                 "owner_uuid": arvados.current_job()['owner_uuid'],
+                                                 "manifest_text": sidecar.manifest_text()},
+                                           ensure_unique_name=True).execute(num_retries=3)
+    except Exception as e:
+        # the sidecar only saves work for later jobs, don't fail this one
+        print "WARNING: could not save reference metadata sidecar %s: %s" % (name, e)
+
+def _prepare_reference(reference_coll):
+    """
+    Checks that the supplied reference_collection has the required
+    files for GATK and bcftools, creates a collection containing only
+    those files and reads the .dict and .fai from it.
+    """
+    # Ensure we have a .fa reference file with corresponding .fai index and .dict
+    # see: http://gatkforums.broadinstitute.org/discussion/1601/how-can-i-prepare-a-fasta-file-to-use-as-reference
+    rcr = arvados.CollectionReader(reference_coll)
+    ref_fasta = {}
+    ref_fai = {}
+    ref_dict = {}
+    ref_input = None
+    found = None
+    for rs in rcr.all_streams():
+        for rf in rs.all_files():
+            if re.search(r'\.fa$', rf.name()):
+                ref_fasta[rs.name(), rf.name()] = rf
+            elif re.search(r'\.fai$', rf.name()):
+                ref_fai[rs.name(), rf.name()] = rf
+            elif re.search(r'\.dict$', rf.name()):
+                ref_dict[rs.name(), rf.name()] = rf
+    for ((s_name, f_name), fasta_f) in ref_fasta.items():
+        fai_f = ref_fai.get((s_name, re.sub(r'fa$', 'fai', f_name)),
+                            ref_fai.get((s_name, re.sub(r'fa$', 'fa.fai', f_name)),
+                                        None))
+        dict_f = ref_dict.get((s_name, re.sub(r'fa$', 'dict', f_name)),
+                              ref_dict.get((s_name, re.sub(r'fa$', 'fa.dict', f_name)),
+                                           None))
+        if fasta_f and fai_f and dict_f:
+            # found a set of all three!
+            ref_input = fasta_f.as_manifest()
+            ref_input += fai_f.as_manifest()
+            ref_input += dict_f.as_manifest()
+            found = (s_name, fasta_f, fai_f, dict_f)
+            break
+    if ref_input is None:
+        raise errors.InvalidArgumentError("Expected a reference fasta with fai and dict in reference_collection. Found [%s]" % ' '.join(rf.name() for rf in rs.all_files()))
+    (s_name, fasta_f, fai_f, dict_f) = found
+
+    # Create a portable data hash for the ref_input manifest
+    r = arvados.api().collections().create(body={"manifest_text": ref_input}).execute()
+    ref_input_pdh = r["portable_data_hash"]
+
+    # Load the dict data
+    dict_lines = dict_f.readlines()
+    if len(dict_lines) == 0 or re.search(r'^@HD', dict_lines[0]) is None:
+        raise errors.InvalidArgumentError("Dict file in reference collection does not have correct header: [%s]" % (dict_lines[0] if dict_lines else ""))
+
+    # Load the fai data
+    fai = []
+    for line in fai_f.readlines():
+        fields = line.rstrip("\n").split("\t")
+        if len(fields) != 5:
+            raise errors.InvalidArgumentError("Fai file in reference collection has malformed line: [%s]" % line)
+        fai.append([fields[0]] + [int(field) for field in fields[1:]])
+
+    return {
+        'ref_pdh': ref_input_pdh,
+        'fasta': os.path.join(s_name, fasta_f.name()),
+        'fai': os.path.join(s_name, fai_f.name()),
+        'dict': os.path.join(s_name, dict_f.name()),
+        'dict_lines': dict_lines,
+        'fai_entries': fai,
+    }
+
+def resolve_reference(reference_coll):
+    """
+    Resolves a reference collection to the files GATK and bcftools need.
+    Returns a dict with:
+      ref_pdh: portable data hash of a collection containing only the
+               reference .fa, .fai and .dict
+      fasta, fai, dict: paths of those files within ref_pdh
+      dict_lines: the lines of the .dict (@HD header then @SQ lines)
+      fai_entries: the .fai as a list of
+                   [name, length, offset, linebases, linewidth]
+    If reference_coll is a portable data hash, the result is cached in
+    this process, in a local cache directory and in a small sidecar
+    collection in Keep, so that only the first job to use a reference
+    has to list and read it.
+    """
+    if reference_coll in _resolved_references:
+        return _resolved_references[reference_coll]
+
+    cacheable = _is_portable_data_hash(reference_coll)
+    ref = None
+    if cacheable:
+        ref = _read_local_cache(reference_coll)
+        if ref is None:
+            ref = _read_keep_sidecar(reference_coll)
+            if ref is not None:
+                print "Using reference metadata sidecar for %s" % (reference_coll)
+                _write_local_cache(reference_coll, ref)
+        else:
+            print "Using locally cached reference metadata for %s" % (reference_coll)
+    if ref is None:
+        print "Preparing reference collection %s" % (reference_coll)
+        ref = _prepare_reference(reference_coll)
+        if cacheable:
+            _write_keep_sidecar(reference_coll, ref)
+            _write_local_cache(reference_coll, ref)
+
+    _resolved_references[reference_coll] = ref
+    return ref
+
+def _copy_reference_files(ref_dir, copy_dir):
+    for root, dirs, files in os.walk(ref_dir):
+        for f in files:
+            src = os.path.join(root, f)
+            dst = os.path.join(copy_dir, os.path.relpath(src, ref_dir))
+            if not os.path.isdir(os.path.dirname(dst)):
+                os.makedirs(os.path.dirname(dst))
+            with open(src, 'rb') as src_f:
+                with open(dst, 'wb') as dst_f:
+                    shutil.copyfileobj(src_f, dst_f, LOCAL_COPY_BUFFER_SIZE)
+            if os.path.getsize(src) != os.path.getsize(dst):
+                raise IOError("copy of %s is %s bytes but should be %s" % (src, os.path.getsize(dst), os.path.getsize(src)))
+
+def _make_local_copy(copy_dir, description, needed, fill):
+    """
+    Makes copy_dir in the local cache directory shared by every task on
+    the node by calling fill(tmp_dir) on a temporary directory (needing
+    about needed bytes) and renaming it into place. The first task to
+    need it fills it while holding a lock on it; tasks starting
+    meanwhile wait for that, and later tasks use it as it is.
+    Returns True if copy_dir is complete, False if it could not be made.
+    """
+    cache_dir = os.path.dirname(copy_dir)
+    if os.path.exists(os.path.join(copy_dir, LOCAL_COPY_COMPLETE)):
+        print "Using node-local %s" % (description)
+        return True
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(copy_dir + ".lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(os.path.join(copy_dir, LOCAL_COPY_COMPLETE)):
+                print "Using node-local %s made by another task" % (description)
+                return True
+            # remove anything left by a task that died while copying
+            for stale in [copy_dir] + glob.glob(copy_dir + ".tmp*"):
+                if os.path.isdir(stale):
+                    shutil.rmtree(stale)
+            stat = os.statvfs(cache_dir)
+            if stat.f_bavail * stat.f_frsize < needed + LOCAL_COPY_MIN_FREE:
+                print "WARNING: not enough space in %s for a node-local %s (%s bytes)" % (cache_dir, description, needed)
+                return False
+            print "Making node-local %s (%s bytes) in %s" % (description, needed, copy_dir)
+            tmp_dir = tempfile.mkdtemp(dir=cache_dir, prefix=os.path.basename(copy_dir) + ".tmp")
+            os.chmod(tmp_dir, 0755)
+            fill(tmp_dir)
+            open(os.path.join(tmp_dir, LOCAL_COPY_COMPLETE), 'w').close()
+            os.rename(tmp_dir, copy_dir)
+    except (IOError, OSError) as e:
+        print "WARNING: could not make a node-local %s: %s" % (description, e)
+        return False
+    return True
+
+def local_reference_dir(ref_pdh, ref_dir):
+    """
+    Returns a node-local copy of the reference files mounted at ref_dir
+    (from the collection ref_pdh), kept in the local cache directory
+    shared by every task on the node. The first task to need a
+    reference copies it in from Keep while holding a lock on it; tasks
+    starting meanwhile wait for that copy, and later tasks read it
+    without touching Keep at all. Falls back to ref_dir (the mount) if
+    ref_pdh is not a portable data hash or the copy cannot be made.
+    """
+    if not _is_portable_data_hash(ref_pdh):
+        return ref_dir
+    copy_dir = os.path.join(_local_cache_dir(), ref_pdh)
+    try:
+        needed = sum([os.path.getsize(os.path.join(root, f)) for root, dirs, files in os.walk(ref_dir) for f in files])
+    except OSError as e:
+        print "WARNING: could not make a node-local copy of reference %s, using the mount: %s" % (ref_pdh, e)
+        return ref_dir
+    if not _make_local_copy(copy_dir, "copy of reference %s" % (ref_pdh), needed,
+                            lambda tmp_dir: _copy_reference_files(ref_dir, tmp_dir)):
+        print "Using the mount of reference %s" % (ref_pdh)
+        return ref_dir
+    return copy_dir
+
+def _read_fai(fai_file):
+    fai = []
+    with open(fai_file, 'r') as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) != 5:
+                raise IOError("Fai file %s has malformed line: [%s]" % (fai_file, line))
+            fai.append([fields[0]] + [int(field) for field in fields[1:]])
+    return fai
+
+def _write_ref_cache(ref_file, fai, cache_dir):
+    with open(ref_file, 'rb') as fasta:
+        for (name, length, offset, linebases, linewidth) in fai:
+            # bytes of the FASTA holding the sequence, including newlines
+            remaining = (length / linebases) * linewidth + length % linebases
+            fasta.seek(offset)
+            md5 = hashlib.md5()
+            seq_file = os.path.join(cache_dir, "sequence.tmp")
+            with open(seq_file, 'wb') as seq_f:
+                while remaining > 0:
+                    data = fasta.read(min(remaining, LOCAL_COPY_BUFFER_SIZE))
+                    if len(data) == 0:
+                        raise IOError("%s ends within sequence %s" % (ref_file, name))
+                    remaining -= len(data)
+                    # as for the M5 of an @SQ line: upper case, no whitespace
+                    data = data.translate(None, string.whitespace).upper()
+                    md5.update(data)
+                    seq_f.write(data)
+            m5 = md5.hexdigest()
+            seq_dir = os.path.join(cache_dir, m5[0:2], m5[2:4])
+            if not os.path.isdir(seq_dir):
+                os.makedirs(seq_dir)
+            os.rename(seq_file, os.path.join(seq_dir, m5[4:]))
+    print "Wrote %s sequences of %s to htslib reference cache %s" % (len(fai), ref_file, cache_dir)
+
+def local_ref_cache(ref_pdh, ref_file):
+    """
+    Returns a REF_PATH/REF_CACHE template (as htslib expects, e.g.
+    "<dir>/%2s/%2s/%s") for an htslib reference cache of the sequences
+    of ref_file (from the collection ref_pdh, with its .fai), kept in
+    the local cache directory shared by every task on the node and
+    built by the first task to need it. CRAM decoding can then find
+    each sequence by the MD5 in the CRAM header in its own small local
+    file, without reading the FASTA. Returns None if ref_pdh is not a
+    portable data hash or the cache cannot be built.
+    """
+    if not _is_portable_data_hash(ref_pdh):
+        return None
+    cache_dir = os.path.join(_local_cache_dir(), ref_pdh + REF_CACHE_SUFFIX)
+    try:
+        fai = _read_fai(ref_file + ".fai")
+    except (IOError, OSError) as e:
+        print "WARNING: could not read the .fai of %s, not building an htslib reference cache: %s" % (ref_file, e)
+        return None
+    if not _make_local_copy(cache_dir, "htslib reference cache for %s" % (ref_pdh),
+                            sum([entry[1] for entry in fai]),
+                            lambda tmp_dir: _write_ref_cache(ref_file, fai, tmp_dir)):
+        return None
+    return os.path.join(cache_dir, "%2s", "%2s", "%s")
+
+def use_local_ref_cache(ref_pdh, ref_file):
+    """
+    Points the htslib tools (samtools, bcftools) this process runs at
+    the node-local reference cache for ref_file (see local_ref_cache),
+    by setting REF_PATH and REF_CACHE in its environment. Returns True
+    if it did, or False (leaving the environment alone) if there is no
+    cache, in which case the tools should be given ref_file.
+    """
+    ref_cache = local_ref_cache(ref_pdh, ref_file)
+    if ref_cache is None:
+        return False
+    os.environ['REF_PATH'] = ref_cache
+    os.environ['REF_CACHE'] = ref_cache
+    print "Set REF_PATH and REF_CACHE to %s" % (ref_cache)
+    return True
+
+if __name__ == '__main__':
+    print "This module is not intended to be executed as a script"
+    sys.exit(1)
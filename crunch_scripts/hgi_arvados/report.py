@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+
+import os           # Import the os module for basic path manipulation
+import re
+import sys
+import json
+import math
+import time
+import calendar
+
+from hgi_arvados import timing
+
+# crunch-job log lines look like:
+#   2016-09-01_12:34:56 zzzzz-8i9sb-0123456789abcde 12345 7 stderr ...
+# where 7 is the job step (crunch-job's own numbering of the tasks it runs)
+LOG_STEP_LINE_RE = re.compile(r'^\S+\s+\S+-8i9sb-\S+\s+\d+\s+(\d+)\s+(.*)$')
+LOG_JOB_TASK_RE = re.compile(r'^job_task (\S+-ot0gb-\S+)')
+LOG_CHILD_STARTED_RE = re.compile(r'^child \d+ started on (\S+)\.(\d+)')
+CRUNCHSTAT_CPU_RE = re.compile(r'^stderr crunchstat: cpu ([\d.]+) user ([\d.]+) sys')
+CRUNCHSTAT_RSS_RE = re.compile(r'^stderr crunchstat: mem .*?(\d+) rss')
+
+# stages reported from the startup profile of a timing summary
+STARTUP_STAGES = [
+    ("startup: to timing import", 'to_timing_import'),
+    ("startup: to first span", 'to_first_span'),
+    ("startup: to first tool", 'to_first_tool'),
+]
+
+# task parameters that identify the chunk of work a task did, in order of preference
+TASK_LABEL_PARAMS = ['chunk', 'interval', 'name', 'input', 'inputs']
+
+def parse_api_time(api_time):
+    """
+    Returns seconds since the epoch for an API timestamp such as
+    2016-09-01T12:34:56.789Z, or None.
+    """
+    if not api_time:
+        return None
+    seconds = calendar.timegm(time.strptime(api_time[:19], "%Y-%m-%dT%H:%M:%S"))
+    m = re.match(r'^\.(\d+)', api_time[19:])
+    if m:
+        seconds += float("0." + m.group(1))
+    return seconds
+
+def percentile(values, p):
+    """
+    Returns the p-th percentile (nearest rank) of values, or None if
+    there are none.
+    """
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    rank = int(math.ceil(p / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+def parse_job_log(lines):
+    """
+    Parses the lines of a crunch-job log, returning a dict mapping each
+    job step to what the log says about it: the task uuid, the node and
+    slot it ran on, its largest crunchstat rss, its crunchstat cpu
+    seconds and its timing summary (see hgi_arvados.timing).
+    """
+    steps = {}
+    for line in lines:
+        m = LOG_STEP_LINE_RE.match(line.rstrip("\n"))
+        if m is None:
+            continue
+        step = steps.setdefault(int(m.group(1)), {'task_uuid': None, 'node': None, 'slot': None,
+                                                  'max_rss': None, 'cpu_seconds': None, 'summary': None})
+        message = m.group(2)
+        if message.startswith("stderr "):
+            if message.startswith("stderr crunchstat: "):
+                cpu_m = CRUNCHSTAT_CPU_RE.match(message)
+                if cpu_m:
+                    # crunchstat reports cumulative cpu time, so keep the last
+                    step['cpu_seconds'] = float(cpu_m.group(1)) + float(cpu_m.group(2))
+                    continue
+                rss_m = CRUNCHSTAT_RSS_RE.match(message)
+                if rss_m:
+                    step['max_rss'] = max(step['max_rss'], int(rss_m.group(1)))
+                continue
+            summary_index = message.find(timing.SUMMARY_LOG_PREFIX)
+            if summary_index >= 0:
+                try:
+                    step['summary'] = json.loads(message[summary_index + len(timing.SUMMARY_LOG_PREFIX):])
+                except ValueError:
+                    print "WARNING: could not parse timing summary in log line: %s" % (line.rstrip("\n"))
+            continue
+        task_m = LOG_JOB_TASK_RE.match(message)
+        if task_m:
+            step['task_uuid'] = task_m.group(1)
+            continue
+        child_m = LOG_CHILD_STARTED_RE.match(message)
+        if child_m:
+            step['node'] = child_m.group(1)
+            step['slot'] = int(child_m.group(2))
+    return steps
+
+def read_job_log(collection_reader):
+    """
+    Parses every file in the log collection of a job (see parse_job_log).
+    """
+    steps = {}
+    for s in collection_reader.all_streams():
+        for f in s.all_files():
+            steps.update(parse_job_log(f.readlines()))
+    return steps
+
+def read_timing_summaries(collection_reader):
+    """
+    Returns the timing summaries (by task uuid) written by
+    hgi_arvados.timing.write_summary into a job or task output.
+    """
+    summaries = {}
+    for s in collection_reader.all_streams():
+        if not timing.is_summary_path(s.name()):
+            continue
+        for f in s.all_files():
+            if not re.search(r'\.json$', f.name()):
+                continue
+            try:
+                summary = json.loads(''.join(f.readall()))
+            except ValueError:
+                print "WARNING: could not parse timing summary %s/%s" % (s.name(), f.name())
+                continue
+            summaries[summary.get('task_uuid') or f.name()[:-len(".json")]] = summary
+    return summaries
+
+def task_label(task):
+    """
+    Returns a short description of the chunk of work a task did, from
+    the first of its TASK_LABEL_PARAMS.
+    """
+    parameters = task.get('parameters') or {}
+    for param in TASK_LABEL_PARAMS:
+        if parameters.get(param):
+            return os.path.basename(str(parameters[param]).rstrip("/"))
+    return task['uuid']
+
+def _stats(values):
+    return {
+        'count': len(values),
+        'total': sum(values),
+        'p50': percentile(values, 50),
+        'p90': percentile(values, 90),
+        'p99': percentile(values, 99),
+        'max': max(values) if values else None,
+    }
+
+def _max_concurrency(intervals):
+    events = []
+    for (start, finish) in intervals:
+        events.append((start, 1))
+        events.append((finish, -1))
+    concurrency = 0
+    peak = 0
+    # finishes sort before starts at the same time, so back to back tasks share a slot
+    for (when, change) in sorted(events):
+        concurrency += change
+        peak = max(peak, concurrency)
+    return peak
+
+def build_report(job, tasks, log_steps=None, summaries=None, slowest=20):
+    """
+    Builds a performance report for job from its job_tasks, the parsed
+    job log (see parse_job_log) and any timing summaries found in its
+    output (see read_timing_summaries). The report is a dict with:
+      stages     percentiles of the seconds each task spent in each timing
+                 span and starting up, and of task run time, rss and cpu
+                 utilisation
+      slowest    the slowest tasks, labelled by the chunk they worked on
+      nodes      per node packing efficiency: task seconds run on the
+                 node over (slots used x time the node was in use)
+      sequences  the critical path: crunch runs the task sequences one
+                 after another, so the job cannot finish sooner than the
+                 sum over sequences of the longest task in each, plus
+                 the gaps between sequences
+    """
+    log_steps = log_steps or {}
+    summaries = dict(summaries or {})
+
+    # log summaries include the spans after write_summary, so prefer them
+    step_by_task = {}
+    for step in log_steps.values():
+        if step['task_uuid'] is not None:
+            step_by_task[step['task_uuid']] = step
+            if step['summary'] is not None:
+                summaries[step['task_uuid']] = step['summary']
+
+    rows = []
+    for task in tasks:
+        started = parse_api_time(task.get('started_at'))
+        finished = parse_api_time(task.get('finished_at'))
+        summary = summaries.get(task['uuid'])
+        step = step_by_task.get(task['uuid'], {})
+        seconds = None
+        if started is not None and finished is not None:
+            seconds = finished - started
+        elif summary is not None:
+            seconds = summary['elapsed']
+        node = step.get('node')
+        if node is None and summary is not None:
+            node = summary.get('hostname')
+        rows.append({
+            'uuid': task['uuid'],
+            'sequence': task.get('sequence'),
+            'label': task_label(task),
+            'success': task.get('success'),
+            'reused': 'reuse_job_task' in (task.get('parameters') or {}),
+            'started': started,
+            'finished': finished,
+            'seconds': seconds,
+            'node': node,
+            'max_rss': step.get('max_rss'),
+            'cpu_seconds': step.get('cpu_seconds'),
+            'summary': summary,
+        })
+
+    # per stage percentiles
+    stage_seconds = {}
+    stage_bytes = {}
+    for row in rows:
+        if row['summary'] is None:
+            continue
+        for (name, total) in row['summary']['totals'].items():
+            stage_seconds.setdefault(name, []).append(total['seconds'])
+            stage_bytes[name] = stage_bytes.get(name, 0) + total['bytes']
+        # summaries written before startup profiles have none
+        startup = row['summary'].get('startup') or {}
+        startup_seconds = [(name, startup.get(key)) for (name, key) in STARTUP_STAGES]
+        startup_seconds += [("startup: import %s" % (module), seconds) for (module, seconds) in (startup.get('imports') or {}).items()]
+        for (name, seconds) in startup_seconds:
+            if seconds is not None:
+                stage_seconds.setdefault(name, []).append(seconds)
+                stage_bytes.setdefault(name, 0)
+    stages = {}
+    for (name, values) in stage_seconds.items():
+        stages[name] = _stats(values)
+        stages[name]['bytes'] = stage_bytes[name]
+    timed_rows = [row for row in rows if row['seconds'] is not None and not row['reused']]
+    stages['task run time'] = _stats([row['seconds'] for row in timed_rows])
+    resources = {
+        'max rss (MiB)': _stats([row['max_rss'] / 1048576.0 for row in rows if row['max_rss'] is not None]),
+        'cpu utilisation': _stats([row['cpu_seconds'] / row['seconds'] for row in timed_rows
+                                   if row['cpu_seconds'] is not None and row['seconds'] > 0]),
+    }
+
+    # slowest chunks
+    slowest_rows = sorted(timed_rows, key=lambda row: row['seconds'], reverse=True)[:slowest]
+    slowest_tasks = [dict((k, row[k]) for k in ('uuid', 'sequence', 'label', 'node', 'seconds', 'success'))
+                     for row in slowest_rows]
+
+    # node packing
+    nodes = {}
+    for row in timed_rows:
+        if row['node'] is None or row['started'] is None or row['finished'] is None:
+            continue
+        nodes.setdefault(row['node'], []).append((row['started'], row['finished']))
+    node_report = {}
+    for (node, intervals) in nodes.items():
+        slots = _max_concurrency(intervals)
+        busy = sum([finish - start for (start, finish) in intervals])
+        in_use = max([finish for (start, finish) in intervals]) - min([start for (start, finish) in intervals])
+        efficiency = None
+        if slots > 0 and in_use > 0:
+            efficiency = busy / (slots * in_use)
+        node_report[node] = {'tasks': len(intervals), 'slots': slots, 'busy_seconds': busy,
+                             'in_use_seconds': in_use, 'efficiency': efficiency}
+
+    # critical path through the sequences
+    by_sequence = {}
+    for row in rows:
+        by_sequence.setdefault(row['sequence'], []).append(row)
+    sequences = []
+    last_finished = parse_api_time(job.get('started_at'))
+    critical_seconds = 0.0
+    for sequence in sorted(by_sequence.keys()):
+        seq_rows = [row for row in by_sequence[sequence] if row['seconds'] is not None]
+        entry = {'sequence': sequence, 'tasks': len(by_sequence[sequence]),
+                 'longest': None, 'wall_seconds': None, 'gap_seconds': None}
+        if len(seq_rows) > 0:
+            longest = max(seq_rows, key=lambda row: row['seconds'])
+            entry['longest'] = {'uuid': longest['uuid'], 'label': longest['label'], 'seconds': longest['seconds']}
+            critical_seconds += longest['seconds']
+            starts = [row['started'] for row in seq_rows if row['started'] is not None]
+            finishes = [row['finished'] for row in seq_rows if row['finished'] is not None]
+            if starts and finishes:
+                entry['wall_seconds'] = max(finishes) - min(starts)
+                if last_finished is not None:
+                    entry['gap_seconds'] = min(starts) - last_finished
+                last_finished = max(finishes)
+        sequences.append(entry)
+
+    job_seconds = None
+    if job.get('started_at') and job.get('finished_at'):
+        job_seconds = parse_api_time(job['finished_at']) - parse_api_time(job['started_at'])
+    return {
+        'job_uuid': job['uuid'],
+        'script': job.get('script'),
+        'job_seconds': job_seconds,
+        'tasks': len(rows),
+        'tasks_with_timing': len([row for row in rows if row['summary'] is not None]),
+        'stages': stages,
+        'resources': resources,
+        'slowest': slowest_tasks,
+        'nodes': node_report,
+        'sequences': sequences,
+        'critical_path_seconds': critical_seconds,
+    }
+
+def _fmt(value, pattern="%.1f"):
+    if value is None:
+        return "-"
+    return pattern % (value)
+
+def format_report(report):
+    """
+    Returns report (see build_report) as text.
+    """
+    lines = []
+    lines.append("Job %s (%s): %s tasks, %s with timing summaries, %s s" % (
+        report['job_uuid'], report['script'], report['tasks'], report['tasks_with_timing'], _fmt(report['job_seconds'])))
+    lines.append("")
+    lines.append("%-28s %8s %12s %10s %10s %10s %10s %12s" % ("stage (s per task)", "tasks", "total", "p50", "p90", "p99", "max", "MiB/s"))
+    for (name, stats) in sorted(report['stages'].items(), key=lambda item: -item[1]['total']):
+        rate = None
+        if stats.get('bytes') and stats['total'] > 0:
+            rate = stats['bytes'] / 1048576.0 / stats['total']
+        lines.append("%-28s %8s %12s %10s %10s %10s %10s %12s" % (
+            name, stats['count'], _fmt(stats['total']), _fmt(stats['p50']), _fmt(stats['p90']),
+            _fmt(stats['p99']), _fmt(stats['max']), _fmt(rate)))
+    for (name, stats) in sorted(report['resources'].items()):
+        lines.append("%-28s %8s %12s %10s %10s %10s %10s" % (
+            name, stats['count'], "", _fmt(stats['p50'], "%.2f"), _fmt(stats['p90'], "%.2f"),
+            _fmt(stats['p99'], "%.2f"), _fmt(stats['max'], "%.2f")))
+    lines.append("")
+    lines.append("Slowest tasks:")
+    for task in report['slowest']:
+        lines.append("  %10s s  seq %-3s %-40s %s on %s%s" % (
+            _fmt(task['seconds']), task['sequence'], task['label'], task['uuid'], task['node'] or "?",
+            "" if task['success'] else " (not successful)"))
+    lines.append("")
+    lines.append("Node packing (task seconds / (slots x seconds in use)):")
+    for (node, stats) in sorted(report['nodes'].items(), key=lambda item: item[1]['efficiency']):
+        lines.append("  %-24s %6s tasks %3s slots %12s s in use  %s" % (
+            node, stats['tasks'], stats['slots'], _fmt(stats['in_use_seconds']), _fmt(stats['efficiency'], "%.2f")))
+    lines.append("")
+    lines.append("Critical path (%s s):" % (_fmt(report['critical_path_seconds'])))
+    for entry in report['sequences']:
+        longest = entry['longest'] or {'label': "-", 'seconds': None}
+        lines.append("  sequence %-3s %8s tasks  wall %10s s  gap before %8s s  longest %10s s %s" % (
+            entry['sequence'], entry['tasks'], _fmt(entry['wall_seconds']), _fmt(entry['gap_seconds']),
+            _fmt(longest['seconds']), longest['label']))
+    return "\n".join(lines) + "\n"
+
+if __name__ == '__main__':
+    print "This module is not intended to be executed as a script"
+    sys.exit(1)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+import os           # Import the os module for basic path manipulation
+import arvados      # Import the Arvados sdk module
+import sys
+
+import hgi_arvados
+from hgi_arvados import stragglers
+
+# Task parameter holding the size in bytes of a task's main input
+INPUT_BYTES_PARAM = "input_bytes"
+
+# Task parameter holding a task's predicted run time in seconds
+PREDICTED_RUNTIME_PARAM = "predicted_runtime"
+
+# Number of the most recent earlier jobs to learn run times from
+RUNTIME_MODEL_MAX_JOBS = 20
+
+# Most earlier tasks to learn run times from (taken from the most
+# recent jobs first)
+RUNTIME_MODEL_MAX_TASKS = 5000
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) / 2]
+
+class RuntimeModel(object):
+    """
+    Predicts the run times of new tasks from those of the successful
+    tasks at the same sequence of the most recent earlier jobs matching
+    job_filters. Tasks are matched by the value of their key_param
+    (e.g. their interval list chunk) and, where earlier tasks recorded
+    their input_bytes, the run time is scaled by the new task's input
+    size. Tasks that did not do all of their work themselves (reused,
+    handed off tails and speculative duplicates) are left out, and at
+    most max_tasks tasks are looked at.
+    """
+    def __init__(self, job_filters, sequence, key_param, max_jobs=RUNTIME_MODEL_MAX_JOBS,
+                 max_tasks=RUNTIME_MODEL_MAX_TASKS):
+        self.key_param = key_param
+        self.runtimes = {}
+        self.rates = {}
+        self.all_rates = []
+        try:
+            self._load(job_filters, sequence, max_jobs, max_tasks)
+        except Exception as e:
+            # the model only changes the order tasks start in
+            print "WARNING: could not load the run times of earlier tasks: %s" % (e)
+        print "Have run times of earlier tasks for %s values of %s" % (len(self.runtimes), key_param)
+
+    def _load(self, job_filters, sequence, max_jobs, max_tasks):
+        jobs = arvados.api().jobs().list(filters=job_filters,
+                                         order="created_at desc",
+                                         select=['uuid'],
+                                         limit=max_jobs).execute(num_retries=3)
+        job_uuids = [job['uuid'] for job in jobs['items'] if job['uuid'] != arvados.current_job()['uuid']]
+        sampled = 0
+        for job_uuid in job_uuids:
+            for task in hgi_arvados.list_all_by_uuid(arvados.api().job_tasks(),
+                                                     filters=[['job_uuid', '=', job_uuid],
+                                                              ['sequence', '=', str(sequence)],
+                                                              ['success', '=', True],
+                                                              ['output', '!=', hgi_arvados.EMPTY_COLLECTION_PDH]],
+                                                     select=['parameters', 'started_at', 'finished_at'],
+                                                     batch_size=min(1000, max_tasks - sampled)):
+                self._add(task)
+                sampled += 1
+                if sampled >= max_tasks:
+                    return
+
+    def _add(self, task):
+        parameters = task['parameters']
+        if (self.key_param not in parameters or
+            'reuse_job_task' in parameters or
+            'straggler_of' in parameters or
+            stragglers.SPECULATIVE_OF_PARAM in parameters or
+            not task['started_at'] or not task['finished_at']):
+            return
+        runtime = stragglers.api_timestamp(task['finished_at']) - stragglers.api_timestamp(task['started_at'])
+        key = parameters[self.key_param]
+        self.runtimes.setdefault(key, []).append(runtime)
+        if parameters.get(INPUT_BYTES_PARAM, 0) > 0:
+            rate = float(runtime) / parameters[INPUT_BYTES_PARAM]
+            self.rates.setdefault(key, []).append(rate)
+            self.all_rates.append(rate)
+
+    def predict(self, parameters):
+        """
+        Returns the predicted run time in seconds of a task with the
+        given parameters, or None if there is nothing to predict it from.
+        """
+        key = parameters.get(self.key_param, None)
+        input_bytes = parameters.get(INPUT_BYTES_PARAM, 0)
+        if key in self.rates and input_bytes > 0:
+            return _median(self.rates[key]) * input_bytes
+        if key in self.runtimes:
+            return _median(self.runtimes[key])
+        if len(self.all_rates) > 0 and input_bytes > 0:
+            return _median(self.all_rates) * input_bytes
+        return None
+
+    def longest_first(self, new_tasks):
+        """
+        Returns new_tasks (a list of task parameter dicts) in descending
+        order of predicted run time, adding a predicted_runtime
+        parameter to those that have one, so that when they are created
+        in that order the longest tasks start first. Tasks with no
+        prediction go last, largest input first, in their given order
+        otherwise.
+        """
+        predicted = []
+        for (i, parameters) in enumerate(new_tasks):
+            runtime = self.predict(parameters)
+            if runtime is not None:
+                parameters[PREDICTED_RUNTIME_PARAM] = int(runtime)
+            predicted.append((runtime is not None, runtime, parameters.get(INPUT_BYTES_PARAM, 0), -i, parameters))
+        predicted.sort(reverse=True)
+        return [p[-1] for p in predicted]
+
+if __name__ == '__main__':
+    print "This module is not intended to be executed as a script"
+    sys.exit(1)
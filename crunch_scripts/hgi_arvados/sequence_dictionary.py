@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+import re
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+
+from hgi_arvados import errors
+
+class SequenceDictionary(object):
+    """
+    The contigs of a reference, in dictionary order, held in flat arrays
+    rather than per-contig dicts and lists:
+      names: contig names (index i is contig i)
+      lengths: contig lengths
+      offsets: cumulative genome offset of the first base of each contig
+               (offsets[i] = sum of lengths[:i]; offsets[-1] = total length)
+    When built from a .fai, the FASTA layout (byte offset, bases per line
+    and bytes per line of each contig) is kept as well.
+    """
+    def __init__(self, names, lengths, fasta_offsets=None, line_bases=None, line_widths=None):
+        self.names = list(names)
+        self.lengths = array('l', lengths)
+        if len(self.names) != len(self.lengths):
+            raise errors.InvalidArgumentError("SequenceDictionary needs one length per name (have %s names and %s lengths)" % (len(self.names), len(self.lengths)))
+        self.index_of = {}
+        for i, name in enumerate(self.names):
+            if name in self.index_of:
+                raise errors.InvalidArgumentError("Sequence dictionary has duplicate entry for SN %s" % (name))
+            self.index_of[name] = i
+        self.offsets = array('l', [0])
+        total = 0
+        for length in self.lengths:
+            total += length
+            self.offsets.append(total)
+        self.fasta_offsets = array('l', fasta_offsets) if fasta_offsets is not None else None
+        self.line_bases = array('l', line_bases) if line_bases is not None else None
+        self.line_widths = array('l', line_widths) if line_widths is not None else None
+
+    @classmethod
+    def from_dict_lines(cls, dict_lines):
+        """
+        Parses the lines of a .dict (an @HD line followed by @SQ lines).
+        """
+        if len(dict_lines) == 0 or re.search(r'^@HD', dict_lines[0]) is None:
+            raise errors.InvalidArgumentError("Dict file does not have correct header: [%s]" % (dict_lines[0] if dict_lines else ""))
+        names = []
+        lengths = []
+        for sq in dict_lines[1:]:
+            if not sq.startswith("@SQ"):
+                raise errors.InvalidArgumentError("Dict file contains malformed SQ line: [%s]" % sq)
+            sn = None
+            ln = None
+            for tagval in sq.rstrip("\n").split("\t"):
+                if tagval.startswith("SN:"):
+                    sn = tagval[3:]
+                elif tagval.startswith("LN:"):
+                    ln = tagval[3:]
+                if sn and ln:
+                    break
+            if not (sn and ln):
+                raise errors.InvalidArgumentError("Dict file SQ entry missing required SN and/or LN parameters: [%s]" % sq)
+            names.append(sn)
+            lengths.append(int(ln))
+        return cls(names, lengths)
+
+    @classmethod
+    def from_fai_entries(cls, fai_entries):
+        """
+        Builds a SequenceDictionary from parsed .fai entries
+        ([name, length, offset, linebases, linewidth]).
+        """
+        return cls([entry[0] for entry in fai_entries],
+                   [entry[1] for entry in fai_entries],
+                   fasta_offsets=[entry[2] for entry in fai_entries],
+                   line_bases=[entry[3] for entry in fai_entries],
+                   line_widths=[entry[4] for entry in fai_entries])
+
+    @classmethod
+    def from_reference(cls, ref):
+        """
+        Builds a SequenceDictionary from a reference resolved by
+        hgi_arvados.reference.resolve_reference(), using the .dict for
+        contig order and the .fai for the FASTA layout.
+        """
+        seqdict = cls.from_dict_lines(ref['dict_lines'])
+        fai = dict((entry[0], entry) for entry in ref['fai_entries'])
+        missing = [name for name in seqdict.names if name not in fai]
+        if len(missing) > 0:
+            raise errors.InvalidArgumentError("Reference .fai is missing entries for %s contigs in the .dict (e.g. %s)" % (len(missing), missing[0]))
+        seqdict.fasta_offsets = array('l', [fai[name][2] for name in seqdict.names])
+        seqdict.line_bases = array('l', [fai[name][3] for name in seqdict.names])
+        seqdict.line_widths = array('l', [fai[name][4] for name in seqdict.names])
+        return seqdict
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.index_of
+
+    def total_length(self):
+        return self.offsets[-1]
+
+    def length(self, name):
+        return self.lengths[self.index_of[name]]
+
+    def subset(self, exclude_r):
+        """
+        Returns a new SequenceDictionary without the contigs whose
+        names match the compiled regex exclude_r.
+        """
+        keep = [i for i, name in enumerate(self.names) if not exclude_r.search(name)]
+        def _pick(values):
+            if values is None:
+                return None
+            return [values[i] for i in keep]
+        return SequenceDictionary(_pick(self.names), _pick(self.lengths),
+                                  fasta_offsets=_pick(self.fasta_offsets),
+                                  line_bases=_pick(self.line_bases),
+                                  line_widths=_pick(self.line_widths))
+
+    def genome_position(self, name, pos):
+        """
+        Returns the 0-based genome-wide offset of 1-based position pos on contig name.
+        """
+        return self.offsets[self.index_of[name]] + pos - 1
+
+    def locate(self, genome_position):
+        """
+        Inverse of genome_position: returns (name, 1-based pos).
+        """
+        if genome_position < 0 or genome_position >= self.offsets[-1]:
+            raise ValueError("genome position %s is outside the sequence dictionary" % (genome_position))
+        i = bisect_right(self.offsets, genome_position) - 1
+        return (self.names[i], genome_position - self.offsets[i] + 1)
+
+    def fasta_byte_offset(self, name, pos):
+        """
+        Returns the byte offset in the FASTA of 1-based position pos on
+        contig name (requires the dictionary to have been built with
+        the .fai).
+        """
+        if self.fasta_offsets is None:
+            raise errors.InvalidArgumentError("SequenceDictionary has no FASTA layout (it was not built from a .fai)")
+        i = self.index_of[name]
+        line, column = divmod(pos - 1, self.line_bases[i])
+        return self.fasta_offsets[i] + line * self.line_widths[i] + column
+
+    def weighted_chunks(self, chunks, weight_seq=0):
+        """
+        Splits the contigs into (at most) chunks pieces of roughly equal
+        weight, where each contig (or piece of a contig) costs
+        weight_seq plus its length in bases. Returns a list with one
+        list of (name, start, end) intervals (1-based, inclusive) per
+        chunk; some may be empty.
+
+        This gives exactly the same chunks as the sns.pop(0) loop used
+        previously by the chunking scripts (including charging
+        weight_seq again for the remainder of a contig that has been
+        split across chunks), but finds the end of each chunk by binary
+        search over the cumulative weighted positions of the contigs.
+        """
+        n = len(self.names)
+        # weighted_ends[k] is the cumulative weight up to and including
+        # the weight_seq charge for contig k (i.e. the weighted position
+        # of its first base)
+        weighted_ends = array('l')
+        weighted_starts = array('l')
+        total_points = 0
+        for length in self.lengths:
+            weighted_starts.append(total_points)
+            weighted_ends.append(total_points + weight_seq)
+            total_points += weight_seq + length
+        chunk_points = int(total_points / chunks)
+        if chunk_points <= weight_seq:
+            # no chunk has room for even one contig
+            return [[] for chunk_i in range(0, chunks)]
+
+        result = []
+        i = 0       # current contig
+        start = 1   # first base of contig i that has not been assigned
+        for chunk_i in range(0, chunks):
+            intervals = []
+            result.append(intervals)
+            if i >= n:
+                continue
+            # weighted position at which this chunk's budget runs out
+            budget_end = weighted_starts[i] + (start - 1) + chunk_points
+            # contigs i..last have room for at least one base in this chunk
+            last = min(bisect_left(weighted_ends, budget_end), n) - 1
+            for k in range(i, last + 1):
+                end = min(self.lengths[k], budget_end - weighted_ends[k])
+                intervals.append((self.names[k], start if k == i else 1, end))
+            if last < i:
+                # not even room for the first contig's weight
+                continue
+            if intervals[-1][2] == self.lengths[last]:
+                i = last + 1
+                start = 1
+            else:
+                i = last
+                start = intervals[-1][2] + 1
+        return result
+
+if __name__ == '__main__':
+    print "This module is not intended to be executed as a script"
+    sys.exit(1)
@@ -0,0 +1,443 @@
+#!/usr/bin/env python
+
+import os           # Import the os module for basic path manipulation
+import arvados      # Import the Arvados sdk module
+import re
+import sys
+import time
+import calendar
+import threading
+
+import hgi_arvados
+from hgi_arvados import checkpoints
+from hgi_arvados import prefetch
+
+# GATK ProgressMeter lines give the current location as contig:position
+# (the contig name may itself contain ':', so match up to the last one)
+PROGRESS_METER_LOCATION_RE = re.compile(r'ProgressMeter -\s+(\S+):(\d+)\s')
+
+# Task parameter naming the task that a speculative duplicate duplicates
+SPECULATIVE_OF_PARAM = "speculative_of"
+
+# Name of the collection whose creation claims the output of a task and
+# its speculative duplicate for one of the two
+SPECULATIVE_CLAIM_NAME = "hgi_arvados speculative claim for %s"
+
+# A running task is duplicated once it has run for longer than this
+# percentile of the run times of the tasks that have finished
+SPECULATIVE_PERCENTILE = 0.9
+
+# Least number of finished tasks to take that percentile of
+SPECULATIVE_MIN_FINISHED = 5
+
+# Most recently finished tasks to take that percentile of
+SPECULATIVE_SAMPLE_TASKS = 200
+
+# Seconds between checks by a running task of whether the other task of
+# its speculative pair has won
+SPECULATIVE_WATCH_INTERVAL = 600
+
+def parse_progress_meter_location(line):
+    """
+    Returns the (contig, position) reported by a GATK ProgressMeter
+    line, or None if the line does not give a location.
+    """
+    m = PROGRESS_METER_LOCATION_RE.search(line)
+    if m is None:
+        return None
+    return (m.group(1), int(m.group(2)))
+
+def api_timestamp(api_time):
+    """
+    Returns the seconds since the epoch of an API server timestamp
+    such as 2016-09-01T12:34:56.789Z.
+    """
+    return calendar.timegm(time.strptime(api_time[:19], "%Y-%m-%dT%H:%M:%S"))
+
+class StragglerSupervisor(object):
+    """
+    Tracks the progress of the current task through total_bases bases,
+    reports it as the task's progress at most every report_interval
+    seconds, and at most every check_interval seconds compares it with
+    the other tasks at the same sequence. Once at least
+    min_finished_fraction of those have finished successfully, the task
+    is a straggler if its expected remaining time is more than
+    slow_factor times their median run time.
+    """
+    def __init__(self, total_bases, slow_factor=2.0, min_finished_fraction=0.5,
+                 report_interval=60, check_interval=300):
+        self.task = arvados.current_task()
+        self.total_bases = total_bases
+        self.slow_factor = slow_factor
+        self.min_finished_fraction = min_finished_fraction
+        self.report_interval = report_interval
+        self.check_interval = check_interval
+        self.started = time.time()
+        self.last_report = 0
+        self.last_check = self.started
+        self.straggling = False
+        self.idle_tasks = 0
+        # run times of the other tasks that have finished, by uuid, and
+        # the latest time at which one of them finished
+        self.run_times = {}
+        self.last_finished_at = None
+
+    def progress(self, bases):
+        now = time.time()
+        fraction = 1.0
+        if self.total_bases > 0:
+            fraction = min(1.0, float(bases) / self.total_bases)
+        if now - self.last_report >= self.report_interval:
+            self.last_report = now
+            try:
+                arvados.api().job_tasks().update(uuid=self.task['uuid'],
+                                                 body={'progress': fraction}
+                                                 ).execute()
+            except Exception as e:
+                # progress is only advisory, keep working
+                print "WARNING: could not report task progress: %s" % (e)
+        if not self.straggling and now - self.last_check >= self.check_interval:
+            self.last_check = now
+            self._check(fraction, now)
+
+    def _check(self, fraction, now):
+        job_tasks = arvados.api().job_tasks()
+        same_sequence = [['job_uuid', '=', self.task['job_uuid']],
+                         ['sequence', '=', self.task['sequence']]]
+        # finished tasks do not change, so only fetch those that finished
+        # since the last check
+        finished_filters = same_sequence + [['success', '=', True]]
+        if self.last_finished_at is not None:
+            finished_filters.append(['finished_at', '>=', self.last_finished_at])
+        for sibling in hgi_arvados.list_all_by_uuid(job_tasks, filters=finished_filters,
+                                                    select=['uuid', 'started_at', 'finished_at']):
+            if sibling['started_at'] and sibling['finished_at']:
+                self.run_times[sibling['uuid']] = api_timestamp(sibling['finished_at']) - api_timestamp(sibling['started_at'])
+                self.last_finished_at = max(self.last_finished_at or sibling['finished_at'], sibling['finished_at'])
+        # only count as many unfinished tasks as could still leave
+        # min_finished_fraction of the others finished
+        max_unfinished = sys.maxint
+        if self.min_finished_fraction > 0:
+            max_unfinished = int(len(self.run_times) * (1 - self.min_finished_fraction) / self.min_finished_fraction)
+        unfinished = 0
+        for sibling in hgi_arvados.list_all_by_uuid(job_tasks, filters=same_sequence + [['success', '=', None]],
+                                                    select=['uuid'], batch_size=min(max_unfinished + 2, 1000)):
+            if sibling['uuid'] == self.task['uuid']:
+                continue
+            unfinished += 1
+            if unfinished > max_unfinished:
+                return
+        others = unfinished + len(self.run_times)
+        run_times = self.run_times.values()
+        if others == 0 or len(run_times) < self.min_finished_fraction * others:
+            return
+        run_times.sort()
+        median_run_time = run_times[len(run_times) / 2]
+        elapsed = now - self.started
+        if fraction > 0:
+            expected_remaining = elapsed * (1 - fraction) / fraction
+        else:
+            expected_remaining = float('inf')
+        print "Progress %.1f%% after %.0fs, expect %.0fs more; %s of %s other tasks finished in a median of %ss" % (100 * fraction, elapsed, expected_remaining, len(run_times), others, median_run_time)
+        if expected_remaining > self.slow_factor * median_run_time:
+            print "This task is a straggler"
+            self.straggling = True
+            self.idle_tasks = len(run_times)
+
+def hand_off(interval_list, chunk_name, tasks, chunk_param="chunk"):
+    """
+    Creates up to tasks new tasks at the next sequence, each a copy of the
+    current task except that its chunk_param is a collection holding
+    one equal share of interval_list (as <chunk_name>.tail_N_of_M.interval_list).
+    """
+    this_task = arvados.current_task()
+    for tail_i, tail in enumerate(interval_list.partition(tasks)):
+        if len(tail) == 0:
+            continue
+        tail_name = "%s.tail_%s_of_%s.interval_list" % (chunk_name, tail_i + 1, tasks)
+        tail_c = arvados.collection.CollectionWriter(num_retries=3)
+        tail_c.start_new_file(newfilename=tail_name)
+        tail_c.write(tail.to_interval_list())
+        tail_c.finish()
+        r = arvados.api().collections().create(body={"manifest_text": tail_c.manifest_text()}).execute()
+        new_task_params = dict(this_task['parameters'])
+        new_task_params[chunk_param] = r["portable_data_hash"]
+        # the new task's pieces are different, so it neither resumes
+        # this task's checkpoint nor races this task's duplicate
+        new_task_params.pop(checkpoints.CHECKPOINT_PARAM, None)
+        new_task_params.pop(SPECULATIVE_OF_PARAM, None)
+        new_task_params['straggler_of'] = this_task['uuid']
+        print "Handing off %s bases in %s to a new task" % (tail.total_length(), tail_name)
+        hgi_arvados.create_task(this_task['sequence'] + 1, new_task_params)
+
+def run_chunk_in_pieces(interval_list_file, run_piece, pieces=8, chunk_param="chunk",
+                        max_tail_tasks=None, checkpoint=None, **kwargs):
+    """
+    Runs the current chunk task's work as pieces consecutive parts of
+    interval_list_file. For each part, calls
+    run_piece(piece_interval_list_file, progress_callback), which should
+    run the tool on that interval list (passing each ProgressMeter line
+    to progress_callback, as gatk._execute does) and return its exit code.
+
+    If the task turns out to be a straggler (see StragglerSupervisor,
+    which is given the remaining keyword arguments), the parts that have
+    not been started yet are handed off to new tasks at the next
+    sequence (one per idle task, up to max_tail_tasks) once the current
+    part is done.
+
+    If checkpoint (a checkpoints.TaskCheckpoint) is given, parts that
+    it says finished before the task was run again are restored rather
+    than run, and the output of each part is added to it as it finishes.
+
+    Returns the first non-zero exit code from run_piece, or 0.
+    """
+    # imported here so that importing this module (as runtime_model and
+    # the speculative mode helpers do) does not need numpy
+    from hgi_arvados import intervals
+    with open(interval_list_file, mode="r") as interval_reader:
+        interval_list = intervals.read_interval_list(interval_reader.readlines())
+    piece_lists = [piece for piece in interval_list.partition(pieces) if len(piece) > 0]
+    supervisor = StragglerSupervisor(interval_list.total_length(), **kwargs)
+    chunk_name = os.path.basename(interval_list_file)
+    piece_dir = os.path.join(arvados.current_task().tmpdir, "pieces")
+    if not os.path.isdir(piece_dir):
+        os.makedirs(piece_dir)
+
+    done_bases = 0
+    for piece_i, piece in enumerate(piece_lists):
+        piece_file = os.path.join(piece_dir, "%s.part_%s_of_%s.interval_list" % (chunk_name, piece_i + 1, len(piece_lists)))
+        with open(piece_file, mode="w") as piece_writer:
+            piece_writer.write(piece.to_interval_list())
+
+        def progress_callback(line):
+            location = parse_progress_meter_location(line)
+            if location is not None and location[0] in piece.seqdict:
+                supervisor.progress(done_bases + piece.bases_before(location[0], location[1]))
+
+        if checkpoint is not None and checkpoint.completed(os.path.basename(piece_file)):
+            print "Part %s of %s (%s bases) was finished by an earlier run of this task" % (piece_i + 1, len(piece_lists), piece.total_length())
+            done_bases += piece.total_length()
+            continue
+
+        print "Running part %s of %s (%s bases)" % (piece_i + 1, len(piece_lists), piece.total_length())
+        exit_code = run_piece(piece_file, progress_callback)
+        if exit_code != 0:
+            return exit_code
+        done_bases += piece.total_length()
+        if checkpoint is not None:
+            checkpoint.add(os.path.basename(piece_file), regions=prefetch.read_regions(piece_file))
+        supervisor.progress(done_bases)
+
+        remaining = piece_lists[piece_i + 1:]
+        if supervisor.straggling and len(remaining) > 0:
+            tasks = max(1, supervisor.idle_tasks)
+            if max_tail_tasks is not None:
+                tasks = min(tasks, max_tail_tasks)
+            hand_off(intervals.concatenate(remaining), chunk_name, tasks, chunk_param=chunk_param)
+            break
+    return 0
+
+def speculation_requested():
+    """
+    True if the job's speculative parameter is true.
+    """
+    if 'speculative' in arvados.current_job()['script_parameters']:
+        return str(arvados.current_job()['script_parameters']['speculative']).lower() == 'true'
+    return False
+
+def _original_uuid(task):
+    return task['parameters'].get(SPECULATIVE_OF_PARAM, task['uuid'])
+
+def _claimant(original_uuid):
+    # returns the uuid of the task that claimed the output of original_uuid, or None
+    claims = arvados.api().collections().list(filters=[['name', '=', SPECULATIVE_CLAIM_NAME % (original_uuid)]],
+                                              select=['description'],
+                                              limit=1).execute(num_retries=3)
+    if len(claims['items']) == 0:
+        return None
+    return claims['items'][0]['description']
+
+def _winner(task):
+    """
+    Returns the uuid of whichever of task and its speculative duplicate
+    (or original) has won, or None if neither has yet.
+    """
+    original_uuid = _original_uuid(task)
+    claimant = _claimant(original_uuid)
+    if claimant is not None:
+        return claimant
+    if original_uuid != task['uuid']:
+        # the original may have finished before it was duplicated
+        original = arvados.api().job_tasks().get(uuid=original_uuid).execute(num_retries=3)
+        if original['success'] and original['output'] not in [None, hgi_arvados.EMPTY_COLLECTION_PDH]:
+            return original_uuid
+    return None
+
+def _yield_to(winner_uuid):
+    # finish the current task without output, as a reused task does
+    task = arvados.current_task()
+    print "JobTask %s has already done this task's work, finishing without output" % (winner_uuid)
+    parameters = dict(task['parameters'])
+    parameters['reuse_job_task'] = winner_uuid
+    arvados.api().job_tasks().update(uuid=task['uuid'],
+                                     body={'parameters': parameters}
+                                     ).execute(num_retries=3)
+    # an empty output keeps the job's output to one copy of the work
+    task.set_output(hgi_arvados.EMPTY_COLLECTION_PDH)
+
+def _watch_for_winner():
+    task = arvados.current_task()
+    while True:
+        time.sleep(SPECULATIVE_WATCH_INTERVAL)
+        try:
+            winner = _winner(task)
+            if winner is not None and winner != task['uuid']:
+                _yield_to(winner)
+                sys.stdout.flush()
+                # the tool runs in its own process group, so it has to
+                # be killed explicitly rather than dying with this task
+                hgi_arvados.kill_tools()
+                os._exit(0)
+        except Exception as e:
+            print "WARNING: could not check whether a speculative duplicate has won: %s" % (e)
+
+def exit_if_superseded():
+    """
+    In speculative mode, finishes the current task successfully (with
+    no output and a reuse_job_task parameter naming the winner) if the
+    other task of its speculative pair has already won, and otherwise
+    starts a thread that does the same if that happens while it runs.
+    """
+    if not speculation_requested():
+        return
+    task = arvados.current_task()
+    winner = _winner(task)
+    if winner is not None and winner != task['uuid']:
+        _yield_to(winner)
+        exit(0)
+    watcher = threading.Thread(target=_watch_for_winner)
+    watcher.daemon = True
+    watcher.start()
+
+def _claim(task):
+    # returns the uuid of the task that won the race to claim task's output
+    original_uuid = _original_uuid(task)
+    winner = _winner(task)
+    if winner is not None:
+        return winner
+    try:
+        # collection names are unique per owner, so only one create succeeds
+        arvados.api().collections().create(body={"name": SPECULATIVE_CLAIM_NAME % (original_uuid),
+                                                 "description": task['uuid'],
+                                                 "manifest_text": ""}).execute(num_retries=3)
+        return task['uuid']
+    except Exception as e:
+        claimant = _claimant(original_uuid)
+        if claimant is None:
+            print "WARNING: could not claim the output of %s, keeping this task's output: %s" % (original_uuid, e)
+            return task['uuid']
+        return claimant
+
+def _has_duplicate(task_uuid):
+    # True if a speculative duplicate of task_uuid (a task at the current
+    # task's sequence) has been created
+    task = arvados.current_task()
+    duplicates = arvados.api().job_tasks().list(filters=[['job_uuid', '=', task['job_uuid']],
+                                                         ['sequence', '=', task['sequence']],
+                                                         ['parameters', 'like', "%%%s: %s%%" % (SPECULATIVE_OF_PARAM.replace('_', '\\_'), task_uuid)]],
+                                                select=['uuid'],
+                                                limit=1).execute(num_retries=3)
+    return len(duplicates['items']) > 0
+
+def set_task_output(output_locator):
+    """
+    Sets the current task's (validated) output to output_locator. In
+    speculative mode, a task that has a speculative duplicate (or is
+    one) first claims the output of the pair, and if the other task
+    claimed it first finishes without output instead.
+    """
+    task = arvados.current_task()
+    if speculation_requested():
+        in_pair = SPECULATIVE_OF_PARAM in task['parameters'] or _has_duplicate(task['uuid'])
+        if in_pair:
+            winner = _claim(task)
+            if winner != task['uuid']:
+                _yield_to(winner)
+                return
+    task.set_output(output_locator)
+
+def queue_speculative_duplicates(percentile=SPECULATIVE_PERCENTILE, min_finished=SPECULATIVE_MIN_FINISHED,
+                                 max_duplicates=1):
+    """
+    In speculative mode, called by a task as it finishes successfully.
+    Once no task at its sequence is waiting to start and at least
+    min_finished have finished, queues a speculative duplicate (with
+    the same parameters, at the same sequence) of each of up to
+    max_duplicates running tasks that have been running for longer than
+    percentile of the run times of the (up to SPECULATIVE_SAMPLE_TASKS)
+    most recently finished tasks. Crunch only starts the tasks a task
+    creates once it exits, so each duplicate takes the place this task
+    leaves. Whichever of a task and its duplicate sets its output first
+    (see set_task_output) wins.
+    """
+    if not speculation_requested():
+        return
+    task = arvados.current_task()
+    job_tasks = arvados.api().job_tasks()
+    same_sequence = [['job_uuid', '=', task['job_uuid']],
+                     ['sequence', '=', task['sequence']]]
+    try:
+        # every finishing task gets here, so only ask the API server for
+        # the few tasks this needs rather than listing all of them
+        waiting = job_tasks.list(filters=same_sequence + [['started_at', '=', None],
+                                                          ['success', '=', None]],
+                                 select=['uuid'],
+                                 limit=1).execute(num_retries=3)
+        if len(waiting['items']) > 0:
+            # the queue has not drained yet
+            return
+        now = time.time()
+        running = []
+        for sibling in hgi_arvados.list_all_by_uuid(job_tasks,
+                                                    filters=same_sequence + [['success', '=', None],
+                                                                             ['started_at', '!=', None]],
+                                                    select=['uuid', 'parameters', 'started_at']):
+            if sibling['uuid'] != task['uuid']:
+                running.append((now - api_timestamp(sibling['started_at']), sibling))
+        if len(running) == 0:
+            return
+        finished = job_tasks.list(filters=same_sequence + [['success', '=', True]],
+                                  select=['uuid', 'parameters', 'started_at', 'finished_at'],
+                                  order=['finished_at desc'],
+                                  limit=SPECULATIVE_SAMPLE_TASKS).execute(num_retries=3)
+        run_times = [api_timestamp(sibling['finished_at']) - api_timestamp(sibling['started_at'])
+                     for sibling in finished['items']
+                     if sibling['started_at'] and sibling['finished_at'] and 'reuse_job_task' not in sibling['parameters']]
+        if len(run_times) < min_finished:
+            return
+        run_times.sort()
+        threshold = run_times[int(percentile * (len(run_times) - 1))]
+        duplicated = set([sibling['parameters'][SPECULATIVE_OF_PARAM] for (elapsed, sibling) in running
+                          if SPECULATIVE_OF_PARAM in sibling['parameters']])
+        running.sort(reverse=True)
+        queued = 0
+        for (elapsed, sibling) in running:
+            if queued >= max_duplicates or elapsed <= threshold:
+                break
+            if SPECULATIVE_OF_PARAM in sibling['parameters'] or sibling['uuid'] in duplicated:
+                continue
+            if _has_duplicate(sibling['uuid']):
+                # its duplicate has already finished
+                continue
+            print "JobTask %s has run for %.0fs, longer than %.0f%% of recently finished tasks (%ss), queueing a speculative duplicate" % (sibling['uuid'], elapsed, 100 * percentile, threshold)
+            new_task_params = dict(sibling['parameters'])
+            new_task_params[SPECULATIVE_OF_PARAM] = sibling['uuid']
+            hgi_arvados.create_task(task['sequence'], new_task_params)
+            queued += 1
+    except Exception as e:
+        # duplicates only save time, don't fail this task
+        print "WARNING: could not queue speculative duplicates: %s" % (e)
+
+if __name__ == '__main__':
+    print "This module is not intended to be executed as a script"
+    sys.exit(1)
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+
+import os           # Import the os module for basic path manipulation
+import arvados      # Import the Arvados sdk module
+import re
+import sys
+import json
+import time
+import socket
+import atexit
+import ctypes
+import ctypes.util
+
+# Stream of the task output collection holding the timing summary (only
+# written if the job's timing_summary_output parameter is true)
+SUMMARY_STREAM = "hgi_arvados_timing"
+
+# Prefix of the log line holding the timing summary
+SUMMARY_LOG_PREFIX = "hgi_arvados timing summary: "
+
+# Prefix of the log line holding the startup profile
+STARTUP_LOG_PREFIX = "hgi_arvados startup profile: "
+
+# Environment variable that, if set (as can the job's profile_startup
+# parameter), has the startup profile logged as soon as the first tool
+# is launched
+STARTUP_PROFILE_ENV = "HGI_ARVADOS_PROFILE_STARTUP"
+
+# Name of the span in which scripts run their main tool
+TOOL_SPAN = "run tool"
+
+def _monotonic_clock():
+    """
+    Returns a function giving seconds from a monotonic clock
+    (clock_gettime(CLOCK_MONOTONIC) through ctypes, as Python 2 has no
+    time.monotonic), falling back to time.time.
+    """
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError):
+        return time.time
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    CLOCK_MONOTONIC = 1
+    def monotonic():
+        t = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            return time.time()
+        return t.tv_sec + t.tv_nsec * 1e-9
+    return monotonic
+
+monotonic = _monotonic_clock()
+
+def _process_age():
+    """
+    Returns the seconds since this process started (from /proc), or
+    None if that cannot be read.
+    """
+    try:
+        with open("/proc/self/stat", 'r') as f:
+            stat = f.read()
+        with open("/proc/uptime", 'r') as f:
+            uptime = float(f.read().split()[0])
+        # the fields after the command name (which may contain spaces)
+        # start with the state, making starttime (field 22) the 20th
+        start_ticks = int(stat[stat.rindex(")") + 2:].split()[19])
+        return uptime - float(start_ticks) / os.sysconf('SC_CLK_TCK')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+# Spans finished so far in this process, in the order they finished
+_spans = []
+# Spans currently open, innermost last
+_open_spans = []
+_started = monotonic()
+_summary_logged = False
+# Seconds from the process starting to this module being imported
+_process_age_at_import = _process_age()
+# Seconds taken to import the modules passed to record_import
+_imports = {}
+# When the first span and the first TOOL_SPAN were entered
+_first_span = None
+_first_tool = None
+_startup_logged = False
+
+class Span(object):
+    """
+    Times one phase of a task, as a context manager. Spans may nest;
+    each records its name, the name of the span it is nested in, when
+    it started (seconds since this module was imported), how long it
+    took, how many bytes it moved (see add_bytes) and whether it failed.
+    """
+    def __init__(self, name, nbytes=0):
+        self.name = name
+        self.bytes = nbytes
+        self.parent = None
+        self.start = None
+
+    def add_bytes(self, nbytes):
+        self.bytes += nbytes
+
+    def __enter__(self):
+        global _first_span, _first_tool
+        _log_summary_at_exit()
+        if len(_open_spans) > 0:
+            self.parent = _open_spans[-1].name
+        _open_spans.append(self)
+        self.start = monotonic()
+        if _first_span is None:
+            _first_span = self.start
+        if self.name == TOOL_SPAN and _first_tool is None:
+            _first_tool = self.start
+            if _startup_profile_requested():
+                log_startup()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = monotonic() - self.start
+        _open_spans.remove(self)
+        # exit(0) (as used to end task 0) is not a failure
+        failed = exc_type is not None and not (exc_type is SystemExit and getattr(exc_value, 'code', exc_value) in (None, 0))
+        _spans.append({
+            'name': self.name,
+            'parent': self.parent,
+            'start': round(self.start - _started, 6),
+            'seconds': round(seconds, 6),
+            'bytes': self.bytes,
+            'failed': failed,
+        })
+        return False
+
+def span(name, nbytes=0):
+    """
+    Returns a Span for the phase name, for use as:
+      with timing.span("run tool") as s:
+          ...
+    """
+    return Span(name, nbytes=nbytes)
+
+def file_size(path):
+    """
+    Returns the size of the file at path (following links), or 0 if
+    it cannot be read.
+    """
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def directory_size(path):
+    """
+    Returns the total size of the files under path.
+    """
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            total += file_size(os.path.join(root, f))
+    return total
+
+def is_summary_path(path):
+    """
+    True if path (within a collection) is a timing summary written by
+    write_summary, which input handling should skip.
+    """
+    return re.search(r'(^|/)%s(/|$)' % (SUMMARY_STREAM), path) is not None
+
+def record_import(name, seconds):
+    """
+    Records that importing the module name took seconds, for the
+    startup profile.
+    """
+    _imports[name] = round(seconds, 6)
+
+def startup():
+    """
+    Returns the startup profile of this process: the seconds from the
+    process starting to this module being imported (interpreter start
+    and the imports before it, such as the Arvados SDK), to the first
+    span and to the first "run tool" span (i.e. until the task launched
+    its main tool), along with the seconds taken by the imports passed
+    to record_import. Times not reached yet are None; if the process
+    start cannot be read they count from this module's import instead.
+    """
+    offset = 0.0
+    if _process_age_at_import is not None:
+        offset = _process_age_at_import
+    def since_start(t):
+        if t is None:
+            return None
+        return round(t - _started + offset, 6)
+    return {
+        'to_timing_import': since_start(_started) if _process_age_at_import is not None else None,
+        'to_first_span': since_start(_first_span),
+        'to_first_tool': since_start(_first_tool),
+        'imports': dict(_imports),
+    }
+
+def _startup_profile_requested():
+    if os.environ.get(STARTUP_PROFILE_ENV):
+        return True
+    if 'JOB_UUID' not in os.environ:
+        # not in a crunch job
+        return False
+    # fetches the job record if nothing has yet (the SDK memoizes it)
+    try:
+        script_parameters = arvados.current_job()['script_parameters']
+    except (KeyError, arvados.errors.ApiError):
+        return False
+    return str(script_parameters.get('profile_startup', False)).lower() == 'true'
+
+def log_startup():
+    """
+    Prints the startup profile as a single JSON line (once per process).
+    """
+    global _startup_logged
+    if _startup_logged:
+        return
+    _startup_logged = True
+    profile = startup()
+    profile['script'] = os.path.basename(sys.argv[0]) if sys.argv else None
+    print "%s%s" % (STARTUP_LOG_PREFIX, json.dumps(profile, sort_keys=True))
+    sys.stdout.flush()
+
+def summary():
+    """
+    Returns the spans recorded so far, with the task they belong to and
+    the total time and bytes for each span name.
+    """
+    totals = {}
+    for s in _spans:
+        total = totals.setdefault(s['name'], {'seconds': 0.0, 'bytes': 0, 'count': 0})
+        total['seconds'] = round(total['seconds'] + s['seconds'], 6)
+        total['bytes'] += s['bytes']
+        total['count'] += 1
+    result = {
+        'script': os.path.basename(sys.argv[0]) if sys.argv else None,
+        'hostname': socket.gethostname(),
+        'job_uuid': os.environ.get('JOB_UUID'),
+        'task_uuid': os.environ.get('TASK_UUID'),
+        'sequence': None,
+        'elapsed': round(monotonic() - _started, 6),
+        'spans': list(_spans),
+        'totals': totals,
+        'startup': startup(),
+    }
+    if 'TASK_UUID' in os.environ:
+        try:
+            result['sequence'] = arvados.current_task()['sequence']
+        except (KeyError, arvados.errors.ApiError):
+            pass
+    return result
+
+def log_summary():
+    """
+    Prints the summary as a single JSON line (once per process).
+    """
+    global _summary_logged
+    if _summary_logged:
+        return
+    _summary_logged = True
+    print "%s%s" % (SUMMARY_LOG_PREFIX, json.dumps(summary(), sort_keys=True))
+    sys.stdout.flush()
+
+_at_exit_registered = False
+def _log_summary_at_exit():
+    global _at_exit_registered
+    if not _at_exit_registered:
+        _at_exit_registered = True
+        atexit.register(log_summary)
+
+def _summary_output_requested():
+    if 'JOB_UUID' not in os.environ:
+        return False
+    try:
+        script_parameters = arvados.current_job()['script_parameters']
+    except (KeyError, arvados.errors.ApiError):
+        return False
+    return str(script_parameters.get('timing_summary_output', False)).lower() == 'true'
+
+def write_summary(collection_writer):
+    """
+    If the job's timing_summary_output parameter is true, writes the
+    summary of the spans finished so far to
+    <SUMMARY_STREAM>/<task uuid>.json in collection_writer (the task's
+    output, before it is finished), so that a job's output collects the
+    summaries of all its tasks. Otherwise the summary is only logged
+    (see log_summary).
+    """
+    if not _summary_output_requested():
+        return
+    name = "%s.json" % (os.environ.get('TASK_UUID', "task"))
+    collection_writer.start_new_stream(os.path.join(".", SUMMARY_STREAM))
+    collection_writer.start_new_file(name)
+    collection_writer.write(json.dumps(summary(), sort_keys=True))
+
+if __name__ == '__main__':
+    print "This module is not intended to be executed as a script"
+    sys.exit(1)
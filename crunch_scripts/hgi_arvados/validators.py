@@ -2,19 +2,82 @@ import os           # Import the os module for basic path manipulation
 import arvados      # Import the Arvados sdk module
 import re
 import gzip
+import json
+import time
+
+from hgi_arvados import bgzf
+from hgi_arvados import errors
+from hgi_arvados import gvcf_columnar
+from hgi_arvados import timing
+from hgi_arvados import vcf_stats
 
 BGZF_EOF="\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
 
-def validate_compressed_indexed_vcf_collection(pdh):
+def deep_validation_requested():
+    """
+    Returns True if the deep_validation script parameter of the current
+    job is set to true.
+    """
+    script_parameters = arvados.current_job()['script_parameters']
+    if 'deep_validation' in script_parameters:
+        return str(script_parameters['deep_validation']).lower() in ['true', '1', 'yes']
+    return False
+
+def validate_bgzf_vcf(vcf, tbi, vcf_path, processes=None):
+    """
+    Reads the whole of a BGZF compressed VCF file, checking the header,
+    CRC32 and ISIZE of every block (see bgzf.scan_blocks), and checks
+    that every virtual offset in its .tbi index points into a block.
+    """
+    start_time = time.time()
+    if processes is None and vcf.size() <= bgzf.SCAN_BATCH_SIZE:
+        # not worth starting worker processes for a single batch
+        processes = 1
+    vcf.seek(0)
+    try:
+        (block_offsets, isizes) = bgzf.scan_blocks(vcf, processes=processes)
+    except errors.InvalidArgumentError as e:
+        print "ERROR: VCF %s is corrupt: %s" % (vcf_path, e)
+        return False
+    if len(isizes) == 0 or isizes[-1] != 0:
+        print "ERROR: VCF %s does not end with an empty BGZF block" % (vcf_path)
+        return False
+    try:
+        voffsets = bgzf.tbi_virtual_offsets(tbi.readfrom(0, tbi.size(), num_retries=10))
+        bgzf.check_virtual_offsets(voffsets, block_offsets, isizes, vcf.size())
+    except Exception as e:
+        print "ERROR: index %s does not match VCF %s: %s" % (tbi.name(), vcf_path, e)
+        return False
+    elapsed = max(time.time() - start_time, 0.001)
+    print "Deep validated VCF %s: %s blocks (%s bytes inflated) and %s index offsets in %.1fs (%.1f MiB/s)" % (
+        vcf_path, len(block_offsets), sum(isizes), len(voffsets), elapsed, vcf.size() / elapsed / 1024 / 1024)
+    return True
+
+def validate_compressed_indexed_vcf_collection(pdh, deep=None, processes=None):
+    """
+    Checks that the collection pdh holds bgzipped VCFs, each with a .tbi
+    index. If deep is true (by default, if the job's deep_validation
+    script parameter is true) every block of each VCF is also inflated
+    and checked, as is every offset in its index.
+    """
+    if deep is None:
+        deep = deep_validation_requested()
     reader = arvados.collection.CollectionReader(pdh)
     vcf_files = {}
     vcf_indices = {}
+    vcf_stats_files = {}
     for s in reader.all_streams():
+        if timing.is_summary_path(s.name()):
+            continue
         for f in s.all_files():
             if re.search(r'\.vcf\.gz$', f.name()):
                 vcf_files[(s.name(), f.name())] = f
             elif re.search(r'\.tbi$', f.name()):
                 vcf_indices[(s.name(), f.name())] = f
+            elif vcf_stats.is_stats_path(f.name()):
+                vcf_stats_files[(s.name(), f.name())] = f
+            elif gvcf_columnar.is_store_path(f.name()):
+                continue
             else:
                 print "WARNING: unexpected file in task output - ignoring %s" % (f.name())
 
@@ -62,4 +125,64 @@ def validate_compressed_indexed_vcf_collection(pdh):
             print "ERROR: could not read from compressed VCF: %s" % (e)
             return False
 
+        # verify that the stats sidecar, if there is one, is for this file
+        stats_f = vcf_stats_files.get((stream_name, file_name + vcf_stats.VCF_STATS_SUFFIX), None)
+        if stats_f is not None:
+            try:
+                stats = json.loads(stats_f.readfrom(0, stats_f.size(), num_retries=10))
+            except ValueError as e:
+                print "ERROR: stats sidecar for VCF %s is not valid JSON: %s" % (vcf_path, e)
+                return False
+            if stats.get('size') != vcf.size():
+                print "ERROR: stats sidecar for VCF %s is for a file of %s bytes, not %s" % (vcf_path, stats.get('size'), vcf.size())
+                return False
+
+        if deep and not validate_bgzf_vcf(vcf, tbi, vcf_path, processes=processes):
+            return False
+
+    return True
+
+def validate_gvcf_columnar_collection(pdh):
+    """
+    Checks that every gVCF in the collection pdh has a readable columnar
+    store (see gvcf_columnar) holding as many records as its stats
+    sidecar says it has, if it has one.
+    """
+    reader = arvados.collection.CollectionReader(pdh)
+    files = {}
+    for s in reader.all_streams():
+        for f in s.all_files():
+            files[(s.name(), f.name())] = f
+    for ((stream_name, file_name), vcf) in sorted(files.items()):
+        if not re.search(r'\.vcf\.gz$', file_name):
+            continue
+        store_path = os.path.join(stream_name, file_name + gvcf_columnar.GVCF_COLUMNAR_SUFFIX)
+        store = files.get((stream_name, file_name + gvcf_columnar.GVCF_COLUMNAR_SUFFIX), None)
+        if store is None:
+            print "ERROR: could not find columnar store for gVCF %s" % (os.path.join(stream_name, file_name))
+            return False
+        magic = gvcf_columnar.GVCF_COLUMNAR_MAGIC
+        trailer_size = gvcf_columnar.TRAILER.size
+        if store.size() < len(magic) + trailer_size or store.readfrom(0, len(magic), num_retries=10) != magic:
+            print "ERROR: columnar store %s does not start with the store magic" % (store_path)
+            return False
+        (index_offset, index_length, trailer_magic) = gvcf_columnar.TRAILER.unpack(store.readfrom(store.size() - trailer_size, trailer_size, num_retries=10))
+        if trailer_magic != magic or index_offset + index_length + trailer_size != store.size():
+            print "ERROR: columnar store %s is truncated" % (store_path)
+            return False
+        try:
+            index = json.loads(store.readfrom(index_offset, index_length, num_retries=10))
+        except ValueError as e:
+            print "ERROR: index of columnar store %s is not valid JSON: %s" % (store_path, e)
+            return False
+        if sum([chunk['n'] for (contig, chunks) in index['contigs'] for chunk in chunks]) != index['records']:
+            print "ERROR: chunks of columnar store %s do not add up to its %s records" % (store_path, index['records'])
+            return False
+        stats_f = files.get((stream_name, file_name + vcf_stats.VCF_STATS_SUFFIX), None)
+        if stats_f is not None:
+            stats = json.loads(stats_f.readfrom(0, stats_f.size(), num_retries=10))
+            if stats.get('records') != index['records']:
+                print "ERROR: columnar store %s has %s records but gVCF stats say %s" % (store_path, index['records'], stats.get('records'))
+                return False
+        print "Have columnar store %s with %s records" % (store_path, index['records'])
     return True
@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+
+import os           # Import the os module for basic path manipulation
+import arvados      # Import the Arvados sdk module
+import re
+import sys
+import json
+import zlib
+import struct
+from multiprocessing import Pool
+
+from hgi_arvados import bgzf
+from hgi_arvados import errors
+from hgi_arvados import timing
+
+# Bump this whenever the layout of the stats sidecar changes
+VCF_STATS_VERSION = 1
+
+# Suffix of the stats sidecar written next to each VCF
+VCF_STATS_SUFFIX = ".stats.json"
+
+# Header lines that mark a VCF as a GATK gVCF
+GVCF_HEADER_RE = re.compile(r'^##(GVCFBlock|ALT=<ID=NON_REF,)')
+
+# Most covered or missing intervals to list in a sidecar
+MAX_LISTED_INTERVALS = 1000
+
+def is_stats_path(path):
+    """
+    True if path is a stats sidecar written by write_stats.
+    """
+    return path.endswith(".vcf.gz" + VCF_STATS_SUFFIX)
+
+def _add_interval(intervals, start, end):
+    # appends [start, end] to sorted intervals, merging it with the last
+    # one if they overlap or are adjacent
+    if len(intervals) > 0 and start <= intervals[-1][1] + 1:
+        if end > intervals[-1][1]:
+            intervals[-1][1] = end
+        if start < intervals[-1][0]:
+            intervals[-1][0] = start
+        return
+    intervals.append([start, end])
+
+def _merge_intervals(intervals):
+    merged = []
+    for (start, end) in sorted(intervals):
+        _add_interval(merged, start, end)
+    return merged
+
+def line_stats(lines):
+    """
+    Returns the stats of complete VCF lines: header line count, whether
+    a gVCF header line was seen, malformed record count and a list of
+    segments (runs of records on one contig) as [contig, first_pos,
+    last_end, records, unsorted, covered_intervals, last_pos].
+    """
+    header_lines = 0
+    gvcf_header = False
+    malformed = 0
+    segments = []
+    segment = None
+    for line in lines:
+        if line == "":
+            continue
+        if line.startswith("#"):
+            header_lines += 1
+            if GVCF_HEADER_RE.match(line):
+                gvcf_header = True
+            continue
+        fields = line.split("\t", 8)
+        try:
+            pos = int(fields[1])
+            info = fields[7]
+            if info.startswith("END="):
+                end = int(info[4:].split(";", 1)[0])
+            elif ";END=" in info:
+                end = int(info.split(";END=", 1)[1].split(";", 1)[0])
+            else:
+                end = pos + len(fields[3]) - 1
+        except (IndexError, ValueError):
+            malformed += 1
+            continue
+        contig = fields[0]
+        if segment is None or segment[0] != contig:
+            segment = [contig, pos, end, 0, 0, [], pos]
+            segments.append(segment)
+        elif pos < segment[6]:
+            segment[4] += 1
+        segment[2] = max(segment[2], end)
+        segment[3] += 1
+        segment[6] = pos
+        _add_interval(segment[5], pos, end)
+    return {'header_lines': header_lines, 'gvcf_header': gvcf_header,
+            'malformed': malformed, 'segments': segments}
+
+def batch_text_stats(text):
+    """
+    Returns line_stats for the complete lines of a piece of VCF text,
+    along with the partial lines at its start ('head') and end ('tail')
+    so that they can be joined with those of the neighbouring pieces.
+    """
+    first = text.find("\n")
+    if first < 0:
+        return {'head': text, 'newline': False}
+    last = text.rfind("\n")
+    stats = line_stats(text[first + 1:last].split("\n"))
+    stats.update({'head': text[:first], 'newline': True, 'tail': text[last + 1:]})
+    return stats
+
+class VcfStats(object):
+    """
+    Accumulates the stats of a VCF from the batch_text_stats of its
+    decompressed text, given in order (see bgzf.scan_blocks).
+    """
+    text_function = staticmethod(batch_text_stats)
+
+    def __init__(self):
+        self.header_lines = 0
+        self.gvcf = False
+        self.malformed = 0
+        self.records = 0
+        self.segments = []
+        self._carry = ""
+
+    def _merge(self, stats):
+        self.header_lines += stats['header_lines']
+        self.malformed += stats['malformed']
+        if stats['gvcf_header']:
+            self.gvcf = True
+        for (contig, first, last, records, unsorted, covered, last_pos) in stats['segments']:
+            self.records += records
+            if not self.gvcf:
+                # covered intervals are only kept for gVCFs, which cover
+                # their intervals with a few runs of reference blocks
+                covered = []
+            if len(self.segments) > 0 and self.segments[-1][0] == contig:
+                segment = self.segments[-1]
+                if first < segment[6]:
+                    unsorted += 1
+                segment[2] = max(segment[2], last)
+                segment[3] += records
+                segment[4] += unsorted
+                for (start, end) in covered:
+                    _add_interval(segment[5], start, end)
+                segment[6] = last_pos
+            else:
+                self.segments.append([contig, first, last, records, unsorted, covered, last_pos])
+
+    def add_batch(self, stats):
+        self._carry += stats['head']
+        if not stats['newline']:
+            return
+        self._merge(line_stats([self._carry]))
+        self._merge(stats)
+        self._carry = stats['tail']
+
+    def finish(self):
+        if self._carry != "":
+            self._merge(line_stats([self._carry]))
+            self._carry = ""
+
+    def to_dict(self, regions=None):
+        """
+        Returns the stats as a dict for the sidecar. If regions (a list
+        of (contig, start, end)) are given and the file is a gVCF, the
+        parts of them its records do not cover are listed as missing
+        (regions without an end are not checked).
+        """
+        self.finish()
+        contigs = []
+        covered_by_contig = {}
+        seen = set()
+        split_contigs = []
+        unsorted = 0
+        for (contig, first, last, records, segment_unsorted, covered, last_pos) in self.segments:
+            if contig in seen:
+                split_contigs.append(contig)
+            seen.add(contig)
+            unsorted += segment_unsorted
+            entry = {'contig': contig, 'first': first, 'last': last, 'last_pos': last_pos, 'records': records}
+            if self.gvcf:
+                entry['covered_bases'] = sum([end - start + 1 for (start, end) in covered])
+                entry['covered'] = covered[:MAX_LISTED_INTERVALS]
+                entry['covered_truncated'] = len(covered) > MAX_LISTED_INTERVALS
+                covered_by_contig.setdefault(contig, []).extend(covered)
+            contigs.append(entry)
+        stats = {
+            'version': VCF_STATS_VERSION,
+            'header_lines': self.header_lines,
+            'records': self.records,
+            'malformed_records': self.malformed,
+            'gvcf': self.gvcf,
+            'sorted': unsorted == 0 and len(split_contigs) == 0,
+            'unsorted_records': unsorted,
+            'split_contigs': sorted(set(split_contigs)),
+            'contigs': contigs,
+            'target_bases': None,
+            'missing': None,
+            'missing_bases': None,
+        }
+        if regions is not None and self.gvcf:
+            missing = []
+            targets = {}
+            for (contig, start, end) in regions:
+                if end is not None:
+                    targets.setdefault(contig, []).append((start, end))
+            for contig in sorted(targets.keys()):
+                covered = _merge_intervals(covered_by_contig.get(contig, []))
+                i = 0
+                for (start, end) in _merge_intervals(targets[contig]):
+                    while i < len(covered) and covered[i][1] < start:
+                        i += 1
+                    j = i
+                    while j < len(covered) and covered[j][0] <= end and start <= end:
+                        if covered[j][0] > start:
+                            missing.append([contig, start, covered[j][0] - 1])
+                        start = max(start, covered[j][1] + 1)
+                        j += 1
+                    if start <= end:
+                        missing.append([contig, start, end])
+            stats['target_bases'] = sum([end - start + 1 for contig in targets for (start, end) in _merge_intervals(targets[contig])])
+            stats['missing_bases'] = sum([end - start + 1 for (contig, start, end) in missing])
+            stats['missing'] = missing[:MAX_LISTED_INTERVALS]
+        return stats
+
+def compute_stats(vcf_file, regions=None, processes=None, pool=None):
+    """
+    Reads a local bgzipped VCF once, checking every BGZF block (and the
+    virtual offsets of its .tbi, if it has one) as bgzf.scan_blocks does
+    (with pool, if given) and gathering its stats from the inflated text
+    in the same pass (see VcfStats.to_dict for the use of regions).
+    Returns the stats as a dict; raises InvalidArgumentError if the file
+    or its index is corrupt.
+    """
+    if processes is None and os.path.getsize(vcf_file) <= bgzf.SCAN_BATCH_SIZE:
+        processes = 1
+    if processes == 1:
+        pool = None
+    stats = VcfStats()
+    with open(vcf_file, 'rb') as f:
+        (block_offsets, isizes) = bgzf.scan_blocks(f, processes=processes, stats=stats, pool=pool)
+    if len(isizes) == 0 or isizes[-1] != 0:
+        raise errors.InvalidArgumentError("%s does not end with an empty BGZF block" % (vcf_file))
+    tbi_file = vcf_file + ".tbi"
+    if os.path.exists(tbi_file):
+        with open(tbi_file, 'rb') as f:
+            bgzf.check_virtual_offsets(bgzf.tbi_virtual_offsets(f.read()), block_offsets, isizes, os.path.getsize(vcf_file))
+    result = stats.to_dict(regions)
+    result.update({
+        'file': os.path.basename(vcf_file),
+        'size': os.path.getsize(vcf_file),
+        'blocks': len(block_offsets),
+        'uncompressed_size': sum(isizes),
+        'indexed': os.path.exists(tbi_file),
+    })
+    return result
+
+def write_stats(vcf_file, regions=None, processes=None, pool=None):
+    """
+    Computes the stats of a local VCF (see compute_stats) and writes them
+    to a JSON sidecar next to it. Returns the stats.
+    """
+    stats = compute_stats(vcf_file, regions=regions, processes=processes, pool=pool)
+    with open(vcf_file + VCF_STATS_SUFFIX, 'w') as f:
+        json.dump(stats, f, indent=1, sort_keys=True)
+    print "Wrote stats for %s: %s records on %s contigs, %s missing bases" % (
+        vcf_file, stats['records'], len(stats['contigs']), stats['missing_bases'])
+    return stats
+
+def stats_requested():
+    """
+    True unless the job's vcf_stats parameter is false.
+    """
+    if 'vcf_stats' in arvados.current_job()['script_parameters']:
+        return str(arvados.current_job()['script_parameters']['vcf_stats']).lower() == 'true'
+    return True
+
+def write_dir_stats(out_dir, regions=None, processes=None):
+    """
+    Unless the job's vcf_stats parameter is false, writes a stats
+    sidecar for every VCF in out_dir, checking each for missing parts of
+    the regions given for it in regions (a dict from VCF file name to a
+    list of (contig, start, end)). The VCFs share one pool of worker
+    processes. Returns False, having printed the error, if any VCF or
+    index is corrupt.
+    """
+    if not stats_requested():
+        print "Not scanning output VCFs for stats (vcf_stats is false)"
+        return True
+    if regions is None:
+        regions = {}
+    vcf_files = [f for f in sorted(os.listdir(out_dir)) if f.endswith(".vcf.gz")]
+    pool = None
+    if processes != 1 and any([os.path.getsize(os.path.join(out_dir, f)) > bgzf.SCAN_BATCH_SIZE for f in vcf_files]):
+        if processes is None:
+            processes = bgzf.cpu_count()
+        pool = Pool(processes=processes)
+    try:
+        with timing.span("vcf stats") as span:
+            for f in vcf_files:
+                span.add_bytes(os.path.getsize(os.path.join(out_dir, f)))
+                try:
+                    write_stats(os.path.join(out_dir, f), regions=regions.get(f), processes=processes, pool=pool)
+                except (errors.InvalidArgumentError, IOError, struct.error, zlib.error) as e:
+                    print "ERROR: output VCF %s failed validation: %s" % (f, e)
+                    return False
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return True
+
+def read_stats(vcf_file):
+    """
+    Returns the stats from the sidecar of a (mounted) VCF, or None if it
+    has none or it was written by another version.
+    """
+    stats_file = vcf_file + VCF_STATS_SUFFIX
+    if not os.path.exists(stats_file):
+        return None
+    try:
+        with open(stats_file, 'r') as f:
+            stats = json.load(f)
+    except (IOError, ValueError) as e:
+        print "WARNING: ignoring unreadable stats sidecar %s: %s" % (stats_file, e)
+        return None
+    if stats.get('version') != VCF_STATS_VERSION:
+        return None
+    return stats
+
+def check_complete(stats_by_file):
+    """
+    Returns a list of problems (empty if none) with the VCFs whose
+    sidecar stats are in stats_by_file: missing intervals, unsorted or
+    malformed records, or a size that does not match the file.
+    """
+    problems = []
+    for (vcf_file, stats) in sorted(stats_by_file.items()):
+        if os.path.exists(vcf_file) and os.path.getsize(vcf_file) != stats['size']:
+            problems.append("%s is %s bytes but its stats are for %s bytes" % (vcf_file, os.path.getsize(vcf_file), stats['size']))
+        if stats['missing_bases']:
+            problems.append("%s is missing %s of its %s target bases (first: %s:%s-%s)" % (
+                vcf_file, stats['missing_bases'], stats['target_bases'], stats['missing'][0][0], stats['missing'][0][1], stats['missing'][0][2]))
+        if not stats['sorted']:
+            problems.append("%s is not sorted (%s records out of order, contigs split: %s)" % (
+                vcf_file, stats['unsorted_records'], ",".join(stats['split_contigs'])))
+        if stats['malformed_records'] > 0:
+            problems.append("%s has %s malformed records" % (vcf_file, stats['malformed_records']))
+    return problems
+
+def check_order(ordered_stats):
+    """
+    Returns a list of problems (empty if none) with concatenating VCFs,
+    given as (vcf_file, stats) in the order they are to be joined: a
+    file whose records start before the end of those of the file before
+    it, or that returns to a contig an earlier file has moved past.
+    """
+    problems = []
+    finished = set()
+    last = None
+    for (vcf_file, stats) in ordered_stats:
+        for entry in stats['contigs']:
+            if last is not None and last[1] != entry['contig']:
+                finished.add(last[1])
+            if entry['contig'] in finished:
+                problems.append("%s has records on %s after files that moved past it" % (vcf_file, entry['contig']))
+            elif last is not None and last[1] == entry['contig'] and last[0] != vcf_file and entry['first'] < last[2]:
+                problems.append("%s starts at %s:%s, before the last record of %s (%s)" % (
+                    vcf_file, entry['contig'], entry['first'], last[0], last[2]))
+            last = (vcf_file, entry['contig'], entry['last_pos'])
+    return problems
+
+def check_input_stats(vcf_files, ordered=False):
+    """
+    Checks the VCFs in vcf_files for completeness (see check_complete)
+    and, if ordered, that they can be concatenated in the order given
+    (see check_order), using their stats sidecars instead of reading
+    them. Inputs without a sidecar are not checked. Returns False,
+    having printed the problems, if there are any.
+    """
+    stats = [(vcf_file, read_stats(vcf_file)) for vcf_file in vcf_files]
+    have_stats = [(vcf_file, vcf_stats) for (vcf_file, vcf_stats) in stats if vcf_stats is not None]
+    if len(have_stats) < len(stats):
+        print "Not checking %s of %s input VCFs that have no stats sidecar" % (len(stats) - len(have_stats), len(stats))
+    problems = check_complete(dict(have_stats))
+    if ordered:
+        problems.extend(check_order(have_stats))
+    for problem in problems:
+        print "ERROR: %s" % (problem)
+    return len(problems) == 0
+
+if __name__ == '__main__':
+    print "This module is not intended to be executed as a script"
+    sys.exit(1)
@@ -4,12 +4,115 @@ import hashlib      # Import the hashlib module to compute MD5.
 import os           # Import the os module for basic path manipulation
 import arvados      # Import the Arvados sdk module
 
+# Name of the file (in both the digest_cache collection and in our output)
+# that maps a file's Keep block segments to its MD5 digest. Because each
+# task writes its own copy and crunch concatenates same-named files when
+# it assembles the job output, the output of one run can be passed as the
+# digest_cache of the next.
+DIGEST_CACHE_FILE = 'md5sum.cache'
+
+def segments_key(input_collection, input_path):
+    """
+    Returns a key describing the exact content of input_path: an MD5
+    of its ordered list of Keep block locators (with permission hints
+    stripped) and the byte range used from each. Two files with the
+    same key have identical content, so their digests can be reused
+    without reading any data.
+    """
+    segments = input_collection.find(input_path).segments()
+    key = hashlib.new('md5')
+    for segment in segments:
+        key.update("%s %s %s\n" % (arvados.KeepLocator(segment.locator).stripped(),
+                                   segment.segment_offset,
+                                   segment.range_size))
+    return key.hexdigest()
+
+def load_digest_cache(digest_cache_locator):
+    """
+    Returns a dict mapping segments keys to MD5 digests, read from
+    every md5sum.cache file in the digest_cache collection.
+    """
+    digest_cache = {}
+    if not digest_cache_locator:
+        return digest_cache
+    cache_collection = arvados.CollectionReader(digest_cache_locator)
+    for s in cache_collection.all_streams():
+        for f in s.all_files():
+            if f.name() != DIGEST_CACHE_FILE:
+                continue
+            for line in f.readlines():
+                fields = line.split()
+                if len(fields) == 2:
+                    digest_cache[fields[0]] = fields[1]
+    print "Loaded %s cached digests from %s" % (len(digest_cache), digest_cache_locator)
+    return digest_cache
+
+def write_digests(out, input_id, digests):
+    """
+    Writes md5sum.txt (the MD5 value and input path) and md5sum.cache
+    (the segments key and the MD5 value) for each (input_path, digest,
+    key) in digests.
+    """
+    with out.open('md5sum.txt') as out_file:
+        for input_path, digest, key in digests:
+            out_file.write("{} {}/{}\n".format(digest, input_id,
+                                               os.path.normpath(input_path)))
+    with out.open(DIGEST_CACHE_FILE) as out_file:
+        for input_path, digest, key in digests:
+            out_file.write("{} {}\n".format(key, digest))
+
+def one_task_per_uncached_input_file(if_sequence=0, and_end_task=True):
+    """
+    Like arvados.job_setup.one_task_per_input_file(input_as_path=True),
+    except that files whose segments key is found in the digest_cache
+    collection are not given a task: their cached digest is written
+    directly to this task's output instead.
+    """
+    this_task = arvados.current_task()
+    if if_sequence != this_task['sequence']:
+        return
+
+    job_parameters = arvados.current_job()['script_parameters']
+    input_id = job_parameters['input']
+    digest_cache = load_digest_cache(job_parameters.get('digest_cache'))
+
+    input_collection = arvados.CollectionReader(input_id)
+    cached_digests = []
+    task_count = 0
+    for s in input_collection.all_streams():
+        for f in s.all_files():
+            input_path = os.path.join(s.name(), f.name())
+            key = segments_key(input_collection, input_path)
+            if key in digest_cache:
+                cached_digests.append((input_path, digest_cache[key], key))
+                continue
+            new_task_attrs = {
+                'job_uuid': arvados.current_job()['uuid'],
+                'created_by_job_task_uuid': this_task['uuid'],
+                'sequence': if_sequence + 1,
+                'parameters': {
+                    'input': "%s/%s" % (input_id, input_path),
+                    'segments_key': key
+                }
+            }
+            arvados.api().job_tasks().create(body=new_task_attrs).execute()
+            task_count += 1
+    print "Reused %s cached digests, created %s tasks for the remaining files" % (len(cached_digests), task_count)
+
+    if and_end_task:
+        out = arvados.CollectionWriter()
+        if cached_digests:
+            write_digests(out, input_id, cached_digests)
+        # set_output also marks this task as successfully finished
+        this_task.set_output(out.finish())
+        exit(0)
+
 # Automatically parallelize this job by running one task per file.
 # This means that if the input consists of many files, each file will
 # be processed in parallel on different nodes enabling the job to
-# be completed quicker.
-arvados.job_setup.one_task_per_input_file(if_sequence=0, and_end_task=True,
-                                          input_as_path=True)
+# be completed quicker. Files whose data has already been hashed by a
+# previous run (according to the digest_cache) are not processed again.
+one_task_per_uncached_input_file(if_sequence=0, and_end_task=True)
 
 # Get object representing the current task
 this_task = arvados.current_task()
@@ -31,10 +134,9 @@ with input_collection.open(input_path) as input_file:
 # Write a new collection as output
 out = arvados.CollectionWriter()
 
-# Write an output file with one line: the MD5 value and input path
-with out.open('md5sum.txt') as out_file:
-    out_file.write("{} {}/{}\n".format(digestor.hexdigest(), input_id,
-                                       os.path.normpath(input_path)))
+# Write the MD5 value to md5sum.txt and record it in md5sum.cache
+write_digests(out, input_id, [(input_path, digestor.hexdigest(),
+                               this_task['parameters']['segments_key'])])
 
 # Commit the output to Keep.
 output_locator = out.finish()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""
+Tests for hgi_arvados.cram_slice, on a small CRAM built in memory: a
+file definition, a header container holding the SAM header, a few
+data containers (copied verbatim, so their contents do not matter)
+and the EOF container, stored in Keep blocks listed by a manifest.
+"""
+
+import os
+import sys
+import gzip
+import shutil
+import struct
+import hashlib
+import tempfile
+import unittest
+import threading
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "crunch_scripts"))
+
+from hgi_arvados import cram_slice
+
+SAM_HEADER = "@HD\tVN:1.4\tSO:coordinate\n@SQ\tSN:chr1\tLN:100000\n@SQ\tSN:chr2\tLN:100000\n"
+
+def itf8(value):
+    assert 0 <= value < 0x80
+    return chr(value)
+
+def header_container():
+    text = struct.pack("<i", len(SAM_HEADER)) + SAM_HEADER
+    block = chr(0) + chr(0) + itf8(0) + itf8(len(text)) + itf8(len(text)) + text
+    fields = itf8(0) + itf8(0) + itf8(0) + itf8(0) + chr(0) + chr(0) + itf8(1) + itf8(0) + "\0\0\0\0"
+    return struct.pack("<i", len(block)) + fields + block
+
+def build_cram(containers):
+    """
+    Returns (cram bytes, crai entries) for a CRAM 3.0 with a data
+    container for each (seq_id, start, span) in containers.
+    """
+    data = "CRAM" + chr(3) + chr(0) + "x" * 20 + header_container()
+    entries = []
+    for (i, (seq_id, start, span)) in enumerate(containers):
+        entries.append([seq_id, start, span, len(data), 10, 20])
+        data += ("container %s " % (i)) * 10
+    data += "E" * cram_slice.CRAM_EOF_SIZE[3]
+    return (data, entries)
+
+def gzipped_crai(entries):
+    buf = StringIO()
+    crai = gzip.GzipFile(fileobj=buf, mode='wb')
+    for entry in entries:
+        crai.write("\t".join([str(x) for x in entry]) + "\n")
+    crai.close()
+    return buf.getvalue()
+
+class FakeKeepClient(object):
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.lock = threading.Lock()
+        self.gets = []
+
+    def get(self, locator, num_retries=None):
+        with self.lock:
+            self.gets.append(locator)
+        return self.blocks[locator]
+
+class FakeCollectionReader(object):
+    def __init__(self, manifest_text):
+        self._manifest_text = manifest_text
+
+    def manifest_text(self, normalize=False):
+        return self._manifest_text
+
+def store(files, block_size):
+    """
+    Returns (manifest text, {locator: data}) for one stream "." holding
+    files (a list of (name, data)), split into blocks of block_size.
+    """
+    data = "".join([file_data for (name, file_data) in files])
+    blocks = {}
+    locators = []
+    for start in range(0, len(data), block_size):
+        block = data[start:start + block_size]
+        locator = "%s+%s" % (hashlib.md5(block).hexdigest(), len(block))
+        blocks[locator] = block
+        locators.append(locator)
+    tokens = ["."] + locators
+    pos = 0
+    for (name, file_data) in files:
+        tokens.append("%s:%s:%s" % (pos, len(file_data), name))
+        pos += len(file_data)
+    return (" ".join(tokens) + "\n", blocks)
+
+class FileSegmentsTest(unittest.TestCase):
+    def test_dot_slash_paths(self):
+        (manifest_text, blocks) = store([("a.cram", "a" * 100), ("b.cram", "b" * 50)], 64)
+        expected = [(locator, offset, size, file_offset)
+                    for (locator, offset, size, file_offset) in cram_slice.file_segments(manifest_text, "b.cram")]
+        self.assertEqual(sum([size for (locator, offset, size, file_offset) in expected]), 50)
+        self.assertEqual(cram_slice.file_segments(manifest_text, "./b.cram"), expected)
+
+    def test_sub_stream(self):
+        manifest_text = "./sub 0123456789abcdef0123456789abcdef+10 0:10:x.cram\n"
+        self.assertEqual(cram_slice.file_segments(manifest_text, "./sub/x.cram"),
+                         [("0123456789abcdef0123456789abcdef+10", 0, 10, 0)])
+        self.assertEqual(cram_slice.file_segments(manifest_text, "./x.cram"), [])
+
+class FetchRangesTest(unittest.TestCase):
+    def test_ranges_within_buffer(self):
+        data = "".join([chr(ord('a') + i % 26) * 10 for i in range(100)])
+        (manifest_text, blocks) = store([("f", data)], 32)
+        segments = cram_slice.file_segments(manifest_text, "./f")
+        keep = FakeKeepClient(blocks)
+        out = StringIO()
+        ranges = [(5, 70), (300, 301), (600, 1000)]
+        fetched = cram_slice.fetch_ranges(segments, ranges, out, keep_client=keep, threads=4, max_buffer=64)
+        self.assertEqual(out.getvalue(), "".join([data[start:end] for (start, end) in ranges]))
+        # each block the ranges overlap is fetched exactly once
+        self.assertEqual(len(keep.gets), len(set(keep.gets)))
+        self.assertEqual(fetched, sum([len(blocks[locator]) for locator in keep.gets]))
+
+    def test_block_larger_than_buffer(self):
+        data = "x" * 1000
+        (manifest_text, blocks) = store([("f", data)], 400)
+        out = StringIO()
+        cram_slice.fetch_ranges(cram_slice.file_segments(manifest_text, "f"), [(0, 1000)], out,
+                                keep_client=FakeKeepClient(blocks), threads=2, max_buffer=100)
+        self.assertEqual(out.getvalue(), data)
+
+class WriteSlicedCramTest(unittest.TestCase):
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def test_slices_dot_slash_path(self):
+        (cram, entries) = build_cram([(0, 1, 1000), (0, 1001, 1000), (1, 1, 1000), (1, 1001, 1000)])
+        crai = gzipped_crai(entries)
+        (manifest_text, blocks) = store([("sample.cram", cram), ("sample.cram.crai", crai)], 128)
+        keep = FakeKeepClient(blocks)
+
+        local_cram = cram_slice.write_sliced_cram(FakeCollectionReader(manifest_text),
+                                                  "./sample.cram", "./sample.cram.crai",
+                                                  [("chr1", 1200, 1300), ("chr2", 1, 10)],
+                                                  self.out_dir, keep_client=keep, threads=2)
+
+        self.assertEqual(local_cram, os.path.join(self.out_dir, "sample.cram"))
+        offsets = [entry[3] for entry in entries]
+        ends = offsets[1:] + [len(cram) - cram_slice.CRAM_EOF_SIZE[3]]
+        expected = (cram[:offsets[0]] + cram[offsets[1]:ends[1]] + cram[offsets[2]:ends[2]] +
+                    cram[-cram_slice.CRAM_EOF_SIZE[3]:])
+        with open(local_cram, 'rb') as f:
+            self.assertEqual(f.read(), expected)
+        sliced_entries = cram_slice.read_crai(open(local_cram + ".crai", 'rb').read())
+        self.assertEqual([entry[:3] for entry in sliced_entries], [[0, 1001, 1000], [1, 1, 1000]])
+        self.assertEqual([entry[3] for entry in sliced_entries],
+                         [offsets[0], offsets[0] + ends[1] - offsets[1]])
+
+if __name__ == '__main__':
+    unittest.main()
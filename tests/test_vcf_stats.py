@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+Tests for hgi_arvados.vcf_stats: the intervals a gVCF's stats report as
+missing from the regions it should cover, and the checks made before
+VCFs are concatenated.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "crunch_scripts"))
+
+from hgi_arvados import vcf_stats
+
+GVCF_HEADER = ("##fileformat=VCFv4.2\n"
+               "##GVCFBlock0-1=minGQ=0(inclusive),maxGQ=1(exclusive)\n"
+               "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tsample\n")
+
+VCF_HEADER = ("##fileformat=VCFv4.2\n"
+              "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tsample\n")
+
+def record(contig, pos, ref="A", alt="<NON_REF>", end=None):
+    info = "END=%s" % (end) if end is not None else "."
+    return "%s\t%s\t.\t%s\t%s\t.\t.\t%s\tGT\t0/0\n" % (contig, pos, ref, alt, info)
+
+def text_stats(text, pieces=1):
+    """
+    Returns the VcfStats of text, fed to it in pieces equal parts as the
+    workers of bgzf.scan_blocks would.
+    """
+    stats = vcf_stats.VcfStats()
+    size = len(text) / pieces + 1
+    for start in range(0, len(text), size):
+        stats.add_batch(vcf_stats.batch_text_stats(text[start:start + size]))
+    return stats
+
+def contig_stats(*contigs):
+    """
+    Returns minimal stats (as used by check_order) for a file with
+    records on each (contig, first, last_pos) in contigs.
+    """
+    return {'contigs': [{'contig': contig, 'first': first, 'last': last_pos, 'last_pos': last_pos}
+                        for (contig, first, last_pos) in contigs]}
+
+class MissingIntervalsTest(unittest.TestCase):
+    def setUp(self):
+        self.text = (GVCF_HEADER +
+                     record("chr1", 1, end=100) +
+                     record("chr1", 101, alt="G,<NON_REF>") +
+                     record("chr1", 150, end=200) +
+                     record("chr2", 5, end=10))
+
+    def test_reports_gaps_and_uncovered_ends(self):
+        stats = text_stats(self.text).to_dict([("chr1", 1, 300), ("chr2", 1, 10), ("chr3", 1, 5)])
+        self.assertTrue(stats['gvcf'])
+        self.assertEqual(stats['records'], 4)
+        self.assertEqual(stats['missing'], [["chr1", 102, 149], ["chr1", 201, 300], ["chr2", 1, 4], ["chr3", 1, 5]])
+        self.assertEqual(stats['missing_bases'], 48 + 100 + 4 + 5)
+        self.assertEqual(stats['target_bases'], 300 + 10 + 5)
+
+    def test_fully_covered_regions(self):
+        stats = text_stats(self.text).to_dict([("chr1", 1, 101), ("chr1", 150, 200), ("chr2", 5, 10)])
+        self.assertEqual(stats['missing'], [])
+        self.assertEqual(stats['missing_bases'], 0)
+
+    def test_overlapping_regions_are_merged(self):
+        stats = text_stats(self.text).to_dict([("chr1", 190, 250), ("chr1", 180, 210)])
+        self.assertEqual(stats['missing'], [["chr1", 201, 250]])
+        self.assertEqual(stats['target_bases'], 71)
+
+    def test_regions_without_end_are_not_checked(self):
+        stats = text_stats(self.text).to_dict([("chr3", 1, None)])
+        self.assertEqual(stats['missing'], [])
+        self.assertEqual(stats['target_bases'], 0)
+
+    def test_same_result_from_batches(self):
+        regions = [("chr1", 1, 300), ("chr2", 1, 10)]
+        whole = text_stats(self.text).to_dict(regions)
+        for pieces in [2, 3, 7, 50]:
+            self.assertEqual(text_stats(self.text, pieces).to_dict(regions), whole)
+
+    def test_plain_vcf_is_not_checked(self):
+        text = VCF_HEADER + record("chr1", 10, alt="G") + record("chr1", 20, alt="T")
+        stats = text_stats(text).to_dict([("chr1", 1, 100)])
+        self.assertFalse(stats['gvcf'])
+        self.assertEqual(stats['records'], 2)
+        self.assertEqual(stats['missing'], None)
+        self.assertEqual(stats['missing_bases'], None)
+
+class CheckOrderTest(unittest.TestCase):
+    def test_files_in_order(self):
+        self.assertEqual(vcf_stats.check_order([
+            ("a.vcf.gz", contig_stats(("chr1", 1, 500))),
+            ("b.vcf.gz", contig_stats(("chr1", 501, 900), ("chr2", 1, 50))),
+            ("c.vcf.gz", contig_stats(("chr2", 60, 80), ("chr3", 1, 10))),
+        ]), [])
+
+    def test_file_starting_before_end_of_previous(self):
+        problems = vcf_stats.check_order([
+            ("a.vcf.gz", contig_stats(("chr1", 1, 500))),
+            ("b.vcf.gz", contig_stats(("chr1", 400, 900))),
+        ])
+        self.assertEqual(len(problems), 1)
+        self.assertTrue(problems[0].startswith("b.vcf.gz starts at chr1:400"))
+
+    def test_returning_to_finished_contig(self):
+        problems = vcf_stats.check_order([
+            ("a.vcf.gz", contig_stats(("chr1", 1, 500))),
+            ("b.vcf.gz", contig_stats(("chr2", 1, 100))),
+            ("c.vcf.gz", contig_stats(("chr1", 600, 700))),
+        ])
+        self.assertEqual(problems, ["c.vcf.gz has records on chr1 after files that moved past it"])
+
+    def test_empty_files_are_skipped(self):
+        self.assertEqual(vcf_stats.check_order([
+            ("a.vcf.gz", contig_stats(("chr1", 1, 500))),
+            ("empty.vcf.gz", contig_stats()),
+            ("b.vcf.gz", contig_stats(("chr1", 501, 600))),
+        ]), [])
+
+if __name__ == '__main__':
+    unittest.main()
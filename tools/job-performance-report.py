@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+Reports where the time went in an Arvados job run by the crunch scripts
+in this repository: per stage percentiles of the timing spans each task
+recorded (see hgi_arvados.timing), the slowest chunks, how well the
+tasks were packed onto each node and the critical path through the
+task sequences.
+
+The job_tasks are listed in pages keyed on uuid, so that jobs with
+100k tasks list quickly. Timing summaries and crunchstat resource use
+are read from the job log collection; summaries for tasks missing from
+the log are read from the timing stream of the job output (written if
+the job was run with timing_summary_output set to true).
+
+Examples:
+  job-performance-report.py zzzzz-8i9sb-0123456789abcde
+  job-performance-report.py --json report.json zzzzz-8i9sb-0123456789abcde
+"""
+
+import os
+import sys
+import json
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "crunch_scripts"))
+
+import arvados      # Import the Arvados sdk module
+
+import hgi_arvados
+from hgi_arvados import report
+
+TASK_SELECT = ['uuid', 'sequence', 'parameters', 'success', 'started_at', 'finished_at', 'output']
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("job_uuid", help="the job to report on")
+    parser.add_argument("--slowest", type=int, default=20, help="number of slowest tasks to list")
+    parser.add_argument("--batch-size", type=int, default=1000, help="job_tasks to request per page")
+    parser.add_argument("--no-log", action="store_true", help="do not read the job log collection")
+    parser.add_argument("--no-output", action="store_true", help="do not read timing summaries from the job output")
+    parser.add_argument("--json", metavar="FILE", help="also write the report as JSON to FILE ('-' for stdout only)")
+    args = parser.parse_args()
+
+    api = arvados.api('v1')
+    job = api.jobs().get(uuid=args.job_uuid).execute()
+
+    sys.stderr.write("Listing tasks of job %s\n" % (args.job_uuid))
+    tasks = list(hgi_arvados.list_all_by_uuid(api.job_tasks(),
+                                              filters=[['job_uuid', '=', args.job_uuid]],
+                                              select=TASK_SELECT,
+                                              batch_size=args.batch_size))
+    sys.stderr.write("Have %s tasks\n" % (len(tasks)))
+
+    log_steps = {}
+    if not args.no_log and job.get('log'):
+        sys.stderr.write("Reading job log %s\n" % (job['log']))
+        log_steps = report.read_job_log(arvados.CollectionReader(job['log'], api_client=api))
+
+    summaries = {}
+    if not args.no_output and job.get('output'):
+        sys.stderr.write("Reading timing summaries from job output %s\n" % (job['output']))
+        summaries = report.read_timing_summaries(arvados.CollectionReader(job['output'], api_client=api))
+
+    job_report = report.build_report(job, tasks, log_steps=log_steps, summaries=summaries, slowest=args.slowest)
+    if args.json == "-":
+        print json.dumps(job_report, indent=2, sort_keys=True)
+        return
+    sys.stdout.write(report.format_report(job_report))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(job_report, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()